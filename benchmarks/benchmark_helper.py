@@ -0,0 +1,42 @@
+import os
+import time
+import logging
+
+from data_loading.data_loaders import set_data_source
+from data_loading.data_sources import SQLiteDataSource
+from data_loading.synthetic_mimic2 import generate_synthetic_mimic2
+
+_SYNTHETIC_DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "synthetic_data")
+
+
+def use_synthetic_data_source(scale, seed=0):
+    """Loads data from a synthetic MIMIC2 database of the given scale. The database is generated on first use and reused
+    by later benchmarks.
+
+    Args:
+        scale: Multiplier for the number of generated patients.
+        seed: Seed for the random number generator.
+
+    Returns:
+        The path to the SQLite file.
+    """
+    database_path = os.path.join(_SYNTHETIC_DATA_DIR, "synthetic_mimic2_scale_%s_seed_%d.db" % (scale, seed))
+    if not os.path.exists(database_path):
+        if not os.path.exists(_SYNTHETIC_DATA_DIR):
+            os.makedirs(_SYNTHETIC_DATA_DIR)
+        logging.info("Generating synthetic database %s" % database_path)
+        generate_synthetic_mimic2(database_path, scale=scale, seed=seed)
+    set_data_source(SQLiteDataSource(database_path))
+    return database_path
+
+
+def time_function(fn, repeat=3):
+    """Calls the function repeat times and returns the result of the last call and the fastest time in seconds."""
+    best_time = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best_time = elapsed if best_time is None else min(best_time, elapsed)
+    return result, best_time
@@ -0,0 +1,50 @@
+import numpy as np
+
+from sklearn.ensemble import RandomForestClassifier
+
+from benchmarks.benchmark_helper import time_function
+from models.compiled_forest import compile_forest
+
+_TRAINING_SAMPLE_COUNT = 3000
+
+_FEATURE_COUNT = 51
+
+_TREATMENT_COUNT = 20
+
+_BATCH_SIZES = [1, 10, 1000, 100000]
+
+
+def assert_probabilities_equal(expected, actual):
+    if isinstance(expected, list):
+        assert len(expected) == len(actual)
+        for (expected_output, actual_output) in zip(expected, actual):
+            assert np.array_equal(expected_output, actual_output)
+    else:
+        assert np.array_equal(expected, actual)
+
+
+# Synthetic preprocessed features, with an outcome and treatments that depend on them. The forests have the same hyper
+# parameters as the outcome and treatment models of the decision engine, with the trees accumulated in order.
+random_state = np.random.RandomState(0)
+features = random_state.randn(_TRAINING_SAMPLE_COUNT, _FEATURE_COUNT)
+died = features[:, 0] + random_state.randn(_TRAINING_SAMPLE_COUNT) * 0.5 > 0.5
+treatments = features[:, 1:_TREATMENT_COUNT + 1] + random_state.randn(_TRAINING_SAMPLE_COUNT, _TREATMENT_COUNT) > 1.5
+forests = [
+    ("outcome", RandomForestClassifier(n_jobs=1, criterion='entropy', max_depth=19, max_features=None,
+                                       n_estimators=55, random_state=0).fit(features, died)),
+    ("treatment", RandomForestClassifier(n_jobs=1, criterion='entropy', max_depth=12, max_features=None,
+                                         n_estimators=40, random_state=0).fit(features, treatments))
+]
+
+for (name, forest) in forests:
+    (compiled_forest, compile_time) = time_function(lambda: compile_forest(forest), repeat=1)
+    print("%s forest compiled in %.3fs" % (name, compile_time))
+    for batch_size in _BATCH_SIZES:
+        X = random_state.randn(batch_size, _FEATURE_COUNT)
+        # Small batches are timed over more calls, the fastest call is reported
+        repeat = 3 if batch_size > 1000 else 20
+        (expected, predict_proba_time) = time_function(lambda: forest.predict_proba(X), repeat=repeat)
+        (actual, compiled_time) = time_function(lambda: compiled_forest.predict_proba(X), repeat=repeat)
+        assert_probabilities_equal(expected, actual)
+        print("%s forest, batch size %6d: predict_proba %9.3fms, compiled forest %9.3fms" %
+              (name, batch_size, 1000 * predict_proba_time, 1000 * compiled_time))
@@ -0,0 +1,56 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.benchmark_helper import use_synthetic_data_source
+from data_loading.data_loaders import get_lab_events, get_chart_events, get_lasix_poe, get_icustay_details
+from data_processing.chart_event_processor import process_chart_events
+from data_processing.feature_store import FeatureStore
+from data_processing.lab_event_processor import process_lab_events
+from data_processing.lasix_poe_processor import process_lasix_poe
+from data_processing.ml_data_prepairer import join_processed_data
+from data_processing.patient_info_processor import get_processed_patient_info
+
+_REPLAY_CHUNKS = 50
+
+_LOOKUPS = 10000
+
+_SINGLE_UPDATES = 200
+
+use_synthetic_data_source(1)
+patients = get_processed_patient_info()
+(lab_events, chart_events) = (get_lab_events(), get_chart_events())
+(lasix_poe, icu_details) = (get_lasix_poe(), get_icustay_details())
+expected = join_processed_data(process_lab_events(lab_events.copy()), process_chart_events(chart_events), patients,
+                               process_lasix_poe(lasix_poe.copy(), icu_details.copy()))
+
+# The events arrive in chunks in the order the database returned them, each chunk updates the icustays it has events for
+store = FeatureStore(patients)
+store.add_icustay_details(icu_details)
+store.add_lasix_orders(lasix_poe)
+(update_count, update_time) = (0, 0.0)
+for (lab_rows, chart_rows) in zip(np.array_split(np.arange(len(lab_events)), _REPLAY_CHUNKS),
+                                  np.array_split(np.arange(len(chart_events)), _REPLAY_CHUNKS)):
+    start = time.perf_counter()
+    update_count += len(store.add_lab_events(lab_events.iloc[lab_rows])) + \
+        len(store.add_chart_events(chart_events.iloc[chart_rows]))
+    update_time += time.perf_counter() - start
+
+pd.testing.assert_frame_equal(expected, store.to_data_frame()[expected.columns], check_categorical=False)
+print("Replayed %d lab and %d chart events in %d chunks: %d icustay updates, %.2fms per update" %
+      (len(lab_events), len(chart_events), _REPLAY_CHUNKS, update_count, 1000 * update_time / update_count))
+print("The %d feature rows match the batch pipeline" % len(expected))
+
+random_rows = expected.sample(_LOOKUPS, replace=True, random_state=0)
+start = time.perf_counter()
+for (icustay_id, date) in zip(random_rows.icustay_id, random_rows.date):
+    store.get_features(icustay_id, date)
+print("Point lookups: %.3fms each" % (1000 * (time.perf_counter() - start) / _LOOKUPS))
+
+# Events that arrive again do not change the features, so they measure the latency of updating a single icustay
+repeated_events = chart_events.sample(_SINGLE_UPDATES, random_state=0)
+start = time.perf_counter()
+for position in range(len(repeated_events)):
+    store.add_chart_events(repeated_events.iloc[[position]])
+print("Single icustay updates: %.2fms each" % (1000 * (time.perf_counter() - start) / _SINGLE_UPDATES))
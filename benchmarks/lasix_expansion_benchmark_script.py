@@ -0,0 +1,55 @@
+import pandas as pd
+
+from benchmarks.benchmark_helper import use_synthetic_data_source, time_function
+from data_loading.data_loaders import get_lasix_poe, get_icustay_details
+from data_processing.datetime_modifier import get_modify_dates_fn
+from data_processing.lasix_poe_processor import get_dated_treatments, expand_treatments_to_icustay_days
+
+
+def expand_treatments_with_loops(treatment_df, icu_details):
+    """The previous implementation of expand_treatments_to_icustay_days, kept as the baseline."""
+    treatment_df_by_icu_id = treatment_df.groupby("icustay_id")
+
+    expanded_treatments = []
+    for icu_row in icu_details.itertuples():
+        try:
+            treatments_for_icustay = treatment_df_by_icu_id.get_group(icu_row.icustay_id).sort_values(["start_dt"])
+        except:
+            icu_stay_time_delta = icu_row.icustay_outtime - icu_row.icustay_intime
+            icu_stay_in_hours = (icu_stay_time_delta.days * 24) + icu_stay_time_delta.seconds * (60 * 60)
+            if icu_stay_in_hours >= 12:
+                treatments_for_icustay = pd.DataFrame()
+            else:
+                continue
+
+        for day in pd.date_range(icu_row.icustay_intime.date(), icu_row.icustay_outtime.date()):
+            selected_row = None
+            for current_row in treatments_for_icustay.itertuples():
+                if current_row.start_dt <= day <= current_row.stop_dt:
+                    selected_row = current_row
+
+            treatment_category = None if selected_row is None else selected_row.treatment_category
+            expanded_treatments.append({
+                "date": day,
+                "treatment": treatment_category,
+                "icustay_id": icu_row.icustay_id})
+
+    expanded_treatments_df = pd.DataFrame(expanded_treatments, columns=["date", "treatment", "icustay_id"])
+    expanded_treatments_df["treatment"] = expanded_treatments_df.treatment.fillna("No treatment")
+    return expanded_treatments_df
+
+
+for scale in [1, 10]:
+    use_synthetic_data_source(scale)
+    get_modify_dates_fn.cache_clear()
+    treatment_df = get_dated_treatments(get_lasix_poe())
+    icu_details = get_modify_dates_fn()(get_icustay_details(), ['icustay_intime', 'icustay_outtime'])
+
+    (expected, loop_time) = time_function(lambda: expand_treatments_with_loops(treatment_df, icu_details), repeat=1)
+    (actual, vectorized_time) = time_function(lambda: expand_treatments_to_icustay_days(treatment_df, icu_details))
+
+    # Newer versions of pandas create the date range with second instead of nanosecond resolution
+    pd.testing.assert_frame_equal(expected, actual, check_dtype=False)
+    print("Scale %dx: %d icustays, %d orders, %d icustay days" %
+          (scale, len(icu_details), len(treatment_df), len(actual)))
+    print("Loops: %.3fs, vectorized: %.3fs, speedup: %.1fx" % (loop_time, vectorized_time, loop_time / vectorized_time))
@@ -0,0 +1,59 @@
+import time
+import tracemalloc
+
+import pandas as pd
+
+from benchmarks.benchmark_helper import use_synthetic_data_source
+from data_loading.data_loaders import get_lab_events, get_chart_events, get_lasix_poe, get_icustay_details
+from data_processing.chart_event_processor import process_chart_events
+from data_processing.datetime_modifier import get_modify_dates_fn
+from data_processing.lab_event_processor import process_lab_events
+from data_processing.lasix_poe_processor import process_lasix_poe
+from data_processing.ml_data_prepairer import build_ml_data_partitions, iter_ml_data_partitions, merge_processed_data
+from data_processing.patient_info_processor import get_processed_patient_info
+
+_MEMORY_BUDGET = 256 * 1024 ** 2
+
+_SORT_COLUMNS = ["icustay_id", "date"]
+
+
+def build_ml_data_in_memory():
+    """Processes the full cohort at once, the way get_ml_data does, as the baseline."""
+    return merge_processed_data(process_lab_events(get_lab_events()), process_chart_events(get_chart_events()),
+                                get_processed_patient_info(), process_lasix_poe(get_lasix_poe(), get_icustay_details()))
+
+
+def build_ml_data_out_of_core():
+    partition_count = build_ml_data_partitions(memory_budget=_MEMORY_BUDGET)
+    return partition_count, pd.concat(iter_ml_data_partitions(), ignore_index=True)
+
+
+def trace_peak_memory(fn):
+    """Calls the function and returns its result, the time it took and the peak number of bytes it allocated."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = fn()
+        return result, time.perf_counter() - start, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# The partitions contain the same rows as the dataset processed in memory
+use_synthetic_data_source(1)
+(expected, in_memory_time, in_memory_peak) = trace_peak_memory(build_ml_data_in_memory)
+((partition_count, actual), out_of_core_time, out_of_core_peak) = trace_peak_memory(build_ml_data_out_of_core)
+pd.testing.assert_frame_equal(
+    expected.sort_values(_SORT_COLUMNS).reset_index(drop=True),
+    actual.sort_values(_SORT_COLUMNS).reset_index(drop=True)[expected.columns],
+    check_categorical=False)
+print("Scale 1x: in memory %.1fs with a %d MB peak, out of core %.1fs in %d partitions with a %d MB peak" %
+      (in_memory_time, in_memory_peak / 1024 ** 2, out_of_core_time, partition_count, out_of_core_peak / 1024 ** 2))
+
+use_synthetic_data_source(100)
+get_modify_dates_fn.cache_clear()
+(partition_count, out_of_core_time, out_of_core_peak) = \
+    trace_peak_memory(lambda: build_ml_data_partitions(memory_budget=_MEMORY_BUDGET))
+row_count = sum(len(partition) for partition in iter_ml_data_partitions(columns=["icustay_id"]))
+print("Scale 100x: %d rows in %d partitions, %.1fs with a %d MB peak, the budget is %d MB" %
+      (row_count, partition_count, out_of_core_time, out_of_core_peak / 1024 ** 2, _MEMORY_BUDGET / 1024 ** 2))
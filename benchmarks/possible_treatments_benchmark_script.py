@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+
+from benchmarks.benchmark_helper import time_function
+from models.decision_engine_predictors import select_possible_treatments
+
+_SAMPLE_COUNT = 20000
+
+_TREATMENT_COUNT = 20
+
+_RECOMMENDATION_PROBABILITY_THRESHOLD = 0.05
+
+
+def get_possible_treatments_with_groupby(ordered_treatments, probabilities_sectioned_by_treatment):
+    """The previous candidate generation of ActualTreatmentPredictor.get_possible_treatments, kept as the baseline."""
+    treatment_dfs = []
+    for (treatment, probabilities_for_treatment) in zip(ordered_treatments, probabilities_sectioned_by_treatment):
+        probability_of_treatment = [prob[1] if len(prob) > 1 else 0 for prob in probabilities_for_treatment]
+        df = pd.DataFrame({
+            "treatment": treatment,
+            "probability_of_treatment": probability_of_treatment,
+            "sample_id": range(len(probability_of_treatment))
+        })
+        treatment_dfs.append(df)
+    combined_df = pd.concat(treatment_dfs)
+    sample_with_high_probability = \
+        combined_df[combined_df.probability_of_treatment > _RECOMMENDATION_PROBABILITY_THRESHOLD]
+    top_treatment_per_sample_id = combined_df.groupby("sample_id")["probability_of_treatment"].nlargest(
+        1).reset_index().drop('level_1', axis=1)
+    samples_ids_with_high_prob = set(sample_with_high_probability.sample_id.unique())
+    all_sample_ids = set(combined_df.sample_id.unique())
+    ids_not_in_high_prob = all_sample_ids - samples_ids_with_high_prob
+    top_treatments_for_samples_missing_high_prob = \
+        top_treatment_per_sample_id[top_treatment_per_sample_id.sample_id.isin(ids_not_in_high_prob)]
+    return pd.concat([sample_with_high_probability, top_treatments_for_samples_missing_high_prob])
+
+
+def get_possible_treatments_with_arrays(ordered_treatments, probabilities_sectioned_by_treatment):
+    probability_of_treatment = np.column_stack([probabilities[:, 1] for probabilities in
+                                                probabilities_sectioned_by_treatment])
+    (sample_ids, treatment_codes) = \
+        select_possible_treatments(probability_of_treatment, _RECOMMENDATION_PROBABILITY_THRESHOLD)
+    return pd.DataFrame({
+        "sample_id": sample_ids,
+        "treatment": ordered_treatments[treatment_codes],
+        "probability_of_treatment": probability_of_treatment[sample_ids, treatment_codes]
+    })
+
+
+# predict_proba of a multi output forest, an array for each treatment with the probabilities of not having and having
+# the treatment. The probabilities are skewed so that some samples have no treatment above the threshold.
+random_state = np.random.RandomState(0)
+ordered_treatments = np.array(["treatment %d" % treatment for treatment in range(_TREATMENT_COUNT)], dtype=object)
+probability_of_treatment = random_state.rand(_SAMPLE_COUNT, _TREATMENT_COUNT) ** 40
+probabilities_sectioned_by_treatment = [np.column_stack([1 - probability_of_treatment[:, treatment],
+                                                         probability_of_treatment[:, treatment]])
+                                        for treatment in range(_TREATMENT_COUNT)]
+
+(expected, groupby_time) = time_function(
+    lambda: get_possible_treatments_with_groupby(ordered_treatments, probabilities_sectioned_by_treatment), repeat=1)
+(actual, array_time) = time_function(
+    lambda: get_possible_treatments_with_arrays(ordered_treatments, probabilities_sectioned_by_treatment))
+
+# The previous implementation lost the treatment of the samples that fell back to their top treatment
+has_fallen_back = expected.treatment.isnull()
+expected = expected.assign(treatment=expected.treatment.where(
+    ~has_fallen_back, ordered_treatments[probability_of_treatment[expected.sample_id].argmax(axis=1)]))
+pd.testing.assert_frame_equal(
+    expected.sort_values(["sample_id", "treatment"]).reset_index(drop=True)[actual.columns],
+    actual.sort_values(["sample_id", "treatment"]).reset_index(drop=True))
+print("%d samples, %d possible treatments, %d samples without a treatment above the threshold" %
+      (_SAMPLE_COUNT, len(actual), has_fallen_back.sum()))
+print("groupby: %.3fs, arrays: %.3fs" % (groupby_time, array_time))
@@ -0,0 +1,21 @@
+from benchmarks.benchmark_helper import use_synthetic_data_source, time_function
+from data_loading.data_loaders import get_chart_events
+from data_processing.chart_event_processor import process_chart_events
+from data_processing.processed_data_interface import configure_processed_data_cache, save_cached_data, \
+    load_cached_data, remove_cached_data
+
+_BENCHMARK_FILE_NAME = "benchmark_processed_chart_events"
+
+use_synthetic_data_source(10)
+chart_events = process_chart_events(get_chart_events())
+print("Processed chart events: %d rows, %d columns" % chart_events.shape)
+
+for storage_format in ["csv", "parquet", "feather"]:
+    configure_processed_data_cache(storage_format=storage_format)
+    save_cached_data(chart_events, _BENCHMARK_FILE_NAME)
+    (_, load_time) = time_function(lambda: load_cached_data(_BENCHMARK_FILE_NAME))
+    (_, column_load_time) = time_function(lambda: load_cached_data(_BENCHMARK_FILE_NAME, columns=["icustay_id", "date"]))
+    print("%s: load %.3fs, two column load %.3fs" % (storage_format, load_time, column_load_time))
+
+remove_cached_data(_BENCHMARK_FILE_NAME)
+configure_processed_data_cache(storage_format="parquet")
@@ -0,0 +1,88 @@
+import json
+import time
+import threading
+from http.client import HTTPConnection
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.benchmark_helper import use_synthetic_data_source
+from data_processing.ml_data_prepairer import get_ml_data
+from models.build_decision_engine import get_decision_engine
+from models.preprocess_pipeline import CATEGORY_FEATURE_FIELDS, SCALAR_FEATURE_FIELDS
+from models.recommendation_service import MicroBatcher, RecommendationServer
+
+_CLIENTS = 32
+
+_REQUESTS_PER_CLIENT = 50
+
+_BATCH_WINDOWS = [0.0, 0.002, 0.01]
+
+_WORKER_COUNTS = [1, 2, 4]
+
+
+def get_payload(row):
+    """Returns the JSON request body with the features of a dataset row, leaving out the missing values."""
+    features = {field: str(row[field]) for field in CATEGORY_FEATURE_FIELDS if not pd.isnull(row[field])}
+    features.update({field: float(row[field]) for field in SCALAR_FEATURE_FIELDS if not pd.isnull(row[field])})
+    return json.dumps(features).encode("utf-8")
+
+
+def send_requests(port, payloads, latencies):
+    """Sends the payloads one after another over one connection, the way a client waiting for each suggestion does,
+    and appends the latency of each request to latencies."""
+    connection = HTTPConnection("127.0.0.1", port)
+    for payload in payloads:
+        start = time.perf_counter()
+        connection.request("POST", "/recommendation", body=payload, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError("Request failed with status %d" % response.status)
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+
+
+def measure_load(decision_engine, payloads, batch_window, workers):
+    """Serves the decision engine on a free port, sends _REQUESTS_PER_CLIENT requests from each of _CLIENTS concurrent
+    clients and returns the client side latencies, the throughput and the server statistics."""
+    batcher = MicroBatcher(decision_engine, batch_window=batch_window, workers=workers)
+    server = RecommendationServer(batcher, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    latencies = []
+    clients = [threading.Thread(target=send_requests,
+                                args=(server.server_address[1],
+                                      payloads[client * _REQUESTS_PER_CLIENT:(client + 1) * _REQUESTS_PER_CLIENT],
+                                      latencies))
+               for client in range(_CLIENTS)]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+
+    stats = batcher.get_stats()
+    server.shutdown()
+    server.server_close()
+    batcher.close()
+    return np.array(latencies), len(latencies) / elapsed, stats
+
+
+# The decision engine is loaded from the model cache, or built from the synthetic data if there is none. The payloads
+# are the features of patient days from the dataset.
+use_synthetic_data_source(1)
+ml_data = get_ml_data()
+decision_engine = get_decision_engine(ml_data)
+feature_rows = ml_data.sample(_CLIENTS * _REQUESTS_PER_CLIENT, replace=True, random_state=0)
+payloads = [get_payload(row) for (_, row) in feature_rows.iterrows()]
+
+print("%d clients sending %d requests each" % (_CLIENTS, _REQUESTS_PER_CLIENT))
+for workers in _WORKER_COUNTS:
+    for batch_window in _BATCH_WINDOWS:
+        (latencies, requests_per_second, stats) = measure_load(decision_engine, payloads, batch_window, workers)
+        print("workers %d, batch window %4.1fms: %6.1f requests/s, latency p50 %6.1fms p95 %6.1fms p99 %6.1fms, "
+              "mean batch size %.1f" %
+              (workers, 1000 * batch_window, requests_per_second, 1000 * np.percentile(latencies, 50),
+               1000 * np.percentile(latencies, 95), 1000 * np.percentile(latencies, 99), stats["mean_batch_size"]))
@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+
+from sklearn.ensemble import RandomForestClassifier
+
+from benchmarks.benchmark_helper import use_synthetic_data_source, time_function
+from data_processing.ml_data_prepairer import get_ml_data
+from models.decision_engine_predictors import OutcomePredictor
+from models.preprocess_pipeline import CongestiveHeartFailurePreprocessor
+
+
+def score_expanded_candidates(outcome_predictor, prediction_df, sample_ids, treatments):
+    """The previous scoring of DecisionEngine.get_treatment_suggestion, which preprocesses a copy of the row of every
+    candidate, kept as the baseline."""
+    candidates = pd.DataFrame({"sample_id": sample_ids, "treatment": treatments})
+    expanded_prediction_df = prediction_df.drop('treatment', axis=1).assign(sample_id=range(len(prediction_df))) \
+        .merge(candidates, on="sample_id")
+    return outcome_predictor.get_probability_of_survival(expanded_prediction_df)
+
+
+use_synthetic_data_source(1)
+data = get_ml_data(use_cache=False)
+outcome_predictor = OutcomePredictor(RandomForestClassifier(n_estimators=20, max_depth=12),
+                                     CongestiveHeartFailurePreprocessor()).fit(data)
+
+# Every sample is combined with every treatment seen in the data, in sample_id order like the merge of the baseline
+all_treatments = data.treatment.dropna().unique()
+sample_ids = np.repeat(np.arange(len(data)), len(all_treatments))
+treatments = np.tile(np.asarray(all_treatments, dtype=object), len(data))
+print("%d samples with %d candidate treatments" % (len(data), len(sample_ids)))
+
+(expected, expanded_time) = time_function(
+    lambda: score_expanded_candidates(outcome_predictor, data, sample_ids, treatments))
+(actual, spliced_time) = time_function(
+    lambda: outcome_predictor.get_probability_of_survival_for_treatments(data, sample_ids, treatments))
+pd.testing.assert_series_equal(expected, actual)
+print("Preprocess every candidate: %.3fs, preprocess every sample once: %.3fs" % (expanded_time, spliced_time))
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+
+from benchmarks.benchmark_helper import time_function
+from models.decision_engine import get_best_treatment_per_sample
+
+_SAMPLE_COUNT = 100000
+
+_TREATMENTS = ["No treatment", "20mg IV", "40mg IV", "80mg IV", "20mg PO", "40mg PO", "Other"]
+
+
+def get_best_treatment_per_sample_with_groupby(expanded_prediction_df):
+    """The previous selection of DecisionEngine.get_treatment_suggestion, kept as the baseline. Uses .loc in place of
+    .ix, which newer versions of pandas do not have."""
+    max_idx = expanded_prediction_df.groupby('sample_id').apply(lambda x: x['probability_of_living'].idxmax())
+    return expanded_prediction_df.loc[max_idx, ['treatment', 'probability_of_living']].reset_index(drop=True)
+
+
+# Every sample has a random subset of the treatments as possible treatments, in the order of _TREATMENTS, the way
+# ActualTreatmentPredictor.get_possible_treatment_codes returns them, and a probability of living with every treatment,
+# the way OutcomePredictor.get_probability_of_survival_by_treatment returns them. Rounding the probabilities makes ties
+# common.
+random_state = np.random.RandomState(0)
+is_possible = random_state.rand(_SAMPLE_COUNT, len(_TREATMENTS)) < 0.4
+is_possible[np.arange(_SAMPLE_COUNT), random_state.randint(len(_TREATMENTS), size=_SAMPLE_COUNT)] = True
+(sample_ids, treatment_codes) = np.nonzero(is_possible)
+treatments = np.array(_TREATMENTS, dtype=object)
+probability_of_living_by_treatment = random_state.rand(_SAMPLE_COUNT, len(_TREATMENTS)).round(2)
+expanded_prediction_df = pd.DataFrame({
+    "sample_id": sample_ids,
+    "treatment": treatments[treatment_codes],
+    "probability_of_living": probability_of_living_by_treatment[sample_ids, treatment_codes]
+})
+print("%d samples with %d possible treatments" % (_SAMPLE_COUNT, len(expanded_prediction_df)))
+
+(expected, groupby_time) = time_function(lambda: get_best_treatment_per_sample_with_groupby(expanded_prediction_df),
+                                         repeat=1)
+(actual, masked_argmax_time) = time_function(lambda: get_best_treatment_per_sample(
+    probability_of_living_by_treatment, sample_ids, treatment_codes, treatments))
+pd.testing.assert_frame_equal(expected, actual)
+print("groupby apply: %.3fs, masked argmax: %.3fs" % (groupby_time, masked_argmax_time))
@@ -0,0 +1,87 @@
+import json
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+# Key in the parquet schema metadata holding the information needed to restore the original DataFrame
+_METADATA_KEY = b'ltr_columns'
+
+
+def write_data_frame(df, file_path, compression='snappy', file_format='parquet'):
+    """Writes a DataFrame to a parquet or feather file. Dtypes such as datetimes, categoricals and float32 are
+    preserved.
+
+    Query results can contain duplicate column names, for example poe_id from "SELECT poe.*, poem.*", and datetime
+    objects outside of the pandas datetime range, for example the obfuscated MIMIC2 dates. Both are stored so that
+    read_data_frame returns the DataFrame unchanged.
+
+    Args:
+        df: The DataFrame to write. The index is not stored.
+        file_path: The file to write.
+        compression: The compression codec, for example snappy, gzip, zstd or none for parquet and lz4, zstd or
+        uncompressed for feather.
+        file_format: parquet or feather. Feather files are faster to read and can be memory mapped without decoding
+        when they are uncompressed, parquet files are smaller.
+    """
+    column_names = list(df.columns)
+    object_date_columns = [
+        position for (position, column_name) in enumerate(column_names)
+        if df.iloc[:, position].dtype == object and
+        pd.api.types.infer_dtype(df.iloc[:, position], skipna=True) in ('datetime', 'date')
+    ]
+    positional_df = df.set_axis([_positional_name(position) for position in range(len(column_names))], axis=1)
+    table = pa.Table.from_pandas(positional_df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[_METADATA_KEY] = json.dumps({
+        "column_names": column_names,
+        "object_date_columns": object_date_columns
+    }).encode('utf8')
+    table = table.replace_schema_metadata(metadata)
+    if file_format == 'feather':
+        feather.write_feather(table, file_path, compression=compression)
+    else:
+        pq.write_table(table, file_path, compression=compression)
+
+
+def read_data_frame(file_path, columns=None, memory_map=False, file_format='parquet'):
+    """Reads a DataFrame written by write_data_frame.
+
+    Args:
+        file_path: The file to read.
+        columns: Only read these columns. Defaults to all columns.
+        memory_map: Whether to memory map the file instead of reading it into a buffer.
+        file_format: The format the file was written in, parquet or feather.
+
+    Returns:
+        The DataFrame.
+    """
+    if file_format == 'feather':
+        schema = feather.read_table(file_path, columns=[], memory_map=memory_map).schema
+    else:
+        schema = pq.read_schema(file_path, memory_map=memory_map)
+    stored_columns = json.loads(schema.metadata[_METADATA_KEY].decode('utf8'))
+    column_names = stored_columns["column_names"]
+    object_date_columns = set(stored_columns["object_date_columns"])
+
+    positions = list(range(len(column_names))) if columns is None else \
+        [column_names.index(column_name) for column_name in columns]
+    positional_names = [_positional_name(position) for position in positions]
+    if file_format == 'feather':
+        table = feather.read_table(file_path, columns=positional_names, memory_map=memory_map)
+    else:
+        table = pq.read_table(file_path, columns=positional_names, memory_map=memory_map)
+
+    has_object_dates = any(position in object_date_columns for position in positions)
+    df = table.to_pandas(timestamp_as_object=has_object_dates)
+    if has_object_dates:
+        for position in positions:
+            name = _positional_name(position)
+            if position not in object_date_columns and pa.types.is_timestamp(table.schema.field(name).type):
+                df[name] = pd.to_datetime(df[name])
+    return df.set_axis([column_names[position] for position in positions], axis=1)
+
+
+def _positional_name(position):
+    return "c%d" % position
@@ -1,10 +1,20 @@
 import os
+import logging
+import time
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 
-from sqlalchemy import create_engine
+from data_loading.data_sources import DEFAULT_DATABASE_URL, get_data_source_for_location
+from data_loading.query_cache import get_cached_query_results
 
 __CONGESTIVE_HEART_FAILURE_CODE = '428.0'
 
+__DEFAULT_LOAD_WORKERS = 6
+
+_data_source = None
+
 __TARGET_LAB_ITEM_IDS = [
     50159, # Sodium in Blood
     50090, # Creatine
@@ -35,91 +45,420 @@ __TARGET_CHART_EVENTS = [
     762 # admit_weight
 ]
 
-def get_lasix_poe():
-    sql_query = """
+# Cohort subqueries used to filter the loaders with semi-joins. Joining icd9 directly would duplicate every row for
+# subjects and admissions that are coded with congestive heart failure more than once.
+__COHORT_HADM_IDS = """
+    SELECT i.hadm_id FROM mimic2v26.icd9 AS i WHERE i.code='%s'
+""" % __CONGESTIVE_HEART_FAILURE_CODE
+
+__COHORT_SUBJECT_IDS = """
+    SELECT i.subject_id FROM mimic2v26.icd9 AS i WHERE i.code='%s'
+""" % __CONGESTIVE_HEART_FAILURE_CODE
+
+
+def get_lasix_poe(icustay_ids=None):
+    return get_query_results(_get_lasix_poe_query(icustay_ids))
+
+
+def get_hospital_admissions():
+    return get_query_results(_get_hospital_admissions_query())
+
+
+def get_patients():
+    return get_query_results(_get_patients_query())
+
+
+def get_demographic_details():
+    return get_query_results(_get_demographic_details_query())
+
+
+def get_lab_events(first_per_day=False, icustay_ids=None):
+    """Returns the target lab events for the cohort.
+
+    Args:
+        first_per_day: Only return the first event with a value per icustay, item and day, or the first event if none
+        of the events for the day have a value. The reduction is done by the database. These are the only events the
+        daily resampling in data_processing.event_processor looks at, so the processed events are the same.
+        icustay_ids: Only return the events for these icustays. Defaults to all icustays in the cohort.
+    """
+    sql_query = _get_lab_events_query(icustay_ids)
+    if first_per_day:
+        sql_query = _get_first_event_per_day_query(sql_query, "valuenum")
+    lab_item_details = get_lab_item_details()[['itemid', 'test_name']].rename(columns={"test_name": "label"})
+    lab_events = _drop_day_rank(get_query_results(sql_query))
+    return lab_events.merge(lab_item_details)
+
+def get_chart_events(first_per_day=False, icustay_ids=None):
+    """Returns the target chart events for the cohort.
+
+    Args:
+        first_per_day: Only return the first event with a value per icustay, item and day, or the first event if none
+        of the events for the day have a value. See get_lab_events.
+        icustay_ids: Only return the events for these icustays. Defaults to all icustays in the cohort.
+    """
+    sql_query = _get_chart_events_query(icustay_ids=icustay_ids)
+    if first_per_day:
+        sql_query = _get_first_event_per_day_query(sql_query, "value1num")
+    chart_items = _drop_day_rank(get_query_results(sql_query))
+    chart_item_details = _get_chart_item_details()[['itemid', 'label']]
+    return chart_items.merge(chart_item_details)
+
+_STREAMED_CHART_EVENT_DTYPES = {
+    "subject_id": "int32",
+    "icustay_id": "int32",
+    "itemid": "int16",
+    "value1num": "float32"
+}
+
+
+def iter_chart_events(chunk_size=100000, first_per_day=False):
+    """Streams the chart events in chunks using a server side cursor so that the full result is never held in memory.
+    Only the columns used by the chart event processor are selected.
+
+    Args:
+        chunk_size: The maximum number of rows in each chunk.
+        first_per_day: Only stream the first event per icustay, item and day. See get_chart_events.
+
+    Returns:
+        A generator of dataframes with the following columns:
+        subject_id: The ID of the subject as int32.
+        icustay_id: The icustay the event was recorded for as int32.
+        charttime: When the event was recorded.
+        itemid: The chart item ID as int16.
+        value1num: The value for the event as float32.
+        label: The chart item label as a category.
+    """
+    sql_query = _get_chart_events_query(columns="ce.subject_id, ce.icustay_id, ce.charttime, ce.itemid, ce.value1num")
+    if first_per_day:
+        sql_query = _get_first_event_per_day_query(sql_query, "value1num")
+    chart_item_details = _get_chart_item_details()
+    target_chart_items = chart_item_details[chart_item_details.itemid.isin(__TARGET_CHART_EVENTS)]
+    label_by_itemid = dict(zip(target_chart_items.itemid, target_chart_items.label))
+    label_dtype = pd.CategoricalDtype(sorted(set(label_by_itemid.values())))
+
+    for chunk in get_data_source().iter_query(sql_query, chunk_size):
+        chunk = _drop_day_rank(chunk).astype(_STREAMED_CHART_EVENT_DTYPES)
+        chunk["label"] = chunk.itemid.map(label_by_itemid).astype(label_dtype)
+        yield chunk
+
+
+def get_icustay_details(icustay_ids=None):
+    return get_query_results(_get_icustay_details_query(icustay_ids))
+
+
+def get_event_counts_by_icustay():
+    """Returns the number of target lab and chart events of each icustay in the cohort. The events are counted by the
+    database, so the counts can be used to plan how to process the events before they are loaded.
+
+    Returns:
+        A DataFrame with the following columns:
+        icustay_id: The ID of the icustay.
+        lab_events: The number of target lab events.
+        chart_events: The number of target chart events.
+    """
+    event_counts = []
+    for (column, sql_query) in [("lab_events", _get_lab_events_query()),
+                                ("chart_events", _get_chart_events_query(columns="ce.icustay_id"))]:
+        counts = get_query_results(
+            "SELECT e.icustay_id, COUNT(*) AS %s FROM (%s) AS e GROUP BY e.icustay_id" % (column, sql_query))
+        event_counts.append(counts.set_index("icustay_id")[column])
+    return pd.concat(event_counts, axis=1).fillna(0).astype("int64").rename_axis("icustay_id").reset_index()
+
+
+def get_watermarks():
+    """Returns the high-water mark of each source table that new ICU data is appended to. Rows added after the
+    watermarks were taken are found with get_icustay_ids_changed_since.
+
+    The watermarks are read from the database directly and not from the query cache.
+
+    Returns:
+        A dict from the source table name to the latest timestamp in the table for the cohort as a string, or None if
+        the table has no rows for the cohort.
+    """
+    watermarks = {}
+    for (table_name, (get_query, column)) in _WATERMARK_COLUMNS.items():
+        results = get_data_source().read_query(
+            "SELECT MAX(e.%s) AS watermark FROM (%s) AS e" % (column, get_query()))
+        watermark = results.watermark.iloc[0]
+        watermarks[table_name] = None if pd.isnull(watermark) else str(watermark)
+    return watermarks
+
+
+def get_icustay_ids_changed_since(watermarks):
+    """Returns the icustays that have rows newer than the watermarks in any of the watermarked source tables.
+
+    Args:
+        watermarks: A dict returned by get_watermarks. Tables without a watermark are treated as if every row is new.
+
+    Returns:
+        A sorted list of icustay IDs.
+    """
+    icustay_ids = set()
+    for (table_name, (get_query, column)) in _WATERMARK_COLUMNS.items():
+        watermark = watermarks.get(table_name)
+        sql_query = "SELECT DISTINCT e.icustay_id FROM (%s) AS e" % get_query()
+        if watermark is not None:
+            sql_query += " WHERE e.%s > '%s'" % (column, watermark)
+        icustay_ids.update(get_data_source().read_query(sql_query).icustay_id.dropna().astype(int))
+    return sorted(icustay_ids)
+
+
+def get_cohort_join_row_counts():
+    """Compares the number of rows returned by the semi-join loader queries with the number of rows the previous
+    queries, which joined icd9 directly, returned for the same data.
+
+    Returns:
+        A DataFrame indexed by loader name with the following columns:
+        icd9_join_rows: The number of rows returned when joining icd9.
+        semi_join_rows: The number of rows returned by the loader.
+        duplicate_rows: The number of rows the icd9 join duplicated.
+    """
+    row_counts = []
+    for (name, icd9_join_query) in _get_icd9_join_queries().items():
+        semi_join_query = _SEMI_JOIN_QUERIES[name]()
+        row_counts.append({
+            "loader": name,
+            "icd9_join_rows": _count_query_rows(icd9_join_query),
+            "semi_join_rows": _count_query_rows(semi_join_query)
+        })
+    report = pd.DataFrame(row_counts, columns=["loader", "icd9_join_rows", "semi_join_rows"]).set_index("loader")
+    report["duplicate_rows"] = report.icd9_join_rows - report.semi_join_rows
+    return report
+
+
+def _get_lasix_poe_query(icustay_ids=None):
+    return """
     SELECT poe.*, poem.*
     FROM mimic2v26.poe_order as poe
     INNER JOIN mimic2v26.poe_med AS poem on poe.poe_id = poem.poe_id
-    INNER JOIN mimic2v26.admissions AS a on a.hadm_id = poe.hadm_id
-    INNER JOIN mimic2v26.icd9 as i on i.hadm_id = a.hadm_id
-    WHERE i.code='%s' AND poe.medication = 'Furosemide' AND poe.icustay_id IS NOT NULL
-    """ % __CONGESTIVE_HEART_FAILURE_CODE
-    return get_query_results(sql_query)
+    WHERE poe.hadm_id IN (%s) AND poe.medication = 'Furosemide' AND poe.icustay_id IS NOT NULL %s
+    """ % (__COHORT_HADM_IDS, _get_icustay_filter("poe", icustay_ids))
 
 
-def get_hospital_admissions():
-    sql_query = """
+def _get_hospital_admissions_query():
+    return """
     SELECT a.* FROM mimic2v26.admissions AS a
-    INNER JOIN mimic2v26.icd9 as i on i.hadm_id = a.hadm_id
-    WHERE i.code='%s'
-    """ % __CONGESTIVE_HEART_FAILURE_CODE
-    return get_query_results(sql_query)
+    WHERE a.hadm_id IN (%s)
+    """ % __COHORT_HADM_IDS
 
 
-def get_patients():
-    sql_query = """
-    SELECT p.*, i.hadm_id
-    FROM mimic2v26.icd9 as i
-    INNER JOIN mimic2v26.d_patients AS p ON p.subject_id = i.subject_id
-    WHERE i.code='%s'
+def _get_patients_query():
+    # One row per cohort admission
+    return """
+    SELECT p.*, c.hadm_id
+    FROM (SELECT DISTINCT i.subject_id, i.hadm_id FROM mimic2v26.icd9 AS i WHERE i.code='%s') AS c
+    INNER JOIN mimic2v26.d_patients AS p ON p.subject_id = c.subject_id
     """ % __CONGESTIVE_HEART_FAILURE_CODE
-    return get_query_results(sql_query)
 
 
-def get_demographic_details():
-    sql_query = """
+def _get_demographic_details_query():
+    return """
     SELECT dd.*
     FROM mimic2v26.demographic_detail as dd
-    INNER JOIN mimic2v26.icd9 as i on i.hadm_id = dd.hadm_id
-    WHERE i.code='%s'
-    """ % __CONGESTIVE_HEART_FAILURE_CODE
-    return get_query_results(sql_query)
+    WHERE dd.hadm_id IN (%s)
+    """ % __COHORT_HADM_IDS
 
 
-def get_lab_events():
-    sql_query = """
+def _get_lab_events_query(icustay_ids=None):
+    return """
     SELECT le.*
     FROM mimic2v26.labevents AS le
-    INNER JOIN mimic2v26.icd9 as i on i.hadm_id = le.hadm_id
-    WHERE i.code='%s' AND
+    WHERE le.hadm_id IN (%s) AND
     le.itemid IN (%s)
-    AND icustay_id IS NOT NULL
-    """ % (__CONGESTIVE_HEART_FAILURE_CODE, ", ".join([str(item) for item in __TARGET_LAB_ITEM_IDS]))
-    lab_item_details = get_lab_item_details()[['itemid', 'test_name']].rename(columns={"test_name": "label"})
-    lab_events = get_query_results(sql_query)
-    return lab_events.merge(lab_item_details)
+    AND le.icustay_id IS NOT NULL %s
+    """ % (__COHORT_HADM_IDS, ", ".join([str(item) for item in __TARGET_LAB_ITEM_IDS]),
+           _get_icustay_filter("le", icustay_ids))
 
-def get_chart_events():
-    sql_query = """
-    SELECT ce.*
+
+def _get_chart_events_query(columns="ce.*", icustay_ids=None):
+    return """
+    SELECT %s
     FROM mimic2v26.chartevents as ce
-    INNER JOIN mimic2v26.icd9 as i on i.subject_id = ce.subject_id
-    WHERE i.code='%s' AND ce.itemid IN (%s) AND icustay_id IS NOT NULL
-    """ % (__CONGESTIVE_HEART_FAILURE_CODE, ", ".join([str(item) for item in __TARGET_CHART_EVENTS]))
-    chart_items = get_query_results(sql_query)
-    chart_item_details = _get_chart_item_details()[['itemid', 'label']]
-    return chart_items.merge(chart_item_details)
+    WHERE ce.subject_id IN (%s) AND ce.itemid IN (%s) AND ce.icustay_id IS NOT NULL %s
+    """ % (columns, __COHORT_SUBJECT_IDS, ", ".join([str(item) for item in __TARGET_CHART_EVENTS]),
+           _get_icustay_filter("ce", icustay_ids))
 
-def get_icustay_details():
-    sql_query = """
+
+def _get_icustay_details_query(icustay_ids=None):
+    return """
     SELECT icd.*
     FROM mimic2v26.icustay_detail as icd
-    INNER JOIN mimic2v26.icd9 as i on i.subject_id = icd.subject_id
-    WHERE i.code='%s'
-    """ % __CONGESTIVE_HEART_FAILURE_CODE
-    return get_query_results(sql_query)
+    WHERE icd.subject_id IN (%s) %s
+    """ % (__COHORT_SUBJECT_IDS, _get_icustay_filter("icd", icustay_ids))
+
+
+def _get_icustay_filter(table_alias, icustay_ids):
+    if icustay_ids is None:
+        return ""
+    # An empty IN list is not valid SQL, NULL matches no rows
+    icustay_id_list = ", ".join([str(int(icustay_id)) for icustay_id in icustay_ids]) or "NULL"
+    return "AND %s.icustay_id IN (%s)" % (table_alias, icustay_id_list)
+
+
+def _get_first_event_per_day_query(event_query, value_column):
+    """Wraps an event query so that only the first event with a value per icustay, item and day is returned, or the
+    first event if none of the events for the day have a value. The events are ranked with a window function over the
+    charttime truncated to the day. The results contain an extra day_rank column."""
+    return """
+    SELECT ranked.* FROM (
+        SELECT e.*, ROW_NUMBER() OVER (
+            PARTITION BY e.icustay_id, e.itemid, %s
+            ORDER BY CASE WHEN e.%s IS NULL THEN 1 ELSE 0 END, e.charttime
+        ) AS day_rank
+        FROM (%s) AS e
+    ) AS ranked
+    WHERE ranked.day_rank = 1
+    """ % (get_data_source().truncate_to_day_sql("e.charttime"), value_column, event_query)
+
+
+def _drop_day_rank(events):
+    return events.drop("day_rank", axis=1) if "day_rank" in events.columns else events
+
+
+_SEMI_JOIN_QUERIES = {
+    "lasix_poe": _get_lasix_poe_query,
+    "hospital_admissions": _get_hospital_admissions_query,
+    "patients": _get_patients_query,
+    "demographic_details": _get_demographic_details_query,
+    "icustay_details": _get_icustay_details_query,
+    "lab_events": _get_lab_events_query,
+    "chart_events": _get_chart_events_query,
+}
+
+
+# The source tables new ICU data is appended to, with the query selecting the cohort rows and the timestamp column
+# tracked by the watermark
+_WATERMARK_COLUMNS = {
+    "icustay_detail": (_get_icustay_details_query, "icustay_intime"),
+    "labevents": (_get_lab_events_query, "charttime"),
+    "chartevents": (_get_chart_events_query, "charttime"),
+    "poe_order": (_get_lasix_poe_query, "start_dt"),
+}
+
+
+def _get_icd9_join_queries():
+    """The loader queries as they were before they were rewritten as semi-joins. Only used for diagnostics."""
+    lab_item_ids = ", ".join([str(item) for item in __TARGET_LAB_ITEM_IDS])
+    chart_item_ids = ", ".join([str(item) for item in __TARGET_CHART_EVENTS])
+    return {
+        "lasix_poe": """
+            SELECT poe.poe_id FROM mimic2v26.poe_order as poe
+            INNER JOIN mimic2v26.poe_med AS poem on poe.poe_id = poem.poe_id
+            INNER JOIN mimic2v26.admissions AS a on a.hadm_id = poe.hadm_id
+            INNER JOIN mimic2v26.icd9 as i on i.hadm_id = a.hadm_id
+            WHERE i.code='%s' AND poe.medication = 'Furosemide' AND poe.icustay_id IS NOT NULL
+            """ % __CONGESTIVE_HEART_FAILURE_CODE,
+        "hospital_admissions": """
+            SELECT a.* FROM mimic2v26.admissions AS a
+            INNER JOIN mimic2v26.icd9 as i on i.hadm_id = a.hadm_id
+            WHERE i.code='%s'
+            """ % __CONGESTIVE_HEART_FAILURE_CODE,
+        "patients": """
+            SELECT p.*, i.hadm_id FROM mimic2v26.icd9 as i
+            INNER JOIN mimic2v26.d_patients AS p ON p.subject_id = i.subject_id
+            WHERE i.code='%s'
+            """ % __CONGESTIVE_HEART_FAILURE_CODE,
+        "demographic_details": """
+            SELECT dd.* FROM mimic2v26.demographic_detail as dd
+            INNER JOIN mimic2v26.icd9 as i on i.hadm_id = dd.hadm_id
+            WHERE i.code='%s'
+            """ % __CONGESTIVE_HEART_FAILURE_CODE,
+        "icustay_details": """
+            SELECT icd.* FROM mimic2v26.icustay_detail as icd
+            INNER JOIN mimic2v26.icd9 as i on i.subject_id = icd.subject_id
+            WHERE i.code='%s'
+            """ % __CONGESTIVE_HEART_FAILURE_CODE,
+        "lab_events": """
+            SELECT le.* FROM mimic2v26.labevents AS le
+            INNER JOIN mimic2v26.icd9 as i on i.hadm_id = le.hadm_id
+            WHERE i.code='%s' AND le.itemid IN (%s) AND icustay_id IS NOT NULL
+            """ % (__CONGESTIVE_HEART_FAILURE_CODE, lab_item_ids),
+        "chart_events": """
+            SELECT ce.* FROM mimic2v26.chartevents as ce
+            INNER JOIN mimic2v26.icd9 as i on i.subject_id = ce.subject_id
+            WHERE i.code='%s' AND ce.itemid IN (%s) AND icustay_id IS NOT NULL
+            """ % (__CONGESTIVE_HEART_FAILURE_CODE, chart_item_ids),
+    }
+
+
+def _count_query_rows(sql_query):
+    return int(get_data_source().read_query("SELECT COUNT(*) AS row_count FROM (%s) AS q" % sql_query).row_count[0])
 
 def get_lab_item_details():
-    file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "mimic2_reference_data", "lab_item_details.csv")
-    return pd.read_csv(file_path)
+    return _read_reference_data("lab_item_details.csv").copy()
 
 def _get_chart_item_details():
-    file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "mimic2_reference_data", "chart_item_details.csv")
+    return _read_reference_data("chart_item_details.csv").copy()
+
+@functools.lru_cache()
+def _read_reference_data(file_name):
+    file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "mimic2_reference_data", file_name)
     return pd.read_csv(file_path)
 
-# TODO: allow configuration
+def set_data_source(data_source):
+    """Sets the data source used by all loaders.
+
+    Args:
+        data_source: A data_loading.data_sources.DataSource, for example a SQLiteDataSource pointing at a synthetic
+        MIMIC2 database.
+    """
+    global _data_source
+    _data_source = data_source
+
+
+def get_data_source():
+    """Returns the data source used by all loaders. Defaults to the database at the MIMIC2_DATABASE_URL environment
+    variable, or the local MIMIC2 postgres database."""
+    global _data_source
+    if _data_source is None:
+        _data_source = get_data_source_for_location(os.environ.get("MIMIC2_DATABASE_URL", DEFAULT_DATABASE_URL))
+    return _data_source
+
+
 def get_query_results(sql_query):
-    return pd.read_sql_query(sql_query, create_engine('postgresql://ckipers@localhost:5432/MIMIC2'), parse_dates=[])
+    start = time.perf_counter()
+    results = get_cached_query_results(sql_query, get_data_source())
+    stop = time.perf_counter()
+    logging.info("Query returned %d rows in %.3fs: %s" % (len(results), stop - start, " ".join(sql_query.split())[:80]))
+    return results
+
+
+_BULK_LOADERS = {
+    "lasix_poe": get_lasix_poe,
+    "hospital_admissions": get_hospital_admissions,
+    "patients": get_patients,
+    "demographic_details": get_demographic_details,
+    "icustay_details": get_icustay_details,
+    "lab_events": get_lab_events,
+    "chart_events": get_chart_events,
+}
+
+
+def load_all(names=None, max_workers=None):
+    """Runs the independent loader queries concurrently on a thread pool. Each loader checks out its own connection
+    from the data source's pool.
+
+    Args:
+        names: The loaders to run. Defaults to all loaders: lasix_poe, hospital_admissions, patients,
+        demographic_details, icustay_details, lab_events and chart_events.
+        max_workers: The number of threads used to run the queries.
+
+    Returns:
+        A dict mapping loader name to the DataFrame the loader returns.
+    """
+    names = list(_BULK_LOADERS) if names is None else list(names)
+    max_workers = max_workers or __DEFAULT_LOAD_WORKERS
+
+    def timed_load(name):
+        start = time.perf_counter()
+        data = _BULK_LOADERS[name]()
+        stop = time.perf_counter()
+        logging.info("Loading %s took %.3fs" % (name, stop - start))
+        return data
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {name: executor.submit(timed_load, name) for name in names}
+        return {name: future.result() for (name, future) in futures.items()}
 
 # TODO remove or move to another file
 def analyze_chart_items(chart_items_df):
@@ -0,0 +1,165 @@
+import os
+import datetime
+import threading
+
+import pandas as pd
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import NullPool
+
+DEFAULT_DATABASE_URL = 'postgresql://ckipers@localhost:5432/MIMIC2'
+
+# Columns in the MIMIC2 tables that hold timestamps. Backends that store timestamps as text use this list to convert
+# them back into datetime objects.
+DATE_COLUMNS = [
+    'admit_dt',
+    'charttime',
+    'disch_dt',
+    'dob',
+    'dod',
+    'enter_dt',
+    'icustay_intime',
+    'icustay_outtime',
+    'realtime',
+    'start_dt',
+    'stop_dt'
+]
+
+
+class DataSource(object):
+    """Provides query access to the tables in the mimic2v26 schema. Loaders only depend on this interface so that the
+    MIMIC2 postgres database can be swapped out for a local copy."""
+
+    @property
+    def identity(self):
+        """A string that uniquely identifies the data behind the source."""
+        raise NotImplementedError()
+
+    def read_query(self, sql_query):
+        """Runs the query and returns the results as a DataFrame."""
+        raise NotImplementedError()
+
+    def iter_query(self, sql_query, chunk_size):
+        """Runs the query and yields the results as DataFrames with at most chunk_size rows."""
+        raise NotImplementedError()
+
+    def truncate_to_day_sql(self, column):
+        """Returns the SQL expression that truncates a timestamp column to its day."""
+        return "date_trunc('day', %s)" % column
+
+
+class SqlAlchemyDataSource(DataSource):
+    """Data source backed by a database reachable through SQLAlchemy, such as the MIMIC2 postgres database. All queries
+    share a single pooled engine that is created on first use.
+
+    Args:
+        url: SQLAlchemy url of the database.
+        pool_size: The number of connections kept open in the pool.
+        max_overflow: The number of connections that can be opened beyond pool_size when the pool is exhausted.
+    """
+
+    def __init__(self, url=DEFAULT_DATABASE_URL, pool_size=6, max_overflow=2):
+        self.url = url
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self._engine = None
+        self._engine_lock = threading.Lock()
+
+    @property
+    def identity(self):
+        return self.url
+
+    def get_engine(self):
+        with self._engine_lock:
+            if self._engine is None:
+                self._engine = self._create_engine()
+            return self._engine
+
+    def dispose(self):
+        with self._engine_lock:
+            if self._engine is not None:
+                self._engine.dispose()
+                self._engine = None
+
+    def read_query(self, sql_query):
+        return pd.read_sql_query(sql_query, self.get_engine(), parse_dates=[])
+
+    def iter_query(self, sql_query, chunk_size):
+        with self.get_engine().connect().execution_options(stream_results=True) as connection:
+            for chunk in pd.read_sql_query(sql_query, connection, chunksize=chunk_size):
+                yield chunk
+
+    def _create_engine(self):
+        return create_engine(self.url, pool_size=self.pool_size, max_overflow=self.max_overflow, pool_pre_ping=True)
+
+    def __getstate__(self):
+        # Engines can not be pickled. The engine is recreated on first use after unpickling.
+        state = self.__dict__.copy()
+        state['_engine'] = None
+        del state['_engine_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._engine_lock = threading.Lock()
+
+
+class SQLiteDataSource(SqlAlchemyDataSource):
+    """Data source backed by a local SQLite file containing the mimic2v26 tables, such as the file written by
+    data_loading.synthetic_mimic2. The file is attached as the mimic2v26 schema so that the loader queries run
+    unchanged.
+
+    SQLite stores timestamps as text, so the timestamp columns are converted back into datetime objects, matching what
+    the postgres driver returns for the obfuscated MIMIC2 dates.
+
+    Args:
+        database_path: Path to the SQLite file.
+    """
+
+    def __init__(self, database_path):
+        super().__init__(url="sqlite://")
+        self.database_path = os.path.realpath(database_path)
+
+    @property
+    def identity(self):
+        modified_time = os.path.getmtime(self.database_path) if os.path.exists(self.database_path) else None
+        return "sqlite:///%s@%s" % (self.database_path, modified_time)
+
+    def read_query(self, sql_query):
+        return _parse_text_dates(super().read_query(sql_query))
+
+    def truncate_to_day_sql(self, column):
+        return "date(%s)" % column
+
+    def iter_query(self, sql_query, chunk_size):
+        # SQLite has no server side cursors, the driver already fetches rows lazily.
+        with self.get_engine().connect() as connection:
+            for chunk in pd.read_sql_query(sql_query, connection, chunksize=chunk_size):
+                yield _parse_text_dates(chunk)
+
+    def _create_engine(self):
+        # SQLite connections can not be shared between threads, so each query opens its own connection.
+        engine = create_engine(self.url, poolclass=NullPool)
+        database_path = self.database_path
+
+        @event.listens_for(engine, "connect")
+        def attach_mimic2_schema(dbapi_connection, connection_record):
+            dbapi_connection.execute("ATTACH DATABASE ? AS mimic2v26", (database_path,))
+
+        return engine
+
+
+def get_data_source_for_location(location):
+    """Creates a data source from a SQLAlchemy url or a path to a SQLite file."""
+    if "://" in location:
+        return SqlAlchemyDataSource(location)
+    return SQLiteDataSource(location)
+
+
+def _parse_text_dates(df):
+    for column in DATE_COLUMNS:
+        if column in df.columns and pd.api.types.is_string_dtype(df[column]):
+            parsed_dates = [datetime.datetime.fromisoformat(value) if isinstance(value, str) else None
+                            for value in df[column]]
+            df[column] = pd.Series(parsed_dates, index=df.index, dtype=object)
+    return df
@@ -0,0 +1,122 @@
+import os
+import shutil
+import hashlib
+import logging
+import threading
+import contextlib
+from collections import OrderedDict
+
+from data_loading.columnar_storage import write_data_frame, read_data_frame
+
+_settings = {
+    "directory": os.path.join(os.path.dirname(os.path.realpath(__file__)), "query_cache"),
+    "max_memory_bytes": 1024 ** 3,
+    "enabled": True
+}
+
+# Query results and their size in bytes kept in memory, ordered from least to most recently used
+_memory_cache = OrderedDict()
+_memory_cache_bytes = {"total": 0}
+_memory_cache_lock = threading.Lock()
+
+
+def configure_query_cache(directory=None, max_memory_bytes=None, enabled=None):
+    """Configures the query result cache.
+
+    Args:
+        directory: The directory the cached query results are stored in.
+        max_memory_bytes: The maximum size of the query results kept in memory. The least recently used results are
+        evicted first. Evicted results are still read from disk.
+        enabled: Whether query results are cached.
+    """
+    if directory is not None:
+        _settings["directory"] = directory
+    if max_memory_bytes is not None:
+        _settings["max_memory_bytes"] = max_memory_bytes
+    if enabled is not None:
+        _settings["enabled"] = enabled
+    with _memory_cache_lock:
+        _evict_memory_cache_entries()
+
+
+@contextlib.contextmanager
+def query_cache_disabled():
+    """Runs the queries made in the with block without caching their results, for example when data is loaded
+    partition by partition and keeping the results of every partition would defeat the purpose."""
+    enabled = _settings["enabled"]
+    _settings["enabled"] = False
+    try:
+        yield
+    finally:
+        _settings["enabled"] = enabled
+
+
+def get_cached_query_results(sql_query, data_source):
+    """Returns the results of a query, running it against the data source only if it has not been cached before. Results
+    are looked up in memory first, then on disk. They are keyed by the normalized query text and the identity of the
+    data source, so results from different databases are never mixed up.
+
+    Args:
+        sql_query: The query to run.
+        data_source: The data_loading.data_sources.DataSource to run the query against.
+
+    Returns:
+        A DataFrame with the query results. Callers are free to modify it.
+    """
+    if not _settings["enabled"]:
+        return data_source.read_query(sql_query)
+
+    key = _get_cache_key(sql_query, data_source.identity)
+    with _memory_cache_lock:
+        if key in _memory_cache:
+            _memory_cache.move_to_end(key)
+            logging.debug("Query results %s loaded from memory" % key)
+            return _memory_cache[key][0].copy()
+
+    file_path = os.path.join(_settings["directory"], key + ".parquet")
+    if os.path.exists(file_path):
+        logging.debug("Query results %s loaded from disk" % key)
+        results = read_data_frame(file_path)
+    else:
+        results = data_source.read_query(sql_query)
+        if not os.path.exists(_settings["directory"]):
+            os.makedirs(_settings["directory"], exist_ok=True)
+        # Write to a temporary file first so that concurrent readers never see a partially written file
+        temporary_file_path = "%s.%d.%d.tmp" % (file_path, os.getpid(), threading.get_ident())
+        write_data_frame(results, temporary_file_path)
+        os.replace(temporary_file_path, file_path)
+
+    with _memory_cache_lock:
+        _add_memory_cache_entry(key, results)
+    return results.copy()
+
+
+def clear_query_cache():
+    """Removes all cached query results from memory and disk."""
+    with _memory_cache_lock:
+        _memory_cache.clear()
+        _memory_cache_bytes["total"] = 0
+    if os.path.exists(_settings["directory"]):
+        shutil.rmtree(_settings["directory"])
+
+
+def _get_cache_key(sql_query, source_identity):
+    normalized_query = " ".join(sql_query.split())
+    return hashlib.sha1(("%s\n%s" % (source_identity, normalized_query)).encode("utf8")).hexdigest()
+
+
+def _add_memory_cache_entry(key, results):
+    size = int(results.memory_usage(index=True, deep=True).sum())
+    if size > _settings["max_memory_bytes"]:
+        return
+    if key in _memory_cache:
+        _memory_cache_bytes["total"] -= _memory_cache.pop(key)[1]
+    _memory_cache[key] = (results, size)
+    _memory_cache_bytes["total"] += size
+    _evict_memory_cache_entries()
+
+
+def _evict_memory_cache_entries():
+    while _memory_cache and _memory_cache_bytes["total"] > _settings["max_memory_bytes"]:
+        (_, (_, evicted_size)) = _memory_cache.popitem(last=False)
+        _memory_cache_bytes["total"] -= evicted_size
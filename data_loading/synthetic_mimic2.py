@@ -0,0 +1,368 @@
+import os
+import sqlite3
+import datetime
+import logging
+
+import numpy as np
+import pandas as pd
+
+from data_loading.data_sources import DATE_COLUMNS
+
+# The number of subjects generated at scale 1. Scale 10 and 100 generate 10 and 100 times as many subjects.
+BASE_SUBJECT_COUNT = 500
+
+_SUBJECTS_PER_BATCH = 1000
+
+_CONGESTIVE_HEART_FAILURE_CODE = '428.0'
+
+_OTHER_ICD9_CODES = [
+    ('401.9', 'HYPERTENSION NOS'),
+    ('427.31', 'ATRIAL FIBRILLATION'),
+    ('584.9', 'ACUTE RENAL FAILURE NOS'),
+    ('250.00', 'DMII WO CMP NT ST UNCNTR')
+]
+
+# itemid: (mean, standard deviation, unit of measurement)
+_LAB_ITEMS = {
+    50159: (139, 4, 'mEq/L'),
+    50090: (1.6, 0.9, 'mg/dL'),
+    50177: (35, 18, 'mg/dL'),
+    50195: (6000, 4000, 'pg/mL'),
+    50073: (60, 40, 'IU/L'),
+    50062: (50, 35, 'IU/L'),
+    50188: (0.5, 0.4, 'ng/mL'),
+    50189: (0.3, 0.3, 'ng/mL'),
+    50384: (0, 0, ''),
+    50386: (10.5, 1.8, 'g/dL'),
+    50277: (60, 30, 'mEq/L'),
+    50178: (7, 2, 'mg/dL'),
+    50149: (4.2, 0.5, 'mEq/L'),
+    50383: (31, 5, '%')
+}
+
+_CHART_ITEMS = {
+    211: (85, 15, 'BPM'),
+    813: (31, 5, '%'),
+    814: (10.5, 1.8, 'gm/dl'),
+    821: (2.1, 0.3, 'mg/dl'),
+    827: (3.8, 0.9, 'mg/dl'),
+    618: (19, 5, 'BPM'),
+    646: (96, 3, '%'),
+    677: (37, 0.6, 'Deg. C'),
+    811: (140, 45, 'mg/dl'),
+    762: (80, 20, 'kg')
+}
+
+# Chart items are recorded several times a day, lab items about once a day.
+_CHART_EVENTS_PER_DAY = 6
+_LAB_EVENTS_PER_DAY = 1
+
+_LASIX_DOSES = [('20', 'mg'), ('40', 'mg'), ('80', 'mg'), ('10', 'mg/hr'), ('40', 'ml')]
+_LASIX_ROUTES = ['IV', 'PO', 'IV DRIP']
+_OTHER_MEDICATIONS = ['Metoprolol', 'Heparin', 'Insulin', 'Potassium Chloride']
+
+_MARITAL_STATUSES = ['MARRIED', 'SINGLE', 'WIDOWED', 'DIVORCED', None]
+_ETHNICITIES = ['WHITE', 'BLACK/AFRICAN AMERICAN', 'HISPANIC OR LATINO', 'ASIAN', 'UNKNOWN/NOT SPECIFIED']
+_PAYOR_GROUPS = ['MEDICARE', 'PRIVATE', 'MEDICAID', 'SELF PAY']
+_RELIGIONS = ['CATHOLIC', 'PROTESTANT QUAKER', 'JEWISH', 'NOT SPECIFIED', 'UNOBTAINABLE']
+
+_TABLE_NAMES = [
+    'd_patients',
+    'admissions',
+    'icd9',
+    'demographic_detail',
+    'icustay_detail',
+    'poe_order',
+    'poe_med',
+    'labevents',
+    'chartevents'
+]
+
+
+def generate_synthetic_mimic2(database_path, scale=1, seed=0):
+    """Writes a SQLite database with synthetic tables shaped like the mimic2v26 tables used by the loaders. The
+    database can be used with data_loading.data_sources.SQLiteDataSource to run the pipeline without access to
+    MIMIC2.
+
+    Like MIMIC2, dates are obfuscated by shifting them hundreds of years into the future.
+
+    Args:
+        database_path: The SQLite file to write. An existing file is replaced.
+        scale: Multiplier for the number of subjects. Scale 1 generates BASE_SUBJECT_COUNT subjects.
+        seed: Seed for the random number generator.
+
+    Returns:
+        A dict mapping table name to the number of rows written.
+    """
+    if os.path.exists(database_path):
+        os.remove(database_path)
+
+    random_state = np.random.RandomState(seed)
+    subject_count = int(BASE_SUBJECT_COUNT * scale)
+    row_counts = {name: 0 for name in _TABLE_NAMES}
+    id_counters = {'hadm_id': 100000, 'icustay_id': 200000, 'poe_id': 300000}
+
+    connection = sqlite3.connect(database_path)
+    try:
+        for first_subject_id in range(1, subject_count + 1, _SUBJECTS_PER_BATCH):
+            last_subject_id = min(first_subject_id + _SUBJECTS_PER_BATCH, subject_count + 1)
+            tables = generate_synthetic_tables(range(first_subject_id, last_subject_id), random_state, id_counters)
+            for name in _TABLE_NAMES:
+                _to_sql_text_dates(tables[name]).to_sql(name, connection, if_exists='append', index=False)
+                row_counts[name] += len(tables[name])
+            logging.info("Generated synthetic subjects %d to %d of %d" %
+                         (first_subject_id, last_subject_id - 1, subject_count))
+
+        # Events are indexed by icustay_id as in MIMIC2, so that the events of some icustays are read without a scan
+        for (table, column) in [('icd9', 'code'), ('labevents', 'itemid'), ('chartevents', 'itemid'),
+                                ('labevents', 'icustay_id'), ('chartevents', 'icustay_id'),
+                                ('poe_order', 'medication'), ('poe_med', 'poe_id'), ('icustay_detail', 'subject_id')]:
+            connection.execute("CREATE INDEX %s_%s ON %s (%s)" % (table, column, table, column))
+        # Collect statistics so that the query planner starts joins from the icd9 cohort
+        connection.execute("ANALYZE")
+        connection.commit()
+    finally:
+        connection.close()
+    return row_counts
+
+
+def generate_synthetic_tables(subject_ids, random_state, id_counters):
+    """Generates the synthetic tables for a batch of subjects.
+
+    Args:
+        subject_ids: The subject IDs to generate data for.
+        random_state: A numpy RandomState.
+        id_counters: A dict with the last used hadm_id, icustay_id and poe_id. It is updated so that IDs stay unique
+        across batches.
+
+    Returns:
+        A dict mapping table name to a DataFrame.
+    """
+    rows = {name: [] for name in _TABLE_NAMES}
+    for subject_id in subject_ids:
+        _add_subject_rows(subject_id, random_state, id_counters, rows)
+    tables = {name: pd.DataFrame(rows[name]) for name in _TABLE_NAMES if rows[name]}
+    tables['labevents'] = _generate_lab_events(tables['icustay_detail'], random_state)
+    tables['chartevents'] = _generate_chart_events(tables['icustay_detail'], random_state)
+    return tables
+
+
+def _add_subject_rows(subject_id, random_state, id_counters, rows):
+    # Obfuscated date of birth, MIMIC2 dates are shifted into the 26th to 34th century
+    dob = datetime.datetime(int(random_state.randint(2500, 3300)), int(random_state.randint(1, 13)),
+                            int(random_state.randint(1, 29)))
+    age = int(random_state.randint(45, 90))
+    first_admit = datetime.datetime(dob.year + age, int(random_state.randint(1, 13)), int(random_state.randint(1, 29)),
+                                    int(random_state.randint(0, 24)), int(random_state.randint(0, 60)))
+
+    admissions = []
+    admit_dt = first_admit
+    for _ in range(random_state.randint(1, 4)):
+        id_counters['hadm_id'] += 1
+        length_of_stay = datetime.timedelta(days=int(random_state.randint(2, 15)), hours=int(random_state.randint(24)))
+        admissions.append((id_counters['hadm_id'], admit_dt, admit_dt + length_of_stay))
+        admit_dt = admit_dt + length_of_stay + datetime.timedelta(days=int(random_state.randint(30, 400)))
+
+    died_in_hospital = random_state.rand() < 0.2
+    last_discharge = admissions[-1][2]
+    if died_in_hospital:
+        dod = datetime.datetime.combine(last_discharge.date(), datetime.time())
+    elif random_state.rand() < 0.3:
+        dod = datetime.datetime.combine((last_discharge + datetime.timedelta(days=int(random_state.randint(1, 1000))))
+                                        .date(), datetime.time())
+    else:
+        dod = None
+
+    sex = 'M' if random_state.rand() < 0.55 else 'F'
+    rows['d_patients'].append({
+        'subject_id': subject_id,
+        'sex': sex,
+        'dob': dob,
+        'dod': dod,
+        'hospital_expire_flg': 'Y' if died_in_hospital else 'N'
+    })
+
+    for (hadm_id, admit_dt, disch_dt) in admissions:
+        rows['admissions'].append({'hadm_id': hadm_id, 'subject_id': subject_id, 'admit_dt': admit_dt,
+                                   'disch_dt': disch_dt})
+        _add_admission_rows(subject_id, hadm_id, admit_dt, disch_dt, random_state, id_counters, rows)
+
+
+def _add_admission_rows(subject_id, hadm_id, admit_dt, disch_dt, random_state, id_counters, rows):
+    # Most admissions are coded with congestive heart failure, some are coded with it more than once.
+    codes = []
+    if random_state.rand() < 0.8:
+        codes.append((_CONGESTIVE_HEART_FAILURE_CODE, 'CONGESTIVE HEART FAILURE NOS'))
+        if random_state.rand() < 0.1:
+            codes.append((_CONGESTIVE_HEART_FAILURE_CODE, 'CONGESTIVE HEART FAILURE NOS'))
+    codes.extend(_OTHER_ICD9_CODES[i] for i in random_state.choice(len(_OTHER_ICD9_CODES), 2, replace=False))
+    for (sequence, (code, description)) in enumerate(codes, 1):
+        rows['icd9'].append({'subject_id': subject_id, 'hadm_id': hadm_id, 'sequence': sequence, 'code': code,
+                             'description': description})
+
+    rows['demographic_detail'].append({
+        'subject_id': subject_id,
+        'hadm_id': hadm_id,
+        'marital_status_descr': _MARITAL_STATUSES[random_state.randint(len(_MARITAL_STATUSES))],
+        'ethnicity_descr': _ETHNICITIES[random_state.randint(len(_ETHNICITIES))],
+        'overall_payor_group_descr': _PAYOR_GROUPS[random_state.randint(len(_PAYOR_GROUPS))],
+        'religion_descr': _RELIGIONS[random_state.randint(len(_RELIGIONS))],
+        'admission_type_descr': 'EMERGENCY',
+        'admission_source_descr': 'EMERGENCY ROOM ADMIT'
+    })
+
+    intime = admit_dt + datetime.timedelta(hours=int(random_state.randint(1, 12)))
+    outtime = min(intime + datetime.timedelta(hours=int(random_state.randint(6, 24 * 10))), disch_dt)
+    id_counters['icustay_id'] += 1
+    icustay_id = id_counters['icustay_id']
+    rows['icustay_detail'].append({
+        'icustay_id': icustay_id,
+        'subject_id': subject_id,
+        'hadm_id': hadm_id,
+        'icustay_intime': intime,
+        'icustay_outtime': outtime,
+        'icustay_los': int((outtime - intime).total_seconds() // 60),
+        'icustay_first_careunit': 'CCU'
+    })
+
+    _add_medication_rows(subject_id, hadm_id, icustay_id, intime, outtime, random_state, id_counters, rows)
+
+
+def _add_medication_rows(subject_id, hadm_id, icustay_id, intime, outtime, random_state, id_counters, rows):
+    stay_hours = max(int((outtime - intime).total_seconds() // 3600), 1)
+    lasix_order_count = random_state.randint(0, 4)
+    medications = ['Furosemide'] * lasix_order_count + \
+        [_OTHER_MEDICATIONS[i] for i in random_state.choice(len(_OTHER_MEDICATIONS), 2, replace=False)]
+    for medication in medications:
+        id_counters['poe_id'] += 1
+        start_dt = intime + datetime.timedelta(hours=int(random_state.randint(stay_hours)))
+        stop_dt = start_dt + datetime.timedelta(hours=int(random_state.randint(4, 96)))
+        # Some orders are missing their stop date
+        if random_state.rand() < 0.05:
+            stop_dt = None
+        if medication == 'Furosemide':
+            (dose_val_rx, dose_unit_rx) = _LASIX_DOSES[random_state.randint(len(_LASIX_DOSES))]
+            route = _LASIX_ROUTES[random_state.randint(len(_LASIX_ROUTES))]
+        else:
+            (dose_val_rx, dose_unit_rx, route) = ('1', 'unit', 'PO')
+        rows['poe_order'].append({
+            'poe_id': id_counters['poe_id'],
+            'subject_id': subject_id,
+            'hadm_id': hadm_id,
+            'icustay_id': icustay_id,
+            'start_dt': start_dt,
+            'stop_dt': stop_dt,
+            'enter_dt': start_dt,
+            'medication': medication,
+            'procedure_type': 'IV Piggyback' if route == 'IV' else 'Unit Dose',
+            'status': 'Inactive',
+            'route': route,
+            'frequency': 'Q12H'
+        })
+        rows['poe_med'].append({
+            'poe_id': id_counters['poe_id'],
+            'drug_type': 'MAIN',
+            'drug_name': medication,
+            'drug_name_generic': medication,
+            'dose_val_rx': dose_val_rx,
+            'dose_unit_rx': dose_unit_rx,
+            'form_val_disp': '1',
+            'form_unit_disp': 'VIAL'
+        })
+
+
+def _generate_events(icustays, items, events_per_day, random_state):
+    """Generates events for every item in every icustay. Event times are spread uniformly over the stay.
+
+    Returns:
+        A dataframe with the following columns:
+        subject_id, hadm_id, icustay_id, itemid, charttime (as text), value, valueuom
+    """
+    intimes = np.array(icustays.icustay_intime.tolist(), dtype='datetime64[m]')
+    stay_minutes = np.maximum(icustays.icustay_los.values, 1)
+    events_per_item = np.maximum((stay_minutes / (24 * 60) * events_per_day).astype(int), 1)
+
+    itemids = np.array(list(items.keys()))
+    means = np.array([items[itemid][0] for itemid in itemids], dtype=float)
+    stds = np.array([items[itemid][1] for itemid in itemids], dtype=float)
+    units = np.array([items[itemid][2] for itemid in itemids], dtype=object)
+
+    # One block of events per icustay and item
+    block_stay = np.repeat(np.arange(len(icustays)), len(itemids))
+    block_item = np.tile(np.arange(len(itemids)), len(icustays))
+    block_sizes = events_per_item[block_stay]
+    event_stay = np.repeat(block_stay, block_sizes)
+    event_item = np.repeat(block_item, block_sizes)
+
+    minutes = (random_state.rand(len(event_stay)) * stay_minutes[event_stay]).astype(int)
+    charttimes = intimes[event_stay] + minutes.astype('timedelta64[m]')
+    values = np.round(random_state.normal(means[event_item], stds[event_item]), 1)
+
+    events = pd.DataFrame({
+        'subject_id': icustays.subject_id.values[event_stay],
+        'hadm_id': icustays.hadm_id.values[event_stay],
+        'icustay_id': icustays.icustay_id.values[event_stay],
+        'itemid': itemids[event_item],
+        'charttime': np.char.replace(np.datetime_as_string(charttimes, unit='s'), 'T', ' ').astype(object),
+        'value': values,
+        'valueuom': units[event_item]
+    })
+    return events.sort_values(['icustay_id', 'charttime'], kind='mergesort').reset_index(drop=True)
+
+
+def _generate_lab_events(icustays, random_state):
+    events = _generate_events(icustays, _LAB_ITEMS, _LAB_EVENTS_PER_DAY, random_state)
+    values = events.value.clip(lower=0)
+    # Some results are recorded without a numeric value
+    has_no_number = random_state.rand(len(events)) < 0.02
+    return pd.DataFrame({
+        'subject_id': events.subject_id,
+        'hadm_id': events.hadm_id,
+        'icustay_id': events.icustay_id,
+        'itemid': events.itemid,
+        'charttime': events.charttime,
+        'value': values.astype(str),
+        'valuenum': values.mask(has_no_number),
+        'flag': None,
+        'valueuom': events.valueuom
+    })
+
+
+def _generate_chart_events(icustays, random_state):
+    events = _generate_events(icustays, _CHART_ITEMS, _CHART_EVENTS_PER_DAY, random_state)
+    return pd.DataFrame({
+        'subject_id': events.subject_id,
+        'icustay_id': events.icustay_id,
+        'itemid': events.itemid,
+        'charttime': events.charttime,
+        'elemid': 1,
+        'realtime': events.charttime,
+        'cgid': 1,
+        'cuid': 1,
+        'value1': events.value.astype(str),
+        'value1num': events.value,
+        'value1uom': events.valueuom,
+        'value2': None,
+        'value2num': None,
+        'value2uom': None,
+        'resultstatus': None,
+        'stopped': None
+    })
+
+
+def _to_sql_text_dates(df):
+    """Formats datetime columns as text the same way SQLite's default adapter does. The obfuscated dates are outside
+    of the pandas datetime range, so they are formatted directly from the datetime objects."""
+    df = df.copy()
+    for column in DATE_COLUMNS:
+        if column in df.columns:
+            df[column] = [_format_date(value) for value in df[column]]
+    return df
+
+
+def _format_date(value):
+    if value is None or isinstance(value, str):
+        return value
+    if pd.isnull(value):
+        return None
+    return value.isoformat(sep=' ')
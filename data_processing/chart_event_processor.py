@@ -1,6 +1,8 @@
-from data_loading.data_loaders import get_chart_events
-from data_processing.datetime_modifier import get_modify_dates_fn
-from data_processing.event_processor import resample_flatten_and_add_diff_values_to_events
+from data_loading.data_loaders import get_chart_events, iter_chart_events
+from data_processing.data_schema import apply_schema
+from data_processing.datetime_modifier import get_modify_dates_fn, iter_modified_dates
+from data_processing.event_processor import resample_flatten_and_add_diff_values_to_events, reduce_event_chunks, \
+    select_event_fields
 from data_processing.processed_data_interface import cache_results
 
 _REGULAR_CHART_ITEM_FIELDS = [
@@ -16,14 +18,21 @@ _REGULAR_CHART_ITEM_FIELDS = [
 
 ALL_CHART_ITEM_FIELDS = _REGULAR_CHART_ITEM_FIELDS + [field + "_diff" for field in _REGULAR_CHART_ITEM_FIELDS]
 
-@cache_results("processed_chart_events.csv", description='chart events')
-def get_processed_chart_events(use_cache=True):
+PROCESSED_CHART_EVENTS_FILE = "processed_chart_events"
+
+@cache_results(PROCESSED_CHART_EVENTS_FILE, description='chart events', version=2,
+               ignored_parameters=["chunk_size", "reduce_in_database"])
+def get_processed_chart_events(use_cache=True, chunk_size=None, reduce_in_database=False):
     """Returns a dataframe where each row a unique combination of date and icustay_id and has a column for each chart
     item and chart item diff for each different chart item that is used in the analysis. The icustay_id and date columns
     are used to join the records with other post processed data.
 
     Args:
-        use_cache: Whether to load the results from a previous calculation.
+        use_cache: Whether to load the results from a previous calculation if they are not stale.
+        chunk_size: When set, the chart events are streamed from the database in chunks of this many rows and reduced
+        as they arrive instead of being loaded all at once.
+        reduce_in_database: Whether the database reduces the chart events to the first event per icustay, item and
+        day so that only those events are transferred. The results are the same.
 
     Returns:
         A dataframe with the following columns:
@@ -48,13 +57,38 @@ def get_processed_chart_events(use_cache=True):
         temperature_c_(calc):
         temperature_c_(calc)_diff:
     """
-    modify_dates_fn = get_modify_dates_fn()
-    chart_events = get_chart_events()
+    if chunk_size is None:
+        return process_chart_events(get_chart_events(first_per_day=reduce_in_database))
+
+    chart_event_chunks = (_select_chart_event_columns(chunk)
+                          for chunk in iter_chart_events(chunk_size, first_per_day=reduce_in_database))
+    chart_events = reduce_event_chunks(iter_modified_dates(chart_event_chunks, ['charttime']))
+    return resample_chart_events(chart_events)
+
+
+def process_chart_events(chart_events):
+    """Transforms chart events, as returned by data_loading.data_loaders.get_chart_events, into the dataframe returned
+    by get_processed_chart_events. Icustays are processed independently, so the chart events for a subset of icustays
+    produce the rows for that subset.
+    """
+    return resample_chart_events(prepare_chart_events(chart_events))
 
-    chart_events.rename(columns={"value1num": "value"}, inplace=True)
-    chart_events = chart_events[['subject_id', 'icustay_id', 'charttime', 'itemid', 'label', 'value']]
 
-    chart_events = modify_dates_fn(chart_events, ['charttime'])
+def prepare_chart_events(chart_events):
+    """Selects the columns of the chart events, as returned by data_loading.data_loaders.get_chart_events, that are
+    processed and modifies their charttime by the subject's date offset."""
+    return get_modify_dates_fn()(_select_chart_event_columns(chart_events), ['charttime'])
+
+
+def resample_chart_events(chart_events):
+    """Resamples chart events prepared by prepare_chart_events into the dataframe returned by
+    get_processed_chart_events."""
     # Modify shape of dataframe so that each chart item has its own column.
-    fields_to_keep = ['icustay_id', 'date'] + ALL_CHART_ITEM_FIELDS
-    return resample_flatten_and_add_diff_values_to_events(chart_events)[fields_to_keep]
+    return apply_schema(
+        select_event_fields(resample_flatten_and_add_diff_values_to_events(chart_events), _REGULAR_CHART_ITEM_FIELDS))
+
+
+def _select_chart_event_columns(chart_events):
+    chart_events = chart_events.rename(columns={"value1num": "value"})
+    return chart_events[['subject_id', 'icustay_id', 'charttime', 'itemid', 'label', 'value']]
+
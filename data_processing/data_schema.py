@@ -0,0 +1,97 @@
+import pandas as pd
+
+# The dtypes of the columns of the processed data and the machine learning dataset. Every processor applies the schema
+# to its results so the cached data, the merged dataset and the data the models are trained on use the same compact
+# dtypes.
+ID_COLUMNS = ["icustay_id", "subject_id"]
+ID_DTYPE = "int32"
+
+CATEGORICAL_COLUMNS = [
+    "treatment",
+    "sex",
+    "marital_status_descr",
+    "ethnicity_descr",
+    "overall_payor_group_descr",
+    "religion_descr"
+]
+
+# Pandas has no datetime dtype narrower than 8 bytes, dates are kept at day resolution in the widest supported unit so
+# that they join with the dates of the other processed data.
+DATE_COLUMNS = ["date"]
+DATE_DTYPE = "datetime64[ns]"
+
+BOOLEAN_COLUMNS = ["died"]
+
+# Every other floating point column holds a measurement, a measurement diff or the age of the patient
+MEASUREMENT_DTYPE = "float32"
+
+
+def apply_schema(df):
+    """Casts the columns of a processed dataframe to the dtypes of the schema. Columns that are not part of the
+    schema are left unchanged.
+
+    Args:
+        df: A dataframe with any of the columns of the machine learning dataset.
+
+    Returns:
+        The dataframe with the columns cast to the schema dtypes. Columns that already have the schema dtype are not
+        copied.
+    """
+    dtypes = {}
+    for (column, dtype) in df.dtypes.items():
+        if column in ID_COLUMNS:
+            dtypes[column] = ID_DTYPE
+        elif column in CATEGORICAL_COLUMNS:
+            dtypes[column] = "category"
+        elif column in DATE_COLUMNS:
+            dtypes[column] = DATE_DTYPE
+        elif column in BOOLEAN_COLUMNS:
+            dtypes[column] = "bool"
+        elif pd.api.types.is_float_dtype(dtype):
+            dtypes[column] = MEASUREMENT_DTYPE
+    changed_dtypes = {column: dtype for (column, dtype) in dtypes.items() if df[column].dtype != dtype}
+    if not changed_dtypes:
+        return df
+    return df.astype(changed_dtypes)
+
+
+def widen_dtypes(df):
+    """Casts the columns of a dataframe to the dtypes that were used before the schema, 64 bit numbers and python
+    string objects. Used to report how much memory the schema saves."""
+    dtypes = {}
+    for (column, dtype) in df.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            dtypes[column] = object
+        elif pd.api.types.is_float_dtype(dtype):
+            dtypes[column] = "float64"
+        elif pd.api.types.is_integer_dtype(dtype):
+            dtypes[column] = "int64"
+    return df.astype(dtypes)
+
+
+def get_memory_report(df):
+    """Compares the memory used by each column of a dataframe with the schema dtypes and with the dtypes that were used
+    before the schema.
+
+    Args:
+        df: A dataframe with any of the columns of the machine learning dataset.
+
+    Returns:
+        A DataFrame indexed by column, with a last row named total, with the following columns:
+        dtype_before: The dtype before the schema.
+        bytes_before: The bytes used by the column before the schema.
+        dtype: The schema dtype.
+        bytes: The bytes used by the column with the schema dtype.
+        saved: The fraction of the bytes that the schema saves.
+    """
+    wide_df = widen_dtypes(df)
+    compact_df = apply_schema(df)
+    report = pd.DataFrame({
+        "dtype_before": wide_df.dtypes.astype(str),
+        "bytes_before": wide_df.memory_usage(index=False, deep=True),
+        "dtype": compact_df.dtypes.astype(str),
+        "bytes": compact_df.memory_usage(index=False, deep=True)
+    })
+    report.loc["total"] = ["", report.bytes_before.sum(), "", report.bytes.sum()]
+    report["saved"] = 1 - report.bytes / report.bytes_before.where(report.bytes_before > 0)
+    return report
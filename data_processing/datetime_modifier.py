@@ -1,11 +1,16 @@
 import functools
 
+import numpy as np
 import pandas as pd
 
 from data_loading.data_loaders import get_patients
 
 __TARGET_YEAR = 2000
 
+# The range of dates that datetime64[ns] can represent, in microseconds
+__MIN_DATE = np.datetime64(-(-pd.Timestamp.min.value // 1000), "us")
+__MAX_DATE = np.datetime64(pd.Timestamp.max.value // 1000, "us")
+
 
 @functools.lru_cache()
 def get_modify_dates_fn():
@@ -27,19 +32,74 @@ def get_modify_dates_fn():
         Returns:
             The data frame augmented by modifying the date columns by the subjects date offset and then
             converting the columns to timestamp.
+
+        Raises:
+            ValueError: If a subject has no date offset, such as a subject added after the offsets were computed.
         """
         year_offsets_per_row = df.subject_id.map(offset_by_subject_id)
+        if year_offsets_per_row.isnull().any():
+            missing_subject_ids = sorted(df.subject_id[year_offsets_per_row.isnull()].unique())
+            raise ValueError("No date offset for subject_ids %s, the offsets are recomputed after "
+                             "get_modify_dates_fn.cache_clear()" % ", ".join(str(i) for i in missing_subject_ids))
+        year_offsets_per_row = year_offsets_per_row.values.astype("int64")
         for column in date_columns:
-            modified_dates = []
-            for (date, year_offset) in zip(df[column], year_offsets_per_row):
-                new_year = date.year - year_offset
-                modified_dates.append(date.replace(year=new_year))
-            df[column] = pd.to_datetime(modified_dates)
+            df[column] = pd.to_datetime(__shift_years(df[column].values, year_offsets_per_row))
         return df
 
     return fn
 
 
+def iter_modified_dates(df_chunks, date_columns):
+    """Transforms the date columns of each data frame in a stream by the subject's date offset as the data frames arrive,
+    so the stream does not need to be held in memory.
+
+    Args:
+        df_chunks: An iterable of data frames with a subject_id column.
+        date_columns: Date columns that will be augmented by the subject's date offset.
+
+    Returns:
+        A generator of the transformed data frames.
+    """
+    modify_dates_fn = get_modify_dates_fn()
+    for df in df_chunks:
+        yield modify_dates_fn(df, date_columns)
+
+
+def __shift_years(dates, year_offsets):
+    """Subtracts a number of years from each date, keeping the month, day and time of day, the same as
+    date.replace(year=date.year - year_offset) does for each date. The dates are shifted with datetime64 arithmetic on
+    the whole array, so dates outside of the pandas datetime range are supported.
+
+    Args:
+        dates: An array of datetime objects or datetime64 values.
+        year_offsets: An integer array with the number of years to subtract from each date.
+
+    Returns:
+        A datetime64[ns] array with the shifted dates.
+
+    Raises:
+        ValueError: If a shifted date does not exist, such as February 29th shifted into a year that is not a leap year.
+        OutOfBoundsDatetime: If a shifted date is outside of the pandas datetime range.
+    """
+    dates = np.asarray(dates, dtype="datetime64[us]")
+    months = dates.astype("datetime64[M]")
+    days = dates.astype("datetime64[D]")
+    day_of_month = days - months.astype("datetime64[D]")
+    time_of_day = dates - days.astype("datetime64[us]")
+
+    shifted_months = months - (year_offsets * 12).astype("timedelta64[M]")
+    days_in_shifted_month = (shifted_months + np.timedelta64(1, "M")).astype("datetime64[D]") - \
+        shifted_months.astype("datetime64[D]")
+    if np.any(day_of_month >= days_in_shifted_month):
+        raise ValueError("day is out of range for month")
+
+    shifted_dates = (shifted_months.astype("datetime64[D]") + day_of_month).astype("datetime64[us]") + time_of_day
+    is_out_of_bounds = (shifted_dates < __MIN_DATE) | (shifted_dates > __MAX_DATE)
+    if np.any(is_out_of_bounds):
+        raise pd.errors.OutOfBoundsDatetime("Out of bounds shifted date: %s" % shifted_dates[is_out_of_bounds][0])
+    return shifted_dates.astype("datetime64[ns]")
+
+
 def __get_offset_by_subject_id():
     """Computes a year offset map that can be used to modify all dates related to a specific subject.
     Dates need to be modified because dates in MIMIC2 are obfuscated for anonymity, but the date ranges
@@ -1,32 +1,82 @@
+import numpy as np
 import pandas as pd
-from pandas.tseries.offsets import Day
 
 from data_loading.data_loaders import get_patients
+from data_processing.datetime_modifier import get_modify_dates_fn
 
+# The time frames, in days, that the died outcome is labeled for in the machine learning dataset
+DEATH_HORIZONS = [1, 3, 7, 30]
 
-def get_death_outcome(data, death_time_frame):
-    """Creates a data frame that contains whether the patient died within a time frame.
+
+def get_death_outcome_column(death_time_frame):
+    """Returns the name of the column labeling whether the patient died within the time frame, in days."""
+    return "died_within_%dd" % death_time_frame
+
+
+def get_death_outcomes(data, horizons=DEATH_HORIZONS):
+    """Labels whether the patient died within each of the time frames from the date of each row. The dates of death
+    are shifted by the same offset as the other dates of the subject, and the labels for all time frames are computed
+    from one array of the time between the date and the date of death.
 
     Args:
         data: A dataframe containing the following columns:
         subject_id: The ID of the subject.
         date: The date to compare against the date of death.
 
-        death_time_frame: The number of days that a patient must be alive after for the died outcome to be false.
+        horizons: The numbers of days that a patient must be alive after for the outcome to be false.
 
     Returns:
-        A dataframe with the following columns:
-        subject_id: The ID of the subject.
-        date: The date to compare against the date of death.
-        died: Whether the patient died within the time frame from the date.
+        A dataframe with the same number of rows as data, in the same order, with a column named by
+        get_death_outcome_column for each time frame, in the order of horizons. A label is true when the patient died
+        at most that many days after the date, or before it.
+    """
+    dod = _get_dates_of_death(data.subject_id.values)
+    # NaT for patients without a date of death, which compares false with every time frame
+    time_until_death = dod - data.date.values.astype("datetime64[ns]")
+    return pd.DataFrame({get_death_outcome_column(horizon): time_until_death <= np.timedelta64(horizon, "D")
+                         for horizon in horizons})
+
+
+def add_death_outcomes(data, death_time_frame, horizons=DEATH_HORIZONS):
+    """Adds the death outcome columns for the time frames to the dataframe, and a died column with the outcome for
+    death_time_frame, which is the outcome the models are trained on. Use select_death_outcome to train on another of
+    the time frames without recomputing the outcomes.
+
+    Args:
+        data: A dataframe with subject_id and date columns, see get_death_outcomes.
+        death_time_frame: The number of days after a date that a patient must be alive for the died outcome to be
+        false.
+        horizons: The other time frames to add death outcome columns for.
+
+    Returns:
+        The dataframe with the death outcome columns added.
     """
-    patients = get_patients()
-    dod_by_subject_id = {p.subject_id: p.dod for p in patients.itertuples()}
-    days_unit = Day(death_time_frame)
-    dod = data.subject_id.map(dod_by_subject_id)
-    end_of_type_frame = data.date.map(lambda d: d + days_unit)
-    date_out_of_range = end_of_type_frame.max() + days_unit
-    died_within_time = end_of_type_frame >= dod.fillna(date_out_of_range).astype(end_of_type_frame.dtype)
-    outcome_df = pd.concat([data.subject_id, data.date, died_within_time], axis=1)
-    outcome_df.columns = ['subject_id', 'date', 'died']
-    return outcome_df
+    all_horizons = sorted(set(horizons) | {death_time_frame})
+    outcomes = get_death_outcomes(data, horizons=all_horizons)
+    for column in outcomes.columns:
+        data[column] = outcomes[column].values
+    data["died"] = data[get_death_outcome_column(death_time_frame)]
+    return data
+
+
+def select_death_outcome(data, death_time_frame):
+    """Returns a copy of the dataframe with the died column set to the stored outcome for another time frame.
+
+    Raises:
+        ValueError: If the dataframe has no death outcome column for the time frame.
+    """
+    column = get_death_outcome_column(death_time_frame)
+    if column not in data.columns:
+        raise ValueError("The data has no death outcome for %d days, it has %s" %
+                         (death_time_frame, ", ".join(c for c in data.columns if c.startswith("died_within_"))))
+    return data.assign(died=data[column].values)
+
+
+def _get_dates_of_death(subject_ids):
+    """Returns the shifted date of death of each subject, or NaT if the subject is not known to have died."""
+    patients = get_patients()[["subject_id", "dod"]].drop_duplicates("subject_id")
+    patients = get_modify_dates_fn()(patients, ["dod"])
+    positions = pd.Index(patients.subject_id.values).get_indexer(subject_ids)
+    dod = patients.dod.values.astype("datetime64[ns]")[positions]
+    dod[positions < 0] = np.datetime64("NaT")
+    return dod
@@ -1,5 +1,5 @@
+import numpy as np
 import pandas as pd
-from pandas.tseries.offsets import Day
 
 
 def resample_flatten_and_add_diff_values_to_events(event_records):
@@ -33,6 +33,74 @@ def resample_flatten_and_add_diff_values_to_events(event_records):
     return _add_event_value_diffs_to_flattened_events(flattened_event_records)
 
 
+def select_event_fields(event_records, fields):
+    """Selects the icustay_id, date, value and value diff columns for the fields from the output of
+    resample_flatten_and_add_diff_values_to_events. Fields that have no events are added with missing values and diffs
+    of 0, the same values they get when only other icustays have events for the field. This makes the output for a
+    subset of icustays the same as the rows for those icustays when all icustays are processed together.
+
+    Args:
+        event_records: A dataframe returned by resample_flatten_and_add_diff_values_to_events.
+        fields: The event labels to keep.
+
+    Returns:
+        A dataframe with the following columns:
+        icustay_id: The icustay the event was recorded for.
+        date: The day the event was recorded.
+        field1: The value for field 1.
+        ...
+        fieldn: The value for field n.
+        field1_diff: The value difference for field 1 from the previous day to the current day.
+        ...
+        fieldn_diff: The value difference for field n from the previous day to the current day.
+    """
+    diff_fields = [field + "_diff" for field in fields]
+    selected_events = event_records.reindex(columns=["icustay_id", "date"] + fields + diff_fields)
+    selected_events[diff_fields] = selected_events[diff_fields].fillna(0)
+    return selected_events
+
+
+def reduce_event_chunks(event_chunks):
+    """Reduces a stream of event chunks to the events that determine the daily values. Each chunk is reduced as it
+    arrives so that only a bounded number of rows per icustay, label and day is held in memory. The reduced events can
+    be passed to resample_flatten_and_add_diff_values_to_events and produce the same result as the unreduced events.
+
+    Args:
+        event_chunks: An iterable of dataframes with the same columns as resample_flatten_and_add_diff_values_to_events
+        expects.
+
+    Returns:
+        A dataframe with the same columns as the chunks.
+    """
+    reduced_chunks = [keep_first_event_per_day(chunk) for chunk in event_chunks]
+    if not reduced_chunks:
+        return pd.DataFrame(columns=["icustay_id", "label", "value", "charttime"])
+    return keep_first_event_per_day(pd.concat(reduced_chunks, ignore_index=True))
+
+
+def keep_first_event_per_day(event_records):
+    """Keeps one event per icustay_id, label and day. The event kept is the earliest event with a value, or the earliest
+    event if none of the events for the day have a value. These are the only events the daily resampling looks at, so
+    dropping the rest does not change the resampled output.
+
+    Args:
+        A dataframe containing the following columns:
+        icustay_id: The icustay the event was recorded for.
+        label: The type of the event.
+        value: The value for the event.
+        charttime: When the event was recorded.
+
+    Returns:
+        A dataframe with the same columns as the input.
+    """
+    ordered_events = event_records.assign(
+        _day=event_records.charttime.dt.floor("D"),
+        _is_missing=event_records.value.isnull()
+    ).sort_values(["_is_missing", "charttime"], kind="mergesort")
+    first_events = ordered_events.drop_duplicates(["icustay_id", "label", "_day"])
+    return first_events.drop(["_day", "_is_missing"], axis=1)
+
+
 def _resample_and_fill_event_items_grouped_by_icustay(event_records):
     """Resamples and forward fills events grouped by label and icustay_id. The purpose of this transformation is to
     create a normalized view into how the patients event values change day by day.
@@ -67,20 +135,77 @@ def _resample_and_fill_event_items_grouped_by_icustay(event_records):
         label: The type of the event.
         value: The value for the event.
         date: The day the event was recorded.
-    """
-    target_events = event_records.set_index(event_records.charttime)
-
-    target_event_fields = target_events[["icustay_id", "label", "value", "charttime"]]
-
-    events_grouped_by_hadm_and_label = target_event_fields.groupby(["icustay_id", "label"])
 
-    events_grouped_by_hadm_and_label_filled = events_grouped_by_hadm_and_label.resample("D").first().ffill()
-
-    # Save charttime to another column so that it is not lost when dropping the indexes
-    events_grouped_by_hadm_and_label_filled.charttime = \
-        events_grouped_by_hadm_and_label_filled.index.get_level_values("charttime")
-    # Drop grouping
-    return events_grouped_by_hadm_and_label_filled.reset_index(drop=True)
+    Note:
+        The events are processed with a sort based kernel instead of a resampler per group. Events are sorted by an
+        integer code for the icustay_id and label, and by charttime. The first event with a value is taken for each
+        day, and values are forward filled across the days of a group without crossing into the next group. Labels are
+        normalized to lower case with underscores, which _flatten_events uses as column names.
+    """
+    output_columns = ["icustay_id", "label", "value", "charttime"]
+    (label_codes, labels) = pd.factorize(event_records.label.values, sort=True)
+    has_keys = (label_codes >= 0) & event_records.icustay_id.notnull().values & event_records.charttime.notnull().values
+    if not has_keys.any():
+        return pd.DataFrame(columns=output_columns)
+
+    (icustay_id_codes, icustay_ids) = pd.factorize(event_records.icustay_id.values[has_keys], sort=True)
+    group_codes = icustay_id_codes.astype(np.int64) * len(labels) + label_codes[has_keys]
+    charttimes = event_records.charttime.values[has_keys].astype("datetime64[ns]")
+    values = event_records.value.values[has_keys]
+
+    order = _argsort_by_group_and_time(group_codes, len(icustay_ids) * len(labels), charttimes)
+    group_codes = group_codes[order]
+    values = values[order]
+    days = charttimes[order].astype("datetime64[D]").astype(np.int64)
+
+    # Each group covers the days from its first event to its last event
+    is_new_group = np.r_[True, group_codes[1:] != group_codes[:-1]]
+    group_starts = np.flatnonzero(is_new_group)
+    group_ends = np.r_[group_starts[1:], len(group_codes)] - 1
+    first_days = days[group_starts]
+    day_counts = days[group_ends] - first_days + 1
+    group_offsets = np.cumsum(day_counts) - day_counts
+    row_count = int(day_counts.sum())
+
+    # The first event with a value for a day is the first in sorted order
+    event_groups = np.cumsum(is_new_group) - 1
+    event_positions = group_offsets[event_groups] + days - first_days[event_groups]
+    has_value = pd.notnull(values)
+    (event_positions, values) = (event_positions[has_value], values[has_value])
+    is_first_value = np.diff(event_positions, prepend=-1) != 0
+    daily_values = np.full(row_count, np.nan, dtype=values.dtype if values.dtype.kind == "f" else np.float64)
+    daily_values[event_positions[is_first_value]] = values[is_first_value]
+
+    # Forward fill within each group. Missing values at the start of a group point to themselves, so they stay missing.
+    is_group_start = np.zeros(row_count, dtype=bool)
+    is_group_start[group_offsets] = True
+    fill_positions = np.where(is_group_start | ~np.isnan(daily_values), np.arange(row_count), 0)
+    daily_values = daily_values[np.maximum.accumulate(fill_positions)]
+
+    output_groups = np.repeat(np.arange(len(group_starts)), day_counts)
+    output_group_codes = group_codes[group_starts][output_groups]
+    output_days = first_days[output_groups] + np.arange(row_count) - group_offsets[output_groups]
+    normalized_labels = np.asarray(pd.Index(np.asarray(labels, dtype=object)).str.replace(" ", "_").str.lower())
+    return pd.DataFrame({
+        "icustay_id": icustay_ids[output_group_codes // len(labels)],
+        "label": normalized_labels[output_group_codes % len(labels)],
+        "value": daily_values,
+        "charttime": output_days.astype("datetime64[D]").astype("datetime64[ns]")
+    }, columns=output_columns)
+
+
+def _argsort_by_group_and_time(group_codes, group_count, charttimes):
+    """Returns the indices that sort the events by group and charttime. The sort is stable, so events with the same
+    charttime keep their order. When the charttimes are whole seconds, which they are for MIMIC2, the group and
+    charttime are combined into a single integer key, which sorts about twice as fast as sorting by both."""
+    nanoseconds = charttimes.astype(np.int64)
+    if np.all(nanoseconds % 10 ** 9 == 0):
+        seconds = nanoseconds // 10 ** 9
+        seconds -= seconds.min()
+        seconds_span = int(seconds.max()) + 1
+        if group_count * seconds_span < 2 ** 62:
+            return np.argsort(group_codes * seconds_span + seconds, kind="stable")
+    return np.lexsort((charttimes, group_codes))
 
 
 def _flatten_events(event_records):
@@ -104,8 +229,6 @@ def _flatten_events(event_records):
         labeln: The value for event with label n.
 
     """
-    event_records.label = event_records.label.str.replace(" ", "_").str.lower()
-
     # Reshape DF so that each row is unique for a icustay_id and day and each label type is a column
     pivot = pd.pivot_table(event_records, values="value", columns=["label"], index=["icustay_id", "charttime"])
 
@@ -132,6 +255,8 @@ def _add_event_value_diffs_to_flattened_events(flattened_events):
     Note:
         The first diffs for each event type for the first day in an icustay will be 0 since there is no previous value
         to compare it to.
+        The diff columns are added to flattened_events in place and the diffs are computed for all event types at once,
+        without copying or merging the dataframe.
 
     Args:
         A dataframe with the following columns
@@ -154,23 +279,21 @@ def _add_event_value_diffs_to_flattened_events(flattened_events):
 
     columns_to_get_diffs = [column for column in flattened_events.columns if column not in ["icustay_id", "date"]]
 
-    previous_day_even_results = flattened_events.copy()
-    previous_day_even_results.date = previous_day_even_results.date - Day(1)
-
-    merged_results = pd.merge(
-        flattened_events,
-        previous_day_even_results,
-        on=["icustay_id", "date"],
-        how="left",
-        suffixes=('', '_previous'))
-
-    for column in columns_to_get_diffs:
-        current = merged_results[column]
-        previous = merged_results[column + "_previous"]
-        diff = current - previous
-        # If a diff is na, assume that the value didn't change since yesterday.
-        diff.fillna(0, inplace=True)
-        merged_results[column + "_diff"] = diff
-
-    columns_to_drop = [column + "_previous" for column in columns_to_get_diffs]
-    return merged_results.drop(columns_to_drop, axis=1)
+    # Work on the rows in icustay_id and date order. Rows are unique for an icustay_id and date, so the previous day of
+    # a row is the row before it when that row is for the same icustay and exactly one day earlier.
+    icustay_ids = flattened_events.icustay_id.values
+    dates = flattened_events.date.values.astype("datetime64[D]")
+    order = np.lexsort((dates, icustay_ids))
+    (icustay_ids, dates) = (icustay_ids[order], dates[order])
+    has_previous_day = (icustay_ids[1:] == icustay_ids[:-1]) & (dates[1:] - dates[:-1] == np.timedelta64(1, "D"))
+
+    values = flattened_events[columns_to_get_diffs].values[order]
+    diffs = np.zeros_like(values)
+    diffs[1:][has_previous_day] = values[1:][has_previous_day] - values[:-1][has_previous_day]
+    # If a diff is na, assume that the value didn't change since yesterday.
+    diffs[np.isnan(diffs)] = 0
+
+    unsorted_diffs = np.empty_like(diffs)
+    unsorted_diffs[order] = diffs
+    flattened_events[[column + "_diff" for column in columns_to_get_diffs]] = unsorted_diffs
+    return flattened_events
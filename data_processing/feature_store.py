@@ -0,0 +1,178 @@
+import logging
+
+import pandas as pd
+
+from data_processing.chart_event_processor import prepare_chart_events, resample_chart_events
+from data_processing.data_schema import apply_schema
+from data_processing.event_processor import keep_first_event_per_day
+from data_processing.lab_event_processor import prepare_lab_events, resample_lab_events
+from data_processing.lasix_poe_processor import process_lasix_poe
+from data_processing.ml_data_prepairer import join_processed_data
+
+# The lasix poe columns that the treatments are computed from, used when an icustay has no lasix orders
+_LASIX_POE_COLUMNS = ["subject_id", "icustay_id", "start_dt", "stop_dt", "dose_val_rx", "dose_unit_rx", "route"]
+
+
+class FeatureStore(object):
+    """Keeps the features of each icustay and day up to date as new lab events, chart events and lasix orders arrive,
+    without running the batch pipeline over the whole cohort.
+
+    The features of a day are the columns of data_processing.ml_data_prepairer.get_ml_data without the death outcomes,
+    which are not known yet. New data for an icustay only updates the rows of that icustay: the events are reduced to
+    the first event per label and day, which are the only events the daily values depend on, and the daily values,
+    forward filled values and diffs of the icustay are recomputed from them with the batch pipeline functions. The
+    rows are therefore the same as the rows the batch pipeline produces for the same data.
+
+    Example:
+        store = FeatureStore(get_processed_patient_info())
+        store.add_icustay_details(get_icustay_details([icustay_id]))
+        store.add_lab_events(new_lab_events)
+        store.get_features(icustay_id, date)
+    """
+
+    def __init__(self, patients):
+        """
+        Args:
+            patients: The processed patient info, as returned by
+            data_processing.patient_info_processor.get_processed_patient_info.
+        """
+        self._patients = patients
+        self._icustays = {}
+
+    def add_icustay_details(self, icu_details):
+        """Adds or replaces the details of icustays, as returned by data_loading.data_loaders.get_icustay_details. The
+        intime and outtime of an icustay determine the days that treatments are recorded for.
+
+        Returns:
+            The icustay IDs whose features were updated.
+        """
+        icustay_ids = self._store_by_icustay(icu_details, "icu_details")
+        self._update_treatments(icustay_ids)
+        return self._update_features(icustay_ids)
+
+    def add_lab_events(self, lab_events):
+        """Adds lab events, as returned by data_loading.data_loaders.get_lab_events, and updates the features of their
+        icustays.
+
+        Returns:
+            The icustay IDs whose features were updated.
+        """
+        return self._add_events(prepare_lab_events(lab_events.copy()), "lab_events", resample_lab_events)
+
+    def add_chart_events(self, chart_events):
+        """Adds chart events, as returned by data_loading.data_loaders.get_chart_events, and updates the features of
+        their icustays.
+
+        Returns:
+            The icustay IDs whose features were updated.
+        """
+        return self._add_events(prepare_chart_events(chart_events), "chart_events", resample_chart_events)
+
+    def add_lasix_orders(self, lasix_poe):
+        """Adds lasix orders, as returned by data_loading.data_loaders.get_lasix_poe, and updates the features of their
+        icustays.
+
+        Returns:
+            The icustay IDs whose features were updated.
+        """
+        icustay_ids = self._store_by_icustay(
+            pd.concat(self._get_stored(lasix_poe.icustay_id.unique(), "lasix_orders") + [lasix_poe], ignore_index=True),
+            "lasix_orders")
+        self._update_treatments(icustay_ids)
+        return self._update_features(icustay_ids)
+
+    def get_features(self, icustay_id, date):
+        """Returns the features of an icustay on a day.
+
+        Args:
+            icustay_id: The ID of the icustay.
+            date: The day, as a timestamp or a string.
+
+        Returns:
+            A Series indexed by feature name.
+
+        Raises:
+            KeyError: If the icustay has no features for the day.
+        """
+        features = self._icustays[icustay_id]["features"] if icustay_id in self._icustays else None
+        if features is None:
+            raise KeyError((icustay_id, date))
+        return features.loc[pd.Timestamp(date)]
+
+    def get_icustay_features(self, icustay_id):
+        """Returns a DataFrame with the features of each day of an icustay, sorted by date, or None if the icustay has
+        no features yet."""
+        features = self._icustays[icustay_id]["features"] if icustay_id in self._icustays else None
+        return None if features is None else features.reset_index(drop=True)
+
+    def to_data_frame(self):
+        """Returns the features of every icustay and day as one DataFrame, sorted by icustay_id and date."""
+        features = [self._icustays[icustay_id]["features"] for icustay_id in sorted(self._icustays)
+                    if self._icustays[icustay_id]["features"] is not None]
+        if not features:
+            return pd.DataFrame()
+        return apply_schema(pd.concat(features, ignore_index=True))
+
+    def _get_icustay(self, icustay_id):
+        if icustay_id not in self._icustays:
+            self._icustays[icustay_id] = {
+                "icu_details": None,
+                "lab_events": None,
+                "chart_events": None,
+                "lasix_orders": None,
+                "resampled_lab_events": None,
+                "resampled_chart_events": None,
+                "treatments": None,
+                "features": None
+            }
+        return self._icustays[icustay_id]
+
+    def _add_events(self, events, name, resample_events):
+        # The stored events of the icustays come before the new events, so ties are resolved in the order they arrived.
+        # All of the icustays are resampled together, their rows are independent of each other.
+        stored_events = self._get_stored(events.icustay_id.unique(), name)
+        reduced_events = keep_first_event_per_day(pd.concat(stored_events + [events], ignore_index=True))
+        icustay_ids = self._store_by_icustay(reduced_events, name)
+        self._store_by_icustay(resample_events(reduced_events), "resampled_" + name, icustay_ids)
+        return self._update_features(icustay_ids)
+
+    def _update_treatments(self, icustay_ids):
+        icustay_ids = [icustay_id for icustay_id in icustay_ids if self._icustays[icustay_id]["icu_details"] is not None]
+        if not icustay_ids:
+            return
+        lasix_orders = self._get_stored(icustay_ids, "lasix_orders") or [pd.DataFrame(columns=_LASIX_POE_COLUMNS)]
+        icu_details = self._get_stored(icustay_ids, "icu_details")
+        treatments = process_lasix_poe(pd.concat(lasix_orders, ignore_index=True),
+                                       pd.concat(icu_details, ignore_index=True))
+        self._store_by_icustay(treatments, "treatments", icustay_ids)
+
+    def _update_features(self, icustay_ids):
+        daily_data_names = ["resampled_lab_events", "resampled_chart_events", "treatments"]
+        icustay_ids = [icustay_id for icustay_id in icustay_ids
+                       if all(self._icustays[icustay_id][name] is not None for name in daily_data_names)]
+        if not icustay_ids:
+            return []
+        (lab_events, chart_events, treatments) = \
+            [pd.concat(self._get_stored(icustay_ids, name), ignore_index=True) for name in daily_data_names]
+        patients = self._patients[self._patients.icustay_id.isin(icustay_ids)]
+        features = join_processed_data(lab_events, chart_events, patients, treatments, log_row_counts=False)
+        self._store_by_icustay(features.set_index(features.date.values), "features", icustay_ids)
+        logging.debug("Updated %d days of %d icustays" % (len(features), len(icustay_ids)))
+        return icustay_ids
+
+    def _get_stored(self, icustay_ids, name):
+        return [self._icustays[icustay_id][name] for icustay_id in icustay_ids
+                if icustay_id in self._icustays and self._icustays[icustay_id][name] is not None]
+
+    def _store_by_icustay(self, df, name, icustay_ids=()):
+        """Stores the rows of each icustay in the dataframe. The icustays in icustay_ids without rows are stored without
+        any rows.
+
+        Returns:
+            The sorted icustay IDs that rows were stored for.
+        """
+        for icustay_id in icustay_ids:
+            self._get_icustay(icustay_id)[name] = df.iloc[0:0]
+        for (icustay_id, rows) in df.groupby("icustay_id", sort=False, observed=True):
+            self._get_icustay(icustay_id)[name] = rows
+        return sorted(set(df.icustay_id.unique()) | set(icustay_ids))
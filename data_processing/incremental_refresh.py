@@ -0,0 +1,154 @@
+import logging
+
+import pandas as pd
+
+from data_loading.data_loaders import get_watermarks, get_icustay_ids_changed_since, get_lab_events, \
+    get_chart_events, get_lasix_poe, get_icustay_details
+from data_loading.query_cache import clear_query_cache
+from data_processing.chart_event_processor import process_chart_events, PROCESSED_CHART_EVENTS_FILE
+from data_processing.data_schema import apply_schema
+from data_processing.datetime_modifier import get_modify_dates_fn
+from data_processing.death_outcome_processor import add_death_outcomes
+from data_processing.lab_event_processor import process_lab_events, PROCESSED_LAB_EVENTS_FILE
+from data_processing.lasix_poe_processor import process_lasix_poe, PROCESSED_LASIX_FILE
+from data_processing.ml_data_prepairer import get_ml_data, merge_processed_data, ML_DATA_FILE
+from data_processing.patient_info_processor import get_processed_patient_info, PROCESSED_PATIENT_INFO_FILE
+from data_processing.processed_data_interface import is_cached, load_cached_data, save_cached_data, \
+    load_cached_metadata, save_cached_metadata, load_cache_parameters, refresh_cache_fingerprint, get_cache_state, \
+    CACHE_VALID, CACHE_UNVERIFIED
+
+WATERMARKS_FILE = "watermarks.json"
+
+_SPLICED_FILES = [
+    PROCESSED_LAB_EVENTS_FILE,
+    PROCESSED_CHART_EVENTS_FILE,
+    PROCESSED_LASIX_FILE,
+    PROCESSED_PATIENT_INFO_FILE,
+    ML_DATA_FILE
+]
+
+# The caches that are extracted from the source tables
+_EXTRACTED_FILES = [
+    PROCESSED_LAB_EVENTS_FILE,
+    PROCESSED_CHART_EVENTS_FILE,
+    PROCESSED_LASIX_FILE,
+    PROCESSED_PATIENT_INFO_FILE
+]
+
+
+def build_ml_data_with_watermarks(reduce_events_in_database=False, use_cache=True, max_workers=None,
+                                  memory_budget=None):
+    """Builds the machine learning dataset, recomputing the stale caches, and records the watermarks of the source
+    tables it was built from, so that later refreshes only process the rows added since.
+
+    Args:
+        reduce_events_in_database: See data_processing.ml_data_prepairer.get_ml_data.
+        use_cache: Whether caches that are not stale are used. Otherwise the dataset is built from scratch.
+        max_workers: See data_processing.ml_data_prepairer.get_ml_data.
+        memory_budget: See data_processing.ml_data_prepairer.get_ml_data.
+
+    Returns:
+        The machine learning dataset.
+    """
+    # Taken before extracting so that rows added during the build are picked up by the next refresh
+    watermarks = get_watermarks()
+    reused_files = [file_name for file_name in _EXTRACTED_FILES
+                    if use_cache and get_cache_state(file_name)[0] in (CACHE_VALID, CACHE_UNVERIFIED)]
+    ml_data = get_ml_data(use_cache=use_cache, reduce_events_in_database=reduce_events_in_database,
+                          max_workers=max_workers, memory_budget=memory_budget)
+    # Reused caches were extracted before the new watermarks, so the previous watermarks still apply to them. Out of
+    # core builds do not update the processed caches that refreshes splice rows into.
+    if not reused_files and memory_budget is None:
+        save_cached_metadata(watermarks, WATERMARKS_FILE)
+    return ml_data
+
+
+def refresh_ml_data(reduce_events_in_database=False):
+    """Brings the cached processed data and machine learning dataset up to date with the source tables. Only the
+    icustays with rows newer than the recorded watermarks, or whose patient info changed, are extracted and processed.
+    Their rows replace the previous rows for those icustays in the cached processed data and the machine learning
+    dataset. The death outcomes are recomputed for all rows since dates of death are updated for existing patients.
+    The refreshed caches are fingerprinted with the modified data source, so they remain valid.
+
+    When no watermarks have been recorded the dataset is built from scratch.
+
+    Args:
+        reduce_events_in_database: See data_processing.ml_data_prepairer.get_ml_data.
+
+    Returns:
+        A sorted list of the icustay IDs that were refreshed.
+
+    Raises:
+        ValueError: If the dataset was cached without a fingerprint, which records the death time frame it was built
+        with.
+    """
+    watermarks = load_cached_metadata(WATERMARKS_FILE)
+    if watermarks is None or not all(is_cached(file_name) for file_name in _SPLICED_FILES):
+        logging.info("No watermarks recorded for the processed data, building it from scratch")
+        ml_data = build_ml_data_with_watermarks(reduce_events_in_database=reduce_events_in_database, use_cache=False)
+        return sorted(ml_data.icustay_id.unique())
+
+    # The refreshed rows are labelled with the same death time frame as the rest of the dataset
+    ml_data_parameters = load_cache_parameters(ML_DATA_FILE)
+    if ml_data_parameters is None:
+        raise ValueError("The machine learning dataset was cached without the death time frame it was built with, "
+                         "it must be rebuilt before it is refreshed")
+    death_time_frame = ml_data_parameters["death_time_frame"]
+
+    # Cached query results and date offsets predate the new rows
+    clear_query_cache()
+    get_modify_dates_fn.cache_clear()
+
+    new_watermarks = get_watermarks()
+    icustay_ids = set(get_icustay_ids_changed_since(watermarks))
+    logging.info("%d icustays have rows newer than the watermarks" % len(icustay_ids))
+
+    # Patient info is computed per admission from small tables, so it is recomputed in full
+    previous_patients = load_cached_data(PROCESSED_PATIENT_INFO_FILE)
+    patients = get_processed_patient_info(use_cache=False)
+    icustay_ids.update(_get_changed_icustay_ids(previous_patients, patients))
+
+    icustay_ids = sorted(icustay_ids)
+    if not icustay_ids:
+        # The caches are up to date with the data source, even if it was modified
+        for file_name in _SPLICED_FILES:
+            refresh_cache_fingerprint(file_name)
+        save_cached_metadata(new_watermarks, WATERMARKS_FILE)
+        logging.info("Processed data is up to date")
+        return icustay_ids
+
+    logging.info("Refreshing %d icustays" % len(icustay_ids))
+    lab_events = process_lab_events(get_lab_events(first_per_day=reduce_events_in_database, icustay_ids=icustay_ids))
+    chart_events = process_chart_events(
+        get_chart_events(first_per_day=reduce_events_in_database, icustay_ids=icustay_ids))
+    lasix = process_lasix_poe(get_lasix_poe(icustay_ids), get_icustay_details(icustay_ids))
+    for (file_name, rows) in [(PROCESSED_LAB_EVENTS_FILE, lab_events),
+                              (PROCESSED_CHART_EVENTS_FILE, chart_events),
+                              (PROCESSED_LASIX_FILE, lasix)]:
+        save_cached_data(_splice_rows(load_cached_data(file_name), rows, icustay_ids), file_name,
+                         refresh_fingerprint=True)
+
+    refreshed_patients = patients[patients.icustay_id.isin(icustay_ids)]
+    new_ml_data = merge_processed_data(lab_events, chart_events, refreshed_patients, lasix,
+                                       death_time_frame=death_time_frame)
+    ml_data = _splice_rows(load_cached_data(ML_DATA_FILE), new_ml_data, icustay_ids)
+    ml_data = add_death_outcomes(ml_data, death_time_frame)
+    # Refreshed last, so that it records the refreshed fingerprints of the caches it depends on
+    save_cached_data(ml_data, ML_DATA_FILE, refresh_fingerprint=True)
+
+    save_cached_metadata(new_watermarks, WATERMARKS_FILE)
+    return icustay_ids
+
+
+def _get_changed_icustay_ids(previous_rows, rows):
+    # Rows that are only in one of the dataframes were added, removed or changed
+    changed_rows = pd.concat([previous_rows, rows], ignore_index=True).drop_duplicates(keep=False)
+    return set(changed_rows.icustay_id.astype(int))
+
+
+def _splice_rows(cached_rows, rows, icustay_ids):
+    """Replaces the cached rows for the icustays with the recomputed rows. Categorical columns with different
+    categories are concatenated as objects, so the schema is applied to the spliced rows again."""
+    kept_rows = cached_rows[~cached_rows.icustay_id.isin(icustay_ids)]
+    logging.info("Replacing %d cached rows with %d rows" % (len(cached_rows) - len(kept_rows), len(rows)))
+    return apply_schema(pd.concat([kept_rows, rows[kept_rows.columns]], ignore_index=True))
@@ -1,6 +1,7 @@
 from data_loading.data_loaders import get_lab_events
+from data_processing.data_schema import apply_schema
 from data_processing.datetime_modifier import get_modify_dates_fn
-from data_processing.event_processor import resample_flatten_and_add_diff_values_to_events
+from data_processing.event_processor import resample_flatten_and_add_diff_values_to_events, select_event_fields
 from data_processing.processed_data_interface import cache_results
 
 _REGULAR_LAB_ITEM_FIELDS = [
@@ -14,14 +15,18 @@ _REGULAR_LAB_ITEM_FIELDS = [
 
 ALL_LAB_ITEM_FIELDS = _REGULAR_LAB_ITEM_FIELDS + [field + "_diff" for field in _REGULAR_LAB_ITEM_FIELDS]
 
-@cache_results("processed_lab_items.csv", description="lab events")
-def get_processed_lab_events(use_cache=True):
+PROCESSED_LAB_EVENTS_FILE = "processed_lab_items"
+
+@cache_results(PROCESSED_LAB_EVENTS_FILE, description="lab events", version=2, ignored_parameters=["reduce_in_database"])
+def get_processed_lab_events(use_cache=True, reduce_in_database=False):
     """Returns a dataframe where each row a unique combination of date and icustay_id and has a column for each lab
     item and lab item diff for each different lab item that is used in the analysis. The icustay_id and date columns
     are used to join the records with other post processed data.
 
     Args:
-        use_cache: Whether to load the results from a previous calculation.
+        use_cache: Whether to load the results from a previous calculation if they are not stale.
+        reduce_in_database: Whether the database reduces the lab events to the first event per icustay, item and day
+        so that only those events are transferred. The results are the same.
 
     Returns:
         A dataframe with the following columns:
@@ -38,12 +43,26 @@ def get_processed_lab_events(use_cache=True):
         urea_n:
         urea_n_diff:
     """
-    lab_events = get_lab_events()
-    modify_dates_fn = get_modify_dates_fn()
+    return process_lab_events(get_lab_events(first_per_day=reduce_in_database))
+
+
+def process_lab_events(lab_events):
+    """Transforms lab events, as returned by data_loading.data_loaders.get_lab_events, into the dataframe returned by
+    get_processed_lab_events. Icustays are processed independently, so the lab events for a subset of icustays produce
+    the rows for that subset.
+    """
+    return resample_lab_events(prepare_lab_events(lab_events))
+
 
+def prepare_lab_events(lab_events):
+    """Selects the numeric value of the lab events, as returned by data_loading.data_loaders.get_lab_events, and
+    modifies their charttime by the subject's date offset."""
     lab_events.drop('value', axis=1, inplace=True)
     lab_events.rename(columns={"valuenum": "value"}, inplace=True)
-    lab_events = modify_dates_fn(lab_events, ["charttime"])
-    fields_to_keep = ['icustay_id', 'date'] + ALL_LAB_ITEM_FIELDS
+    return get_modify_dates_fn()(lab_events, ["charttime"])
+
 
-    return resample_flatten_and_add_diff_values_to_events(lab_events)[fields_to_keep]
+def resample_lab_events(lab_events):
+    """Resamples lab events prepared by prepare_lab_events into the dataframe returned by get_processed_lab_events."""
+    return apply_schema(
+        select_event_fields(resample_flatten_and_add_diff_values_to_events(lab_events), _REGULAR_LAB_ITEM_FIELDS))
@@ -1,13 +1,18 @@
 import pandas as pd
+import numpy as np
 import logging
 
 from data_loading.data_loaders import get_lasix_poe, get_icustay_details
+from data_processing.data_schema import apply_schema
 from data_processing.datetime_modifier import get_modify_dates_fn
 from data_processing.processed_data_interface import cache_results
 
 
-@cache_results("lasix_poe.csv", description="lasix treatments")
-def get_processed_lasix(use_cache=False):
+PROCESSED_LASIX_FILE = "lasix_poe"
+
+
+@cache_results(PROCESSED_LASIX_FILE, description="lasix treatments", version=2)
+def get_processed_lasix(use_cache=True):
     """Processes the lasix poe data into a format that can be used for machine learning models.
 
     There are two major parts to the transformation:
@@ -23,7 +28,7 @@ def get_processed_lasix(use_cache=False):
         there are no treatments for them.
 
     Args:
-        use_cache: Skip computation and load results from previous computation.
+        use_cache: Whether to load the results from a previous calculation if they are not stale.
 
     Returns:
         A DataFrame with the following columns:
@@ -31,7 +36,29 @@ def get_processed_lasix(use_cache=False):
         treatment: The treatment category for the day
         icustay_id: The icustay ID
     """
-    lasix_poe = get_lasix_poe()
+    return process_lasix_poe(get_lasix_poe(), get_icustay_details())
+
+
+def process_lasix_poe(lasix_poe, icu_details):
+    """Transforms the lasix poe data and icustay details, as returned by data_loading.data_loaders.get_lasix_poe and
+    get_icustay_details, into the dataframe returned by get_processed_lasix. Icustays are processed independently, so
+    the data for a subset of icustays produces the rows for that subset.
+    """
+    modify_dates_fn = get_modify_dates_fn()
+    icu_details = modify_dates_fn(icu_details, ['icustay_intime', 'icustay_outtime'])
+    return apply_schema(expand_treatments_to_icustay_days(get_dated_treatments(lasix_poe), icu_details))
+
+
+def get_dated_treatments(lasix_poe):
+    """Returns the lasix orders that have a start and stop date with their treatment category and the dates modified by
+    the subject's date offset.
+
+    Args:
+        lasix_poe: The lasix poe data as returned by data_loading.data_loaders.get_lasix_poe.
+
+    Returns:
+        The lasix poe data with an additional treatment_category column.
+    """
     lasix_poe_w_dates = lasix_poe.dropna(subset=["start_dt", "stop_dt"])
 
     treatment_categories = \
@@ -45,45 +72,74 @@ def get_processed_lasix(use_cache=False):
     modify_dates_fn = get_modify_dates_fn()
     lasix_poe_w_dates = modify_dates_fn(lasix_poe_w_dates, ["start_dt", "stop_dt"])
 
-    icu_details = modify_dates_fn(get_icustay_details(), ['icustay_intime', 'icustay_outtime'])
-
-    treatment_df = pd.concat([lasix_poe_w_dates, treatment_categories], axis=1)
-    treatment_df_by_icu_id = treatment_df.groupby("icustay_id")
-
-    expanded_treatments = []
-    icu_id_w_no_treatments = []
-    for icu_row in icu_details.itertuples():
-        try:
-            treatments_for_icustay = treatment_df_by_icu_id.get_group(icu_row.icustay_id).sort_values(["start_dt"])
-        except:
-            icu_id_w_no_treatments.append(icu_row.icustay_id)
-            icu_stay_time_delta = icu_row.icustay_outtime - icu_row.icustay_intime
-            icu_stay_in_hours = (icu_stay_time_delta.days * 24) + icu_stay_time_delta.seconds * (60 * 60)
-
-            # Only count the ICU if they meet an hour threshold. The threshold is required so that they are given the
-            # oportunity to receive treatment. If we include records where they are denied treatment, then the
-            # recommended treatment will be no treatment despite that not being the case since they died.
-
-            if icu_stay_in_hours >= 12:
-                # Create empty df so that each day in icustay will have no treatment
-                treatments_for_icustay = pd.DataFrame()
-            else:
-                continue
-
-        for day in pd.date_range(icu_row.icustay_intime.date(), icu_row.icustay_outtime.date()):
-            selected_row = None
-            for current_row in treatments_for_icustay.itertuples():
-                if current_row.start_dt <= day <= current_row.stop_dt:
-                    selected_row = current_row
-
-            treatment_category = None if selected_row is None else selected_row.treatment_category
-            expanded_treatments.append({
-                "date": day,
-                "treatment": treatment_category,
-                "icustay_id": icu_row.icustay_id})
+    return pd.concat([lasix_poe_w_dates, treatment_categories], axis=1)
+
+
+def expand_treatments_to_icustay_days(treatment_df, icu_details):
+    """Expands the treatments across the days of each icustay. Each treatment covers the days from its start_dt to its
+    stop_dt. When treatments overlap on a day, the treatment that started latest is used. Icustays without any
+    treatments are kept with no treatment for each day if they lasted at least 12 hours.
+
+    The expansion is done with array operations. Each icustay is exploded into a calendar of days and each treatment
+    into the days it covers, the overlapping treatment days are resolved with a sort and dedupe and the treatment days
+    are left joined onto the calendar.
+
+    Args:
+        treatment_df: A dataframe returned by get_dated_treatments.
+        icu_details: The icustay details with icustay_intime and icustay_outtime modified by the subject's date offset.
+
+    Returns:
+        A DataFrame with the following columns:
+        date: The day of the treatment as a timestamp
+        treatment: The treatment category for the day
+        icustay_id: The icustay ID
+    """
+    has_treatments = icu_details.icustay_id.isin(treatment_df.icustay_id)
+    icu_id_w_no_treatments = icu_details.icustay_id[~has_treatments]
+
+    icu_stay_time_delta = icu_details.icustay_outtime - icu_details.icustay_intime
+    icu_stay_in_hours = (icu_stay_time_delta.dt.days * 24) + icu_stay_time_delta.dt.seconds * (60 * 60)
+
+    # Only count the ICU if they meet an hour threshold. The threshold is required so that they are given the
+    # oportunity to receive treatment. If we include records where they are denied treatment, then the
+    # recommended treatment will be no treatment despite that not being the case since they died.
+    target_icu_details = icu_details[has_treatments | (icu_stay_in_hours >= 12)]
+
+    calendar = _explode_days(
+        target_icu_details.icustay_id.values,
+        target_icu_details.icustay_intime.dt.normalize().values,
+        target_icu_details.icustay_outtime.dt.normalize().values)
+
+    # A treatment covers the days whose midnight is between its start and stop
+    treatment_days = _explode_days(
+        treatment_df.icustay_id.values.astype(calendar.icustay_id.dtype),
+        treatment_df.start_dt.dt.ceil("D").values,
+        treatment_df.stop_dt.dt.floor("D").values,
+        treatment=treatment_df.treatment_category.values,
+        start_dt=treatment_df.start_dt.values)
+
+    # Later starting treatments take precedence, ties are resolved by order
+    latest_treatment_days = treatment_days.sort_values(["start_dt"], kind="mergesort") \
+        .drop_duplicates(["icustay_id", "date"], keep="last")
 
     logging.debug("No treatments for %d icustay_id: %s" % \
                  (len(icu_id_w_no_treatments), ",".join([str(s) for s in icu_id_w_no_treatments])))
-    expanded_treatments_df = pd.DataFrame(expanded_treatments)
-    expanded_treatments_df.treatment.fillna("No treatment", inplace=True)
-    return expanded_treatments_df
+    expanded_treatments_df = calendar.merge(
+        latest_treatment_days[["icustay_id", "date", "treatment"]], on=["icustay_id", "date"], how="left")
+    expanded_treatments_df["treatment"] = expanded_treatments_df.treatment.fillna("No treatment")
+    return expanded_treatments_df[["date", "treatment", "icustay_id"]]
+
+
+def _explode_days(icustay_ids, first_days, last_days, **columns):
+    """Creates a row for each day from first_days to last_days, inclusive, for each of the icustay_ids. The other
+    columns are repeated for each day."""
+    day_counts = np.maximum((last_days - first_days) // np.timedelta64(1, "D") + 1, 0)
+    row_positions = np.repeat(np.arange(len(day_counts)), day_counts)
+    day_offsets = np.arange(len(row_positions)) - np.repeat(np.cumsum(day_counts) - day_counts, day_counts)
+    exploded_days = pd.DataFrame({
+        "icustay_id": icustay_ids[row_positions],
+        "date": first_days[row_positions] + day_offsets.astype("timedelta64[D]")
+    })
+    for (name, values) in columns.items():
+        exploded_days[name] = values[row_positions]
+    return exploded_days
@@ -1,20 +1,48 @@
+import logging
+
+import numpy as np
 import pandas as pd
 
-from data_processing.chart_event_processor import get_processed_chart_events
-from data_processing.lab_event_processor import get_processed_lab_events
-from data_processing.patient_info_processor import get_processed_patient_info
-from data_processing.death_outcome_processor import get_death_outcome
-from data_processing.lasix_poe_processor import get_processed_lasix
-from data_processing.processed_data_interface import cache_results
+from data_processing.chart_event_processor import get_processed_chart_events, PROCESSED_CHART_EVENTS_FILE
+from data_processing.lab_event_processor import get_processed_lab_events, PROCESSED_LAB_EVENTS_FILE
+from data_processing.patient_info_processor import get_processed_patient_info, PROCESSED_PATIENT_INFO_FILE
+from data_processing.data_schema import apply_schema
+from data_processing.death_outcome_processor import add_death_outcomes
+from data_processing.lasix_poe_processor import get_processed_lasix, PROCESSED_LASIX_FILE
+from data_processing.partitioned_processing import get_icustay_partitions, process_icustay_partition, \
+    DEFAULT_MEMORY_BUDGET
+from data_processing.processed_data_interface import cache_results, get_cache_state, save_cached_partition, \
+    iter_cached_partitions, remove_cached_partitions, CACHE_VALID, CACHE_UNVERIFIED
+from data_processing.stage_scheduler import Stage, run_stages
+
+
+ML_DATA_FILE = "ml_data"
 
+DEATH_TIME_FRAME = 3
 
-@cache_results("ml_data.csv", description="machine learning dataset")
-def get_ml_data(use_cache=False):
+# The number of low bits of the combined icustay_id and date join key that hold the day
+_DAY_KEY_BITS = 32
+
+
+# The dataset is loaded whole by every command that builds or analyzes the models, feather files load fastest
+@cache_results(ML_DATA_FILE, description="machine learning dataset", storage_format="feather", version=3,
+               ignored_parameters=["reduce_events_in_database", "max_workers", "memory_budget"])
+def get_ml_data(use_cache=True, reduce_events_in_database=False, death_time_frame=DEATH_TIME_FRAME, max_workers=None,
+                memory_budget=None):
     """Returns a dataframe that can be used to train a ML model to predict the outcome of a congestive
     heart failure patient.
 
     Args:
-        use_cache: Skip computation and load results from previous computation.
+        use_cache: Whether to load the results from a previous calculation if they are not stale.
+        reduce_events_in_database: Whether the database reduces the lab and chart events to the first event per
+        icustay, item and day before they are transferred.
+        death_time_frame: The number of days after a date that a patient must be alive for the died outcome to be
+        false.
+        max_workers: The number of processes used to compute the lab event, chart event, patient info and lasix
+        stages, which are independent of each other. Defaults to one process per stage, limited by the number of CPUs.
+        memory_budget: When set, the events are processed out of core with build_ml_data_partitions, in partitions of
+        icustays that are expected to be processed within this many bytes, and the dataset is concatenated from the
+        partitions. The processed lab event, chart event and lasix caches are not used or updated.
 
     Returns:
         A DataFrame with the following columns:
@@ -27,7 +55,11 @@ def get_ml_data(use_cache=False):
         overall_payor_group_descr:
         religion_descr:
         age:
-        died:
+        died: Whether the patient died within death_time_frame days of the date.
+        died_within_1d, died_within_3d, died_within_7d, died_within_30d: Whether the patient died within that many days
+        of the date, for the time frames in data_processing.death_outcome_processor.DEATH_HORIZONS and
+        death_time_frame. The models can be trained on another time frame with
+        data_processing.death_outcome_processor.select_death_outcome.
         creat:
         creat_diff:
         hct:
@@ -57,34 +89,159 @@ def get_ml_data(use_cache=False):
         temperature_c_(calc):
         temperature_c_(calc)_diff:
     """
-    lab_events = get_processed_lab_events(use_cache=use_cache)
-    chart_events = get_processed_chart_events(use_cache=use_cache)
-    patients = get_processed_patient_info(use_cache=use_cache)
-    lasix = get_processed_lasix(use_cache=use_cache)
-
-    current_merged_df = pd.merge(
-        lasix,
-        lab_events,
-        how="inner"  # Keep rows even if there is not a row from each df
-    )
-
-    current_merged_df = pd.merge(
-        current_merged_df,
-        chart_events,
-        how="inner"  # Keep rows even if there is not a row from each df
-    )
-
-    current_merged_df = pd.merge(
-        current_merged_df,
-        patients,
-        how="inner"
-    )
-
-    outcome_df = get_death_outcome(current_merged_df, death_time_frame=3)
-    current_merged_df = pd.merge(
-        current_merged_df,
-        outcome_df,
-        how="inner"
-    )
-
-    return current_merged_df
+    if memory_budget is not None:
+        build_ml_data_partitions(reduce_events_in_database=reduce_events_in_database,
+                                 death_time_frame=death_time_frame, memory_budget=memory_budget)
+        # Categories differ between the partitions, so the categorical columns are concatenated as objects
+        return apply_schema(pd.concat(iter_ml_data_partitions(), ignore_index=True))
+
+    stages = {
+        PROCESSED_LAB_EVENTS_FILE: Stage(
+            _cache_stage, {"get_stage_data": get_processed_lab_events, "use_cache": use_cache,
+                           "reduce_in_database": reduce_events_in_database}, []),
+        PROCESSED_CHART_EVENTS_FILE: Stage(
+            _cache_stage, {"get_stage_data": get_processed_chart_events, "use_cache": use_cache,
+                           "reduce_in_database": reduce_events_in_database}, []),
+        PROCESSED_PATIENT_INFO_FILE: Stage(
+            _cache_stage, {"get_stage_data": get_processed_patient_info, "use_cache": use_cache}, []),
+        PROCESSED_LASIX_FILE: Stage(_cache_stage, {"get_stage_data": get_processed_lasix, "use_cache": use_cache}, [])
+    }
+    stale_stages = {name: stage for (name, stage) in stages.items()
+                    if not use_cache or get_cache_state(name)[0] not in (CACHE_VALID, CACHE_UNVERIFIED)}
+    if stale_stages:
+        run_stages(stale_stages, max_workers=max_workers)
+
+    # The stages cached their results, loading them records them as the dependencies of the dataset
+    lab_events = get_processed_lab_events(reduce_in_database=reduce_events_in_database)
+    chart_events = get_processed_chart_events(reduce_in_database=reduce_events_in_database)
+    patients = get_processed_patient_info()
+    lasix = get_processed_lasix()
+
+    return merge_processed_data(lab_events, chart_events, patients, lasix, death_time_frame=death_time_frame)
+
+
+def build_ml_data_partitions(reduce_events_in_database=False, death_time_frame=DEATH_TIME_FRAME,
+                             memory_budget=DEFAULT_MEMORY_BUDGET):
+    """Builds the machine learning dataset out of core. The icustays are hash partitioned so that the events of each
+    partition are expected to be processed within the memory budget. The partitions are loaded, processed, merged and
+    cached one at a time, so the events of the full cohort are never in memory at once.
+
+    Args:
+        reduce_events_in_database: See get_ml_data.
+        death_time_frame: See get_ml_data.
+        memory_budget: The number of bytes that processing a partition may allocate.
+
+    Returns:
+        The number of partitions, which can be loaded one at a time with iter_ml_data_partitions.
+    """
+    # A cohort without icustays is built as one empty partition, so that the dataset still has its columns and dtypes
+    partitions = get_icustay_partitions(memory_budget) or [np.array([], dtype=np.int64)]
+    patients = get_processed_patient_info()
+    remove_cached_partitions(ML_DATA_FILE)
+    for (partition, icustay_ids) in enumerate(partitions):
+        (lab_events, chart_events, lasix) = process_icustay_partition(
+            icustay_ids, reduce_in_database=reduce_events_in_database)
+        partition_patients = patients[patients.icustay_id.isin(icustay_ids)]
+        ml_data = merge_processed_data(lab_events, chart_events, partition_patients, lasix,
+                                       death_time_frame=death_time_frame)
+        save_cached_partition(ml_data, ML_DATA_FILE, partition)
+        logging.info("Partition %d of %d: %d icustays, %d rows" %
+                     (partition + 1, len(partitions), len(icustay_ids), len(ml_data)))
+    return len(partitions)
+
+
+def iter_ml_data_partitions(columns=None):
+    """Streams the machine learning dataset built by build_ml_data_partitions one partition at a time.
+
+    Args:
+        columns: Only load these columns. Defaults to all columns.
+
+    Returns:
+        A generator of DataFrames with the columns returned by get_ml_data.
+    """
+    return iter_cached_partitions(ML_DATA_FILE, columns=columns)
+
+
+def merge_processed_data(lab_events, chart_events, patients, lasix, death_time_frame=DEATH_TIME_FRAME):
+    """Joins the processed lab events, chart events, patient info and lasix treatments into the dataframe returned by
+    get_ml_data with join_processed_data and adds the death outcomes. Only rows present in all of the processed data are
+    kept, so processed data for a subset of icustays produces the rows for that subset.
+
+    Returns:
+        The rows returned by join_processed_data with the death outcome columns added by
+        data_processing.death_outcome_processor.add_death_outcomes.
+    """
+    ml_data = join_processed_data(lab_events, chart_events, patients, lasix)
+    # The outcomes are computed for every row in order, so they are added without joining on subject_id and date
+    return apply_schema(add_death_outcomes(ml_data, death_time_frame))
+
+
+def join_processed_data(lab_events, chart_events, patients, lasix, log_row_counts=True):
+    """Joins the processed lab events, chart events, patient info and lasix treatments. Only rows present in all of
+    them are kept.
+
+    The daily data is joined on icustay_id and date and the patient info on icustay_id, the keys must be unique in
+    each of them. The keys of the joined rows are computed once, sorted by icustay_id and date, and every dataframe is
+    aligned to them in a single step instead of merging the growing dataframe again for each join. The number of rows
+    each join keeps and drops is logged, unless log_row_counts is false.
+
+    Returns:
+        The joined rows sorted by icustay_id and date, with the columns of lasix, lab_events, chart_events and
+        patients, in that order and without repeating the join keys.
+    """
+    daily_data = [("lasix", lasix), ("lab events", lab_events), ("chart events", chart_events)]
+    (sorted_keys, key_orders) = ([], [])
+    for (name, df) in daily_data:
+        keys = _get_row_keys(df)
+        key_order = np.argsort(keys, kind="stable")
+        if (np.diff(keys[key_order]) == 0).any():
+            raise ValueError("The %s contain more than one row for an icustay_id and date" % name)
+        sorted_keys.append(keys[key_order])
+        key_orders.append(key_order)
+    if patients.icustay_id.duplicated().any():
+        raise ValueError("The patient info contains more than one row for an icustay_id")
+
+    joined_keys = sorted_keys[0]
+    for ((name, _), keys) in list(zip(daily_data, sorted_keys))[1:]:
+        kept_keys = np.intersect1d(joined_keys, keys, assume_unique=True)
+        if log_row_counts:
+            _log_join(name, "icustay_id and date", len(joined_keys), len(kept_keys), len(keys), len(kept_keys))
+        joined_keys = kept_keys
+    kept_keys = joined_keys[np.isin(joined_keys >> _DAY_KEY_BITS, patients.icustay_id.values)]
+    if log_row_counts:
+        _log_join("patient info", "icustay_id", len(joined_keys), len(kept_keys), len(patients),
+                  len(np.unique(kept_keys >> _DAY_KEY_BITS)))
+    joined_keys = kept_keys
+
+    columns = {}
+    for ((_, df), keys, key_order) in zip(daily_data, sorted_keys, key_orders):
+        _add_aligned_columns(columns, df, key_order[np.searchsorted(keys, joined_keys)])
+    patient_positions = pd.Index(patients.icustay_id.values).get_indexer(joined_keys >> _DAY_KEY_BITS)
+    _add_aligned_columns(columns, patients, patient_positions)
+    joined_data = pd.DataFrame(columns)
+    if log_row_counts:
+        logging.info("Joined %d rows" % len(joined_data))
+    return joined_data
+
+
+def _get_row_keys(df):
+    """Combines icustay_id and the day of date into one sortable integer key per row."""
+    days = df.date.values.astype("datetime64[D]").astype("int64")
+    return (df.icustay_id.values.astype("int64") << _DAY_KEY_BITS) + (days + 2 ** (_DAY_KEY_BITS - 1))
+
+
+def _add_aligned_columns(columns, df, positions):
+    for column in df.columns:
+        if column not in columns:
+            columns[column] = df[column].take(positions).values
+
+
+def _log_join(name, keys, joined_rows, kept_joined_rows, rows, kept_rows):
+    logging.info("Inner join with %s on %s: kept %d of %d joined rows and %d of %d %s rows, dropped %d and %d" %
+                 (name, keys, kept_joined_rows, joined_rows, kept_rows, rows, name, joined_rows - kept_joined_rows,
+                  rows - kept_rows))
+
+
+def _cache_stage(get_stage_data, **kwargs):
+    # Runs in a worker process. The results are passed back through the processed data cache instead of being pickled.
+    get_stage_data(**kwargs)
@@ -0,0 +1,82 @@
+import logging
+
+import numpy as np
+
+from data_loading.data_loaders import get_event_counts_by_icustay, get_lab_events, get_chart_events, get_lasix_poe, \
+    get_icustay_details
+from data_loading.query_cache import query_cache_disabled
+from data_processing.chart_event_processor import process_chart_events
+from data_processing.lab_event_processor import process_lab_events
+from data_processing.lasix_poe_processor import process_lasix_poe
+
+DEFAULT_MEMORY_BUDGET = 1024 ** 3
+
+# The peak number of bytes allocated per lab or chart event while the events of a partition are loaded and processed.
+# Around 820 bytes were measured on synthetic databases, the rest is headroom. Used to estimate how many icustays fit in
+# the memory budget.
+_PEAK_BYTES_PER_EVENT = 1000
+
+# Knuth's multiplicative hash constant, spreads consecutive icustay IDs over the partitions
+_HASH_MULTIPLIER = 2654435761
+
+
+def get_icustay_partitions(memory_budget=DEFAULT_MEMORY_BUDGET):
+    """Hash partitions the icustays of the cohort so that processing the events of any partition is expected to stay
+    within the memory budget. The events are counted by the database before any are loaded.
+
+    Args:
+        memory_budget: The number of bytes that processing a partition may allocate.
+
+    Returns:
+        A list with a sorted array of icustay IDs for each partition. Icustays without lab or chart events are not in
+        any partition, they have no rows in the machine learning dataset.
+    """
+    event_counts = get_event_counts_by_icustay()
+    estimated_bytes = (event_counts.lab_events + event_counts.chart_events).values * _PEAK_BYTES_PER_EVENT
+    if len(event_counts) == 0:
+        return []
+    if estimated_bytes.max() > memory_budget:
+        raise ValueError("The events of icustay %d are expected to need %d bytes, more than the memory budget of %d bytes"
+                         % (event_counts.icustay_id.iloc[estimated_bytes.argmax()], estimated_bytes.max(),
+                            memory_budget))
+
+    # Hashing does not balance the partitions exactly, partitions are added until the largest one fits
+    partition_count = int(np.ceil(estimated_bytes.sum() / memory_budget))
+    while True:
+        partitions = _hash_partition(event_counts.icustay_id.values, partition_count)
+        partition_bytes = np.bincount(partitions, weights=estimated_bytes, minlength=partition_count)
+        if partition_bytes.max() <= memory_budget:
+            break
+        partition_count += 1
+
+    logging.info("Partitioned %d icustays into %d partitions of at most %d estimated bytes" %
+                 (len(event_counts), partition_count, partition_bytes.max()))
+    icustay_ids = event_counts.icustay_id.values
+    return [np.sort(icustay_ids[partitions == partition]) for partition in range(partition_count)
+            if (partitions == partition).any()]
+
+
+def process_icustay_partition(icustay_ids, reduce_in_database=False):
+    """Loads and processes the lab events, chart events and lasix treatments of a partition of icustays. Icustays are
+    processed independently, so the results are the rows of the full processed data for those icustays. The query
+    results are not cached, so only the data of the partition being processed is held in memory.
+
+    Args:
+        icustay_ids: The icustay IDs of the partition, as returned by get_icustay_partitions.
+        reduce_in_database: Whether the database reduces the lab and chart events to the first event per icustay, item
+        and day before they are transferred.
+
+    Returns:
+        A tuple of the processed lab events, chart events and lasix treatments of the partition, as returned by
+        get_processed_lab_events, get_processed_chart_events and get_processed_lasix.
+    """
+    with query_cache_disabled():
+        lab_events = process_lab_events(get_lab_events(first_per_day=reduce_in_database, icustay_ids=icustay_ids))
+        chart_events = process_chart_events(get_chart_events(first_per_day=reduce_in_database, icustay_ids=icustay_ids))
+        lasix = process_lasix_poe(get_lasix_poe(icustay_ids), get_icustay_details(icustay_ids))
+    return lab_events, chart_events, lasix
+
+
+def _hash_partition(icustay_ids, partition_count):
+    hashes = (icustay_ids.astype(np.uint64) * np.uint64(_HASH_MULTIPLIER)) % np.uint64(2 ** 32)
+    return (hashes % np.uint64(partition_count)).astype(np.int64)
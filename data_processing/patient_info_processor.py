@@ -1,13 +1,17 @@
 from data_loading.data_loaders import get_patients, get_demographic_details, get_hospital_admissions, get_icustay_details
+from data_processing.data_schema import apply_schema
 from data_processing.datetime_modifier import get_modify_dates_fn
 from data_processing.processed_data_interface import cache_results
 
-@cache_results("patient_info.csv", description="patient info")
-def get_processed_patient_info(use_cache=False):
+PROCESSED_PATIENT_INFO_FILE = "patient_info"
+
+
+@cache_results(PROCESSED_PATIENT_INFO_FILE, description="patient info", version=2)
+def get_processed_patient_info(use_cache=True):
     """Returns non medical information about a patient for a hospital admission stay.
 
     Args:
-        use_cache: Skip computation and load results from previous computation.
+        use_cache: Whether to load the results from a previous calculation if they are not stale.
 
     Returns:
         A DataFrame with the following columns:
@@ -21,10 +25,13 @@ def get_processed_patient_info(use_cache=False):
         age:
     TODO: Add comments for each column
     """
+    return process_patient_info(get_patients(), get_icustay_details(), get_demographic_details())
+
+
+def process_patient_info(patients, icu_details, demographic_details):
+    """Transforms the patients, icustay details and demographic details, as returned by data_loading.data_loaders, into
+    the dataframe returned by get_processed_patient_info."""
     modify_dates_fn = get_modify_dates_fn()
-    patients = get_patients()
-    icu_details = get_icustay_details()
-    demographic_details = get_demographic_details()
 
     target_patient_data = patients[["subject_id", "hadm_id", "sex", "dob"]]
 
@@ -44,7 +51,7 @@ def get_processed_patient_info(use_cache=False):
     icu_details = modify_dates_fn(icu_details, ["icustay_intime"])
     patients_info = modify_dates_fn(patients_info, ["dob"])
 
-    ages = (icu_details.icustay_intime - patients_info.dob).astype("timedelta64[Y]")
+    ages = (icu_details.icustay_intime - patients_info.dob).dt.days // 365.2425
     patients_info.drop("dob", axis=1, inplace=True)
     patients_info["age"] = ages
 
@@ -52,4 +59,4 @@ def get_processed_patient_info(use_cache=False):
     target_icu_fields = icu_details[['hadm_id', 'icustay_id']]
     patients_info = target_icu_fields.merge(patients_info)
 
-    return patients_info.drop(['hadm_id'], axis=1).drop_duplicates()
+    return apply_schema(patients_info.drop(['hadm_id'], axis=1).drop_duplicates())
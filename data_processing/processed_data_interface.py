@@ -1,65 +1,415 @@
 import os
+import json
 import shutil
 import logging
 import time
+import hashlib
+import inspect
+import functools
+import threading
+from collections import OrderedDict
 
 import pandas as pd
 
+from data_loading.columnar_storage import write_data_frame, read_data_frame
+from data_loading.data_loaders import get_data_source
+
 _PROCESSED_DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "processed_data")
 
 _DATE_FIELDS = ['charttime', 'date']
 
+# File extension for each storage format. CSV is only kept to read caches written before the columnar formats.
+_FILE_EXTENSIONS = {
+    "parquet": ".parquet",
+    "feather": ".feather",
+    "csv": ".csv"
+}
+
+_settings = {
+    "storage_format": "parquet",
+    "compression": {"parquet": "zstd", "feather": "lz4"}
+}
+
+# The caches created with cache_results, keyed by cache file name, in the order they were declared
+_registered_caches = OrderedDict()
+
+# Fingerprints of the caches loaded or computed while computing a cache, so that they are recorded as its dependencies
+_dependency_stack = threading.local()
+
+_FINGERPRINT_FILE_SUFFIX = ".fingerprint.json"
+
+# Partitions of data processed out of core are cached to files in a directory named after the cache
+_PARTITIONS_DIR_SUFFIX = ".partitions"
 
-def cache_results(file_name, description):
-    """Decorator used by data processing methods to cache results to csv files
+# States of a cache, see get_cache_state
+CACHE_VALID = "valid"
+CACHE_STALE = "stale"
+CACHE_MISSING = "missing"
+CACHE_UNVERIFIED = "unverified"
+
+
+def configure_processed_data_cache(storage_format=None, compression=None):
+    """Configures how processed data is cached.
 
     Args:
-        file_name: The file name to use as the cache file.
+        storage_format: The default storage format for caches that do not choose one: parquet, feather or csv.
+        compression: A dict from storage format to compression codec, for example {"parquet": "snappy"}.
+    """
+    if storage_format is not None:
+        _settings["storage_format"] = storage_format
+    if compression is not None:
+        _settings["compression"].update(compression)
+
+
+def cache_results(file_name, description, storage_format=None, version=1, ignored_parameters=()):
+    """Decorator used by data processing methods to cache results to files
+
+    Each cache is stored with a fingerprint of what produced it: the code version, the parameters of the method, the
+    data source and the fingerprints of the caches the method loaded or computed. Cached results are only used while
+    all of these still match, otherwise they are stale and recomputed. Caches written before fingerprints were
+    recorded are used as they are.
+
+    Args:
+        file_name: The file name to use as the cache file, without extension.
+        description: Description of the results used in log messages.
+        storage_format: The storage format of the cache file: parquet, feather or csv. Defaults to the format set with
+        configure_processed_data_cache. Caches written in another format, such as CSV caches from before the columnar
+        formats, are still loaded.
+        version: The code version of the method. Increment it when a change to the method changes its results.
+        ignored_parameters: Parameters of the method that do not change its results, such as chunk sizes.
 
     Returns:
         A decorator function for the given file_name.
     """
+    _registered_caches[file_name] = {
+        "description": description,
+        "storage_format": storage_format,
+        "version": version
+    }
 
     def decorate(func):
+        signature = inspect.signature(func)
 
+        @functools.wraps(func)
         def cacher(**karg):
             use_cache = karg["use_cache"] if "use_cache" in karg else True
-            if _does_file_exist(file_name) and use_cache:
+            parameters = _get_fingerprint_parameters(signature, karg, ignored_parameters)
+            (state, reason) = get_cache_state(file_name, parameters)
+            if use_cache and state in (CACHE_VALID, CACHE_UNVERIFIED):
                 logging.info("Loading %s from cache" % description)
                 start = time.perf_counter()
-                data = _load_data_frame(file_name)
-                for date_field in _DATE_FIELDS:
-                    if date_field in data.columns:
-                        data[date_field] = pd.to_datetime(data[date_field])
+                data = load_cached_data(file_name)
                 stop = time.perf_counter()
                 logging.info("Loading %s from cache took %.3fs" % (description, stop - start))
+                fingerprint_record = _load_fingerprint_record(file_name)
             else:
+                if use_cache:
+                    logging.info("Cached %s is %s: %s" % (description, state, reason))
                 logging.info("Processing %s" % description)
                 start = time.perf_counter()
-                data = func(**karg)
+                (data, dependencies) = _call_recording_dependencies(func, karg)
                 stop = time.perf_counter()
                 logging.info("Processing %s took %.3fs" % (description, stop - start))
+                fingerprint_record = _create_fingerprint_record(file_name, parameters, dependencies)
                 _save_data_frame(data, file_name)
+                save_cached_metadata(fingerprint_record, file_name + _FINGERPRINT_FILE_SUFFIX)
+            _record_dependency(file_name, fingerprint_record)
             return data
 
         return cacher
 
     return decorate
 
+
+def get_cache_state(file_name, parameters=None):
+    """Returns whether the cached results can be used.
+
+    Args:
+        file_name: The file name used by the method decorated with cache_results.
+        parameters: The parameters the results are requested for. Defaults to the parameters they were computed with.
+
+    Returns:
+        A tuple of the state and the reason for it. The state is one of:
+        CACHE_VALID: The cache matches the current code version, parameters, data source and dependencies.
+        CACHE_STALE: The cache was produced by a different code version, parameters or data source, or one of the
+        caches it depends on is stale or was recomputed since.
+        CACHE_MISSING: The results have not been cached.
+        CACHE_UNVERIFIED: The cache was written without a fingerprint.
+    """
+    if not _does_file_exist(file_name):
+        return CACHE_MISSING, "not cached"
+    record = _load_fingerprint_record(file_name)
+    if record is None:
+        return CACHE_UNVERIFIED, "cached without a fingerprint"
+
+    registered_cache = _registered_caches.get(file_name)
+    if registered_cache is not None and record["version"] != registered_cache["version"]:
+        return CACHE_STALE, "code version changed from %s to %s" % (record["version"], registered_cache["version"])
+    if parameters is not None and record["parameters"] != parameters:
+        return CACHE_STALE, "parameters changed from %s to %s" % (record["parameters"], parameters)
+    if record["source"] != get_data_source().identity:
+        return CACHE_STALE, "data source changed from %s" % record["source"]
+    for (dependency, dependency_fingerprint) in sorted(record["dependencies"].items()):
+        (dependency_state, _) = get_cache_state(dependency)
+        if dependency_state in (CACHE_STALE, CACHE_MISSING):
+            return CACHE_STALE, "%s is %s" % (dependency, dependency_state)
+        if _get_fingerprint(_load_fingerprint_record(dependency)) != dependency_fingerprint:
+            return CACHE_STALE, "%s was recomputed" % dependency
+    return CACHE_VALID, "up to date"
+
+
+def load_cache_parameters(file_name):
+    """Returns the parameters the cached results were computed with, or None if they were cached without a
+    fingerprint."""
+    record = _load_fingerprint_record(file_name)
+    return None if record is None else record["parameters"]
+
+
+def get_cache_status():
+    """Returns the state of every cache declared with cache_results.
+
+    Returns:
+        A DataFrame indexed by cache file name with the following columns:
+        description: The description of the cached results.
+        state: The state of the cache, see get_cache_state.
+        reason: Why the cache is in that state.
+        fingerprint: The start of the cache's fingerprint.
+    """
+    status = []
+    for (file_name, registered_cache) in _registered_caches.items():
+        (state, reason) = get_cache_state(file_name)
+        fingerprint = _get_fingerprint(_load_fingerprint_record(file_name)) if state != CACHE_MISSING else None
+        status.append({
+            "cache": file_name,
+            "description": registered_cache["description"],
+            "state": state,
+            "reason": reason,
+            "fingerprint": fingerprint[:12] if fingerprint else ""
+        })
+    return pd.DataFrame(status, columns=["cache", "description", "state", "reason", "fingerprint"]).set_index("cache")
+
+
 def clear_processed_data_cache():
     """Removes all cached preprocessed data"""
     if os.path.exists(_PROCESSED_DATA_DIR):
         shutil.rmtree(_PROCESSED_DATA_DIR)
 
+
+def is_cached(file_name):
+    """Returns whether results have been cached to the file."""
+    return _does_file_exist(file_name)
+
+
+def remove_cached_data(file_name):
+    """Removes the results cached to the file in any storage format, and its partitions."""
+    _remove_data_files(file_name)
+    remove_cached_partitions(file_name)
+    fingerprint_file_path = os.path.join(_PROCESSED_DATA_DIR, file_name + _FINGERPRINT_FILE_SUFFIX)
+    if os.path.exists(fingerprint_file_path):
+        os.remove(fingerprint_file_path)
+
+
+def load_cached_data(file_name, columns=None, memory_map=False):
+    """Loads results cached by a method decorated with cache_results.
+
+    Args:
+        file_name: The file name the results were cached to.
+        columns: Only load these columns. Defaults to all columns. Columnar formats only read the selected columns.
+        memory_map: Whether to memory map columnar cache files instead of reading them into a buffer.
+
+    Returns:
+        The cached DataFrame.
+    """
+    (file_path, storage_format) = _find_cache_file(file_name)
+    if storage_format == "csv":
+        data = pd.read_csv(file_path, usecols=columns)
+        for date_field in _DATE_FIELDS:
+            if date_field in data.columns:
+                data[date_field] = pd.to_datetime(data[date_field])
+        return data if columns is None else data[columns]
+    return read_data_frame(file_path, columns=columns, memory_map=memory_map, file_format=storage_format)
+
+
+def save_cached_data(data, file_name, refresh_fingerprint=False):
+    """Replaces the results cached to the file, for example after some of the rows have been recomputed.
+
+    Args:
+        data: The DataFrame to cache.
+        file_name: The file name used by the method decorated with cache_results.
+        refresh_fingerprint: Whether the results are now up to date with the current data source, see
+        refresh_cache_fingerprint. Otherwise the fingerprint is kept.
+    """
+    _save_data_frame(data, file_name)
+    if refresh_fingerprint:
+        refresh_cache_fingerprint(file_name)
+
+
+def refresh_cache_fingerprint(file_name):
+    """Fingerprints cached results with the current data source and the current fingerprints of the caches they depend
+    on, keeping the parameters they were computed with. Used when the results were brought up to date without
+    recomputing them, such as by an incremental refresh. The caches they depend on must be refreshed first.
+
+    Results cached without a fingerprint are left without one.
+
+    Args:
+        file_name: The file name used by the method decorated with cache_results.
+    """
+    record = _load_fingerprint_record(file_name)
+    if record is None:
+        return
+    dependencies = {dependency: _get_fingerprint(_load_fingerprint_record(dependency))
+                    for dependency in record["dependencies"]}
+    save_cached_metadata(_create_fingerprint_record(file_name, record["parameters"], dependencies),
+                         file_name + _FINGERPRINT_FILE_SUFFIX)
+
+
+def save_cached_partition(data, file_name, partition):
+    """Caches one partition of data that is processed out of core, one partition at a time.
+
+    Args:
+        data: The DataFrame with the rows of the partition.
+        file_name: The file name of the cache the partition belongs to.
+        partition: The number of the partition.
+    """
+    partitions_dir = os.path.join(_PROCESSED_DATA_DIR, file_name + _PARTITIONS_DIR_SUFFIX)
+    os.makedirs(partitions_dir, exist_ok=True)
+    _save_data_frame(data, _get_partition_file_name(file_name, partition))
+
+
+def iter_cached_partitions(file_name, columns=None):
+    """Loads the partitions cached with save_cached_partition one at a time, in partition order.
+
+    Args:
+        file_name: The file name of the cache the partitions belong to.
+        columns: Only load these columns. Defaults to all columns.
+
+    Returns:
+        A generator of DataFrames, one per partition.
+    """
+    partitions_dir = os.path.join(_PROCESSED_DATA_DIR, file_name + _PARTITIONS_DIR_SUFFIX)
+    partition_names = sorted({os.path.splitext(name)[0] for name in os.listdir(partitions_dir)}) \
+        if os.path.exists(partitions_dir) else []
+    for partition_name in partition_names:
+        yield load_cached_data(file_name + _PARTITIONS_DIR_SUFFIX + "/" + partition_name, columns=columns)
+
+
+def remove_cached_partitions(file_name):
+    """Removes the partitions cached with save_cached_partition."""
+    partitions_dir = os.path.join(_PROCESSED_DATA_DIR, file_name + _PARTITIONS_DIR_SUFFIX)
+    if os.path.exists(partitions_dir):
+        shutil.rmtree(partitions_dir)
+
+
+def load_cached_metadata(file_name):
+    """Loads a dict saved by save_cached_metadata, or returns None if it has not been saved."""
+    file_path = os.path.join(_PROCESSED_DATA_DIR, file_name)
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path) as metadata_file:
+        return json.load(metadata_file)
+
+
+def save_cached_metadata(metadata, file_name):
+    """Saves a dict describing the cached data, for example the watermarks of the source data it was built from. The
+    metadata is removed with the rest of the cached data."""
+    # Stages running in parallel processes may create the directory at the same time
+    os.makedirs(_PROCESSED_DATA_DIR, exist_ok=True)
+    with open(os.path.join(_PROCESSED_DATA_DIR, file_name), "w") as metadata_file:
+        json.dump(metadata, metadata_file, indent=2, sort_keys=True)
+
+
+def _get_storage_format(file_name):
+    registered_cache = _registered_caches.get(file_name)
+    if registered_cache is not None and registered_cache["storage_format"] is not None:
+        return registered_cache["storage_format"]
+    return _settings["storage_format"]
+
+
+def _get_fingerprint_parameters(signature, karg, ignored_parameters):
+    bound_arguments = signature.bind(**karg)
+    bound_arguments.apply_defaults()
+    parameters = {name: value for (name, value) in bound_arguments.arguments.items()
+                  if name != "use_cache" and name not in ignored_parameters}
+    # Normalized the same way as when the parameters are loaded from the fingerprint file
+    return json.loads(json.dumps(parameters, sort_keys=True, default=str))
+
+
+def _call_recording_dependencies(func, karg):
+    if not hasattr(_dependency_stack, "frames"):
+        _dependency_stack.frames = []
+    _dependency_stack.frames.append({})
+    try:
+        data = func(**karg)
+    finally:
+        dependencies = _dependency_stack.frames.pop()
+    return data, dependencies
+
+
+def _record_dependency(file_name, fingerprint_record):
+    frames = getattr(_dependency_stack, "frames", None)
+    if frames:
+        frames[-1][file_name] = _get_fingerprint(fingerprint_record)
+
+
+def _create_fingerprint_record(file_name, parameters, dependencies):
+    record = {
+        "cache": file_name,
+        "version": _registered_caches[file_name]["version"],
+        "parameters": parameters,
+        "source": get_data_source().identity,
+        "dependencies": dependencies
+    }
+    record["fingerprint"] = hashlib.sha1(json.dumps(record, sort_keys=True).encode("utf8")).hexdigest()
+    return record
+
+
+def _load_fingerprint_record(file_name):
+    return load_cached_metadata(file_name + _FINGERPRINT_FILE_SUFFIX)
+
+
+def _get_fingerprint(fingerprint_record):
+    return None if fingerprint_record is None else fingerprint_record["fingerprint"]
+
+
+def _get_file_path(file_name, storage_format):
+    return os.path.join(_PROCESSED_DATA_DIR, file_name + _FILE_EXTENSIONS[storage_format])
+
+
+def _get_partition_file_name(file_name, partition):
+    return "%s%s/part-%05d" % (file_name, _PARTITIONS_DIR_SUFFIX, partition)
+
+
+def _find_cache_file(file_name):
+    """Returns the path and storage format of the cache file, preferring the storage format chosen for the cache, or
+    (None, None) if the results have not been cached."""
+    storage_format = _get_storage_format(file_name)
+    for candidate_format in [storage_format] + [f for f in _FILE_EXTENSIONS if f != storage_format]:
+        file_path = _get_file_path(file_name, candidate_format)
+        if os.path.exists(file_path):
+            return file_path, candidate_format
+    return None, None
+
+
 def _does_file_exist(file_name):
-    return os.path.exists(os.path.join(_PROCESSED_DATA_DIR, file_name))
+    return _find_cache_file(file_name)[0] is not None
 
 
 def _save_data_frame(dataframe, file_name):
-    if not os.path.exists(_PROCESSED_DATA_DIR):
-        os.makedirs(_PROCESSED_DATA_DIR)
-    dataframe.to_csv(os.path.join(_PROCESSED_DATA_DIR, file_name), index=False)
+    # Stages running in parallel processes may create the directory at the same time
+    os.makedirs(_PROCESSED_DATA_DIR, exist_ok=True)
+    # Remove caches in other formats so that they are never loaded instead of the new results
+    _remove_data_files(file_name)
+    storage_format = _get_storage_format(file_name)
+    file_path = _get_file_path(file_name, storage_format)
+    if storage_format == "csv":
+        dataframe.to_csv(file_path, index=False)
+    else:
+        write_data_frame(dataframe.reset_index(drop=True), file_path,
+                         compression=_settings["compression"][storage_format], file_format=storage_format)
 
 
-def _load_data_frame(file_name):
-    return pd.read_csv(os.path.join(_PROCESSED_DATA_DIR, file_name))
+def _remove_data_files(file_name):
+    for storage_format in _FILE_EXTENSIONS:
+        file_path = _get_file_path(file_name, storage_format)
+        if os.path.exists(file_path):
+            os.remove(file_path)
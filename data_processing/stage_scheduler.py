@@ -0,0 +1,139 @@
+import os
+import time
+import logging
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import pandas as pd
+
+from data_loading.data_loaders import get_data_source, set_data_source
+
+# A processing stage. function is called with kwargs once all of the stages in dependencies have finished. The function
+# must be picklable, for example a module level function, since it runs in another process.
+Stage = namedtuple("Stage", ["function", "kwargs", "dependencies"])
+
+
+def run_stages(stages, max_workers=None):
+    """Runs processing stages on a process pool. A stage starts as soon as the stages it depends on have finished, so
+    independent stages run at the same time.
+
+    Results are pickled to return them from the worker processes. Stages that produce large dataframes should write
+    them to the processed data cache and return nothing, the cache files can be loaded without copying them through
+    the pool.
+
+    Args:
+        stages: A dict from stage name to Stage.
+        max_workers: The number of worker processes. Defaults to the number of CPUs, but no more than the number of
+        stages. With a single worker the stages run one after another in the current process.
+
+    Returns:
+        A tuple of a dict from stage name to the value returned by its function, and a DataFrame indexed by stage name
+        with the following columns:
+        start: When the stage started, in seconds since the first stage started.
+        finish: When the stage finished, in seconds since the first stage started.
+        seconds: The time the stage took to run.
+        critical_path: Whether the stage is on the critical path, the chain of dependent stages with the longest total
+        time. The stages can not finish in less than the critical path time however many workers there are.
+    """
+    max_workers = max_workers or min(os.cpu_count() or 1, max(len(stages), 1))
+    _validate_stages(stages)
+
+    start = time.perf_counter()
+    if max_workers == 1:
+        results, timings = _run_stages_in_process(stages)
+    else:
+        results, timings = _run_stages_in_pool(stages, max_workers)
+    elapsed = time.perf_counter() - start
+
+    report = pd.DataFrame(
+        [{"stage": name, "start": stage_start - start, "finish": stage_finish - start,
+          "seconds": stage_finish - stage_start} for (name, (stage_start, stage_finish)) in timings.items()],
+        columns=["stage", "start", "finish", "seconds"]).set_index("stage").sort_values("start")
+    critical_path = _get_critical_path(stages, report.seconds.to_dict())
+    report["critical_path"] = report.index.isin(critical_path)
+
+    for (name, stage_report) in report.iterrows():
+        logging.info("Stage %s took %.3fs" % (name, stage_report.seconds))
+    logging.info("%d stages took %.3fs with %d workers, the critical path %s takes %.3fs" %
+                 (len(stages), elapsed, max_workers, " -> ".join(critical_path),
+                  report.seconds[critical_path].sum()))
+    return results, report
+
+
+def _run_stages_in_process(stages):
+    (results, timings) = ({}, {})
+    finished = set()
+    while len(finished) < len(stages):
+        for name in _get_ready_stages(stages, finished, set()):
+            (results[name], timings[name]) = _run_stage(stages[name].function, stages[name].kwargs)
+            finished.add(name)
+    return results, timings
+
+
+def _run_stages_in_pool(stages, max_workers):
+    (results, timings) = ({}, {})
+    (finished, submitted) = (set(), set())
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_initialize_worker,
+                             initargs=(get_data_source(),)) as executor:
+        running = {}
+        while len(finished) < len(stages):
+            for name in _get_ready_stages(stages, finished, submitted):
+                running[executor.submit(_run_stage, stages[name].function, stages[name].kwargs)] = name
+                submitted.add(name)
+            (done, _) = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                (results[name], timings[name]) = future.result()
+                finished.add(name)
+    return results, timings
+
+
+def _initialize_worker(data_source):
+    # Workers load data from the same source as the process that started them
+    set_data_source(data_source)
+
+
+def _run_stage(function, kwargs):
+    stage_start = time.perf_counter()
+    result = function(**kwargs)
+    return result, (stage_start, time.perf_counter())
+
+
+def _get_ready_stages(stages, finished, submitted):
+    return [name for (name, stage) in stages.items()
+            if name not in finished and name not in submitted and all(d in finished for d in stage.dependencies)]
+
+
+def _validate_stages(stages):
+    for (name, stage) in stages.items():
+        for dependency in stage.dependencies:
+            if dependency not in stages:
+                raise ValueError("Stage %s depends on unknown stage %s" % (name, dependency))
+    # Every stage must become ready eventually, otherwise the stages contain a cycle
+    finished = set()
+    while len(finished) < len(stages):
+        ready_stages = _get_ready_stages(stages, finished, set())
+        if not ready_stages:
+            raise ValueError("Stages contain a dependency cycle: %s" % ", ".join(sorted(set(stages) - finished)))
+        finished.update(ready_stages)
+
+
+def _get_critical_path(stages, seconds_by_stage):
+    """Returns the chain of dependent stages with the longest total time."""
+    (path_seconds, previous_stage) = ({}, {})
+    finished = set()
+    while len(finished) < len(stages):
+        for name in _get_ready_stages(stages, finished, set()):
+            dependencies = stages[name].dependencies
+            longest_dependency = max(dependencies, key=lambda d: path_seconds[d]) if dependencies else None
+            path_seconds[name] = seconds_by_stage[name] + \
+                (path_seconds[longest_dependency] if longest_dependency is not None else 0)
+            previous_stage[name] = longest_dependency
+            finished.add(name)
+
+    critical_path = []
+    name = max(path_seconds, key=lambda s: path_seconds[s]) if path_seconds else None
+    while name is not None:
+        critical_path.insert(0, name)
+        name = previous_stage[name]
+    return critical_path
@@ -2,10 +2,18 @@
 import logging
 import click
 
-from data_processing.processed_data_interface import clear_processed_data_cache
-from data_processing.ml_data_prepairer import get_ml_data
+from data_loading.data_loaders import set_data_source, get_cohort_join_row_counts
+from data_loading.data_sources import get_data_source_for_location
+from data_loading.query_cache import clear_query_cache
+from data_loading.synthetic_mimic2 import generate_synthetic_mimic2
+from data_processing.processed_data_interface import clear_processed_data_cache, get_cache_status, get_cache_state, \
+    CACHE_VALID, CACHE_UNVERIFIED
+from data_processing.ml_data_prepairer import get_ml_data, ML_DATA_FILE
+from data_processing.data_schema import get_memory_report
+from data_processing.incremental_refresh import build_ml_data_with_watermarks, refresh_ml_data
 from models.save_file_helper import delete_model_debugging_files
 from models.build_decision_engine import get_decision_engine, delete_cached_model
+from models.recommendation_service import serve_recommendations
 from models.analysis.decision_engine_analyzer import DecisionEngineAnalyzer, delete_previous_analysis_reports, ANALYSIS_RESULTS_DIR
 
 _LOG_LEVELS = [
@@ -19,25 +27,70 @@ _LOG_LEVELS = [
 @click.group()
 @click.option('--ll', type=click.Choice(_LOG_LEVELS), help="The log level", default='INFO')
 @click.option('--cache', default=True)
+@click.option('--db', help="SQLAlchemy url or SQLite file to load MIMIC2 data from. Defaults to the MIMIC2_DATABASE_URL "
+                           "environment variable or the local MIMIC2 database")
 @click.pass_context
-def cli(ctx, ll, cache):
+def cli(ctx, ll, cache, db):
     logger = logging.getLogger()
     logger.setLevel(ll)
     ctx.obj['use_cache'] = cache
+    if db is not None:
+        set_data_source(get_data_source_for_location(db))
 
 @cli.command(help="Remove all cached data")
 @click.pass_context
 def clean(ctx):
     _all_clean()
+    clear_query_cache()
+    click.echo("Cached query results removed")
 
 @cli.command(help="Build machine learning feature set")
+@click.option('--reduce-in-db', is_flag=True, help="Reduce lab and chart events to daily values in the database")
+@click.option('--incremental', is_flag=True, help="Only process icustays with data added since the last build")
+@click.option('--force', is_flag=True, help="Remove all cached data and rebuild everything")
+@click.option('--workers', type=int, help="Number of processes used to process the independent stages in parallel")
+@click.option('--memory-budget', type=int,
+              help="Process the events out of core in partitions of icustays that fit in this many megabytes")
 @click.pass_context
-def pd(ctx):
-    # When building a new dataset, we should clear all cache since the models and analysis are no longer valid
-    _all_clean()
-    get_ml_data()
+def pd(ctx, reduce_in_db, incremental, force, workers, memory_budget):
+    if incremental:
+        try:
+            refreshed_icustay_ids = refresh_ml_data(reduce_events_in_database=reduce_in_db)
+        except ValueError as e:
+            raise click.ClickException("%s. Rebuild it with pd --force" % e)
+        if not refreshed_icustay_ids:
+            click.echo("Dataset is up to date")
+            return
+        # The models and analysis are no longer valid for the refreshed dataset
+        _model_clean()
+        click.echo("Dataset refreshed for %d icustays" % len(refreshed_icustay_ids))
+        return
+    (state, _) = get_cache_state(ML_DATA_FILE)
+    if force:
+        _all_clean()
+    elif state == CACHE_VALID:
+        click.echo("Dataset is up to date")
+        return
+    else:
+        # The models and analysis are no longer valid for the new dataset
+        _model_clean()
+    # Caches written without a fingerprint would be used as they are, so they are rebuilt along with the dataset
+    build_ml_data_with_watermarks(reduce_events_in_database=reduce_in_db, use_cache=state != CACHE_UNVERIFIED,
+                                  max_workers=workers,
+                                  memory_budget=memory_budget * 1024 ** 2 if memory_budget else None)
     click.echo("New dataset built")
 
+@cli.command(help="Show which cached processed data is valid and which is stale")
+@click.pass_context
+def status(ctx):
+    click.echo(get_cache_status().to_string())
+
+@cli.command(name="memory-report", help="Show the memory used by each column of the dataset before and after the schema")
+@click.pass_context
+def memory_report(ctx):
+    report = get_memory_report(get_ml_data())
+    click.echo(report.to_string(formatters={"saved": "{:.0%}".format}))
+
 @cli.command(help="Build the decision engine")
 @click.pass_context
 def bde(ctx):
@@ -59,9 +112,40 @@ def dea(ctx):
     analyzer.create_analysis_reports()
     click.echo("Reports created in directory %s" % ANALYSIS_RESULTS_DIR)
 
+@cli.command(help="Serve treatment suggestions for patient day features over HTTP")
+@click.option('--host', default="127.0.0.1")
+@click.option('--port', default=8000)
+@click.option('--batch-window', default=5.0, help="Milliseconds a request waits for others to join its batch")
+@click.option('--max-batch-size', default=256)
+@click.option('--workers', default=1, help="Number of threads that process batches")
+@click.pass_context
+def serve(ctx, host, port, batch_window, max_batch_size, workers):
+    decision_engine = get_decision_engine(get_ml_data())
+    serve_recommendations(decision_engine, host=host, port=port, batch_window=batch_window / 1000,
+                          max_batch_size=max_batch_size, workers=workers)
+
+@cli.command(help="Generate a synthetic MIMIC2 SQLite database that can be used with --db")
+@click.argument('path')
+@click.option('--scale', default=1.0, help="Multiplier for the number of generated patients")
+@click.option('--seed', default=0)
+@click.pass_context
+def synth(ctx, path, scale, seed):
+    row_counts = generate_synthetic_mimic2(path, scale=scale, seed=seed)
+    for (table, count) in row_counts.items():
+        click.echo("%s: %d rows" % (table, count))
+    click.echo("Synthetic database written to %s" % path)
+
+@cli.command(name="join-report", help="Compare loader row counts with the previous icd9 join queries")
+@click.pass_context
+def join_report(ctx):
+    click.echo(get_cohort_join_row_counts().to_string())
+
 def _all_clean():
     clear_processed_data_cache()
     click.echo("Cached preprocessed data removed")
+    _model_clean()
+
+def _model_clean():
     delete_model_debugging_files()
     click.echo("Model debugging files removed")
     delete_cached_model()
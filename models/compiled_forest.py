@@ -0,0 +1,151 @@
+import numpy as np
+
+# The child of a leaf node in a fitted sklearn tree
+_TREE_LEAF = -1
+
+# The number of sample and tree pairs that are walked together, which bounds the memory of a traversal
+_PAIRS_PER_CHUNK = 1 << 16
+
+
+class CompiledForest(object):
+    """A fitted random forest flattened into contiguous arrays of the nodes of all its trees, which predicts the same
+    probabilities as the forest without any sklearn objects involved.
+
+    The nodes of the trees are stored one tree after another, and a leaf is its own left and right child. Every sample
+    walks every tree at the same time, one level of the trees per step, with a few numpy operations on the arrays of
+    all the walks. This avoids the fixed cost of a call to sklearn, which dominates when a few samples are scored.
+
+    Example:
+        compiled_forest = compile_forest(forest)
+        compiled_forest.predict_proba(X)
+    """
+
+    def __init__(self, features, thresholds, children, leaf_probabilities, roots, max_depth, class_counts):
+        """
+        Args:
+            features: The feature each node splits on, 0 for leaves.
+            thresholds: The float32 threshold each node splits at, a sample goes left if its feature is less than or
+            equal to it.
+            children: A nodes x 2 array with the left and right child of each node.
+            leaf_probabilities: A nodes x outputs x classes array with the class probabilities of each leaf.
+            roots: The root node of each tree.
+            max_depth: The depth of the deepest tree.
+            class_counts: The number of classes of each output.
+        """
+        self.features = features
+        self.thresholds = thresholds
+        self.children = children
+        self.leaf_probabilities = leaf_probabilities
+        self.roots = roots
+        self.max_depth = max_depth
+        self.class_counts = class_counts
+
+    def predict_proba(self, X):
+        """Returns the class probabilities of the samples, see RandomForestClassifier.predict_proba.
+
+        The leaf probabilities of the trees are added up in the order of the trees, so they are equal to those of
+        the forest when its trees are accumulated in order, and differ by rounding otherwise.
+
+        Args:
+            X: The preprocessed features of each sample.
+
+        Returns:
+            An array of shape (samples, classes) for a forest with a single output, or a list of such arrays for each
+            output.
+        """
+        # sklearn trees compare float32 features with their thresholds
+        X = np.array(X, dtype=np.float32, order="C")
+        (output_count, class_count) = self.leaf_probabilities.shape[1:]
+        probabilities = np.zeros((len(X), output_count, class_count))
+        samples_per_chunk = max(_PAIRS_PER_CHUNK // len(self.roots), 1)
+        for first_sample in range(0, len(X), samples_per_chunk):
+            samples = slice(first_sample, first_sample + samples_per_chunk)
+            leaves = self._get_leaves(X[samples])
+            # Each tree adds the leaf probabilities of every sample once, in the order of the trees
+            for tree in range(len(self.roots)):
+                probabilities[samples] += np.take(self.leaf_probabilities, leaves[:, tree], axis=0)
+        probabilities /= len(self.roots)
+
+        if output_count == 1:
+            return probabilities[:, 0, :self.class_counts[0]]
+        return [probabilities[:, output, :output_class_count]
+                for (output, output_class_count) in enumerate(self.class_counts)]
+
+    def _get_leaves(self, X):
+        """Returns a samples x trees array with the leaf each sample ends in in each tree."""
+        (sample_count, feature_count) = X.shape
+        tree_count = len(self.roots)
+        nodes = np.tile(self.roots, sample_count)
+        leaves = nodes.copy()
+        pairs = np.arange(len(nodes))
+        row_offsets = np.repeat(np.arange(0, sample_count * feature_count, feature_count), tree_count)
+        X_flat = X.ravel()
+        children_flat = self.children.ravel()
+        for _ in range(self.max_depth):
+            goes_right = ~(X_flat[row_offsets + self.features[nodes]] <= self.thresholds[nodes])
+            nodes = children_flat[2 * nodes + goes_right]
+            leaves[pairs] = nodes
+            # The walks that reached a leaf are dropped, most end well above the depth of the deepest leaf
+            is_walking = self.children[nodes, 0] != nodes
+            (pairs, nodes, row_offsets) = (pairs[is_walking], nodes[is_walking], row_offsets[is_walking])
+        return leaves.reshape(sample_count, tree_count)
+
+
+def compile_forest(forest):
+    """Flattens a fitted sklearn RandomForestClassifier into a CompiledForest.
+
+    Args:
+        forest: A fitted sklearn RandomForestClassifier with one or more outputs.
+
+    Returns:
+        A CompiledForest that predicts the same probabilities as the forest.
+    """
+    class_counts = np.atleast_1d(forest.n_classes_).astype(np.intp)
+    trees = [estimator.tree_ for estimator in forest.estimators_]
+    node_counts = np.array([tree.node_count for tree in trees])
+    roots = np.concatenate([[0], np.cumsum(node_counts)[:-1]])
+
+    features = np.zeros(node_counts.sum(), dtype=np.int32)
+    thresholds = np.full(node_counts.sum(), np.inf, dtype=np.float32)
+    children = np.empty((node_counts.sum(), 2), dtype=np.int32)
+    leaf_probabilities = np.zeros((node_counts.sum(), len(class_counts), class_counts.max()))
+    for (tree, root) in zip(trees, roots):
+        nodes = np.arange(root, root + tree.node_count)
+        is_leaf = tree.children_left == _TREE_LEAF
+        features[nodes[~is_leaf]] = tree.feature[~is_leaf]
+        thresholds[nodes[~is_leaf]] = get_float32_thresholds(tree.threshold[~is_leaf])
+        children[nodes, 0] = np.where(is_leaf, nodes, root + tree.children_left)
+        children[nodes, 1] = np.where(is_leaf, nodes, root + tree.children_right)
+        for (output, class_count) in enumerate(class_counts):
+            leaf_probabilities[nodes, output, :class_count] = get_leaf_probabilities(tree, output, class_count)
+
+    return CompiledForest(features=features,
+                          thresholds=thresholds,
+                          children=children,
+                          leaf_probabilities=leaf_probabilities,
+                          roots=roots.astype(np.int32),
+                          max_depth=max(tree.max_depth for tree in trees),
+                          class_counts=class_counts)
+
+
+def get_float32_thresholds(thresholds):
+    """Returns the largest float32 that is less than or equal to each float64 threshold. A float32 feature is less than
+    or equal to a threshold exactly when it is less than or equal to the rounded threshold, so the trees split the same
+    way with either."""
+    float32_thresholds = thresholds.astype(np.float32)
+    is_rounded_up = float32_thresholds > thresholds
+    float32_thresholds[is_rounded_up] = np.nextafter(float32_thresholds[is_rounded_up], np.float32(-np.inf))
+    return float32_thresholds
+
+
+def get_leaf_probabilities(tree, output, class_count):
+    """Returns the class probabilities of each node of a fitted sklearn tree for an output, the way
+    DecisionTreeClassifier.predict_proba computes them for the samples that end in the node."""
+    # Older versions of sklearn store the weighted class counts of the nodes and DecisionTreeClassifier.predict_proba
+    # normalizes them, newer versions store the class fractions and return them as they are
+    leaf_probabilities = tree.value[:, output, :class_count].copy()
+    normalizer = leaf_probabilities.sum(axis=1)[:, np.newaxis]
+    if not np.allclose(normalizer, 1.0):
+        normalizer[normalizer == 0.0] = 1.0
+        leaf_probabilities /= normalizer
+    return leaf_probabilities
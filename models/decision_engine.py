@@ -1,3 +1,6 @@
+import numpy as np
+import pandas as pd
+
 
 class DecisionEngine(object):
     """Provides lasix treatment recommendations based on patient data.
@@ -30,26 +33,22 @@ class DecisionEngine(object):
     def get_treatment_suggestion(self, prediction_df):
         # Remove treatment column from prediction_df since we will be cross referencing all valid treatments
         # with each patient feature.
-        prediction_df = prediction_df.drop('treatment', axis=1).copy()
-        # Add a sample_id column to the dataframe to be able to reconcile treatment recommendations with
-        # the patient feature they are for.
-        prediction_df['sample_id'] = range(len(prediction_df))
-
-        # Get all valie treatments for each sample_id
-        treatments_per_sample_id = self._actual_treatment_predictor.get_possible_treatments(prediction_df)
-        # Cross reference all patient features with valid treatements for the features
-        expanded_prediction_df = prediction_df.merge(treatments_per_sample_id, on="sample_id")
-
-        # Add the probability of survival for each row
-        expanded_prediction_df['probability_of_living'] = \
-            self._outcome_predictor.get_probability_of_survival(expanded_prediction_df)
-
-        # Keep only one record per sample_id. The record kept is the one with the highest probability.
-        rows_with_best_probability = \
-            self._get_rows_with_best_probility_for_sample_id(expanded_prediction_df)
-        # Return only the treatment and probability_of_living. The returned dataframe can be matched with
-        # the input dataframe by row position.
-        return rows_with_best_probability[['treatment', 'probability_of_living']]
+        prediction_df = prediction_df.drop('treatment', axis=1)
+
+        # Get all valid treatments for each sample. A sample_id is the position of the patient features in
+        # prediction_df.
+        possible_treatments = self._actual_treatment_predictor.get_possible_treatment_codes(prediction_df)
+        # Get the probability of survival for each patient feature with every treatment. The patient features are
+        # scored with all of the treatments at once rather than once per combination.
+        probability_of_living_by_treatment = self._outcome_predictor.get_probability_of_survival_by_treatment(
+            prediction_df, possible_treatments.treatments)
+
+        # Keep only one treatment per sample_id. The treatment kept is the one with the highest probability. The
+        # returned dataframe can be matched with the input dataframe by row position.
+        return get_best_treatment_per_sample(probability_of_living_by_treatment,
+                                             possible_treatments.sample_ids,
+                                             possible_treatments.treatment_codes,
+                                             possible_treatments.treatments)
 
     def get_probability_of_survival(self, prediction_df):
         return self._outcome_predictor.get_probability_of_survival(prediction_df)
@@ -78,7 +77,41 @@ class DecisionEngine(object):
         """
         return self._outcome_predictor.get_feature_importance()
 
-    def _get_rows_with_best_probility_for_sample_id(self, df):
-        max_idx = df.groupby('sample_id').apply(lambda x: x['probability_of_living'].idxmax())
-        df.reset_index(level=0, inplace=True, drop=True)
-        return df.ix[max_idx]
+
+def get_best_treatment_per_sample(probability_of_living_by_treatment, sample_ids, treatment_codes, treatments):
+    """Selects the treatment with the highest probability of living for each sample.
+
+    The possible treatments of the samples are a mask over the samples x treatments matrix of probabilities, and the
+    best treatment of every sample is found with one masked argmax over the rows. Ties are resolved in favor of the
+    treatment that comes first in treatments, like idxmax over the possible treatments in treatment code order.
+    Treatments with a NaN probability of living are never selected.
+
+    Args:
+        probability_of_living_by_treatment: A samples x treatments array with the probability of living of each sample
+        with each treatment.
+        sample_ids: The sample of each possible treatment.
+        treatment_codes: The treatment code of each possible treatment, a column of probability_of_living_by_treatment.
+        treatments: The treatment of each treatment code.
+
+    Returns:
+        A dataframe with a row for each sample, in sample order, with the following columns:
+        treatment: The possible treatment with the highest probability of living, NaN if the sample has no possible
+        treatments with a probability.
+        probability_of_living: The probability of living with that treatment, NaN if the sample has no possible
+        treatments with a probability.
+    """
+    is_possible = np.zeros(probability_of_living_by_treatment.shape, dtype=bool)
+    is_possible[sample_ids, treatment_codes] = True
+    is_possible &= ~np.isnan(probability_of_living_by_treatment)
+
+    # argmax returns the first of the columns with the highest probability
+    best_treatment_codes = np.where(is_possible, probability_of_living_by_treatment, -np.inf).argmax(axis=1)
+    has_possible_treatment = is_possible.any(axis=1)
+    best_probabilities = \
+        probability_of_living_by_treatment[np.arange(len(best_treatment_codes)), best_treatment_codes]
+
+    return pd.DataFrame({
+        "treatment": np.where(has_possible_treatment,
+                              np.asarray(treatments, dtype=object)[best_treatment_codes], np.nan),
+        "probability_of_living": np.where(has_possible_treatment, best_probabilities, np.nan)
+    })
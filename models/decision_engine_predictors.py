@@ -1,12 +1,26 @@
+from collections import namedtuple
+
+import numpy as np
 import pandas as pd
 
+from sklearn.ensemble import RandomForestClassifier
 from sklearn.pipeline import Pipeline
 from sklearn.cross_validation import train_test_split
 from sklearn.metrics import accuracy_score
 from sklearn.preprocessing import LabelBinarizer
 
+from models.compiled_forest import compile_forest
+from models.forest_treatment_scorer import get_forest_probabilities_by_treatment
 from models.save_file_helper import save_debugging_file
 
+# The largest number of rows that is scored by the compiled forest, sklearn walks larger batches faster
+_MAX_COMPILED_BATCH_SIZE = 256
+
+# The possible treatments of samples, with an entry in sample_ids, treatment_codes and probabilities for each possible
+# treatment of a sample. A treatment code is the position of the treatment in treatments, and the probability is the
+# probability that the patient was given the treatment.
+PossibleTreatments = namedtuple("PossibleTreatments", ["sample_ids", "treatment_codes", "probabilities", "treatments"])
+
 
 class _BasePredictor(object):
     """Provides shared functionally used by OutcomePredictor and ActualTreatmentPredictor"""
@@ -24,6 +38,7 @@ class _BasePredictor(object):
 
         self._prediction_model = prediction_model
         self._preprocessor = preprocessor
+        self._compiled_prediction_model = None
 
         self._pipeline = \
             Pipeline([('preprocess', preprocessor), ('predictor', prediction_model)])
@@ -42,6 +57,8 @@ class _BasePredictor(object):
         X_train, X_test, y_train, y_test = train_test_split(data, y, test_size=0.3)
 
         self._pipeline.fit(X_train, y_train)
+        if isinstance(self._prediction_model, RandomForestClassifier):
+            self._compiled_prediction_model = compile_forest(self._prediction_model)
 
         train_pred = self._pipeline.predict(X_train)
         print("%s train accuracy %.5f" % (class_name, accuracy_score(train_pred, y_train)))
@@ -83,6 +100,15 @@ class _BasePredictor(object):
         raw_feature_importance = self._prediction_model.feature_importances_
         return self._preprocessor.transform_feature_importance(raw_feature_importance)
 
+    def _predict_proba(self, X):
+        """Returns the class probabilities the prediction model predicts for preprocessed features. Small batches are
+        scored by the CompiledForest of a random forest, which avoids the fixed cost of calling sklearn."""
+        # Predictors pickled before their forest was compiled do not have a compiled prediction model
+        compiled_prediction_model = getattr(self, "_compiled_prediction_model", None)
+        if compiled_prediction_model is None or len(X) > _MAX_COMPILED_BATCH_SIZE:
+            return self._prediction_model.predict_proba(X)
+        return compiled_prediction_model.predict_proba(X)
+
     def _checked_is_trained(self):
         if not self._is_trained:
             raise ValueError("Not trained")
@@ -111,7 +137,47 @@ class OutcomePredictor(_BasePredictor):
 
         """
         self._checked_is_trained()
-        return pd.Series([prob[0] for prob in self._pipeline.predict_proba(data)])
+        return pd.Series(self._predict_proba(self._preprocessor.transform(data))[:, 0])
+
+    def get_probability_of_survival_for_treatments(self, data, sample_ids, treatments):
+        """Returns the probability that the patient survived for combinations of rows in the dataframe with candidate
+        treatments. Each row is preprocessed once no matter how many candidates it has.
+
+        Args:
+            data: Dataframe containing patient features.
+            sample_ids: The position in data of the row of each candidate.
+            treatments: The treatment of each candidate.
+
+        Returns:
+            A series where the nth entry is the probability of survival for the nth candidate.
+
+        """
+        self._checked_is_trained()
+        X = self._preprocessor.transform_treatment_candidates(data, sample_ids, treatments)
+        return pd.Series(self._predict_proba(X)[:, 0])
+
+    def get_probability_of_survival_by_treatment(self, data, treatments):
+        """Returns the probability that the patient survived for every row in the dataframe combined with every
+        treatment. Each row is preprocessed once, and a random forest walks each of its trees once per distinct path
+        the treatments of a row take rather than once per treatment.
+
+        Args:
+            data: Dataframe containing patient features.
+            treatments: The distinct treatments.
+
+        Returns:
+            An array where the entry in the nth row and mth column is the probability of survival for the nth row in
+            the dataframe with the mth treatment.
+
+        """
+        self._checked_is_trained()
+        if not isinstance(self._prediction_model, RandomForestClassifier):
+            sample_ids = np.repeat(np.arange(len(data)), len(treatments))
+            return self.get_probability_of_survival_for_treatments(data, sample_ids, np.tile(treatments, len(data))) \
+                .values.reshape(len(data), len(treatments))
+
+        (X, encoded_treatments) = self._preprocessor.transform_by_treatment(data, treatments)
+        return get_forest_probabilities_by_treatment(self._prediction_model, X, encoded_treatments)[:, :, 0]
 
     def _get_outcome_data_for_training(self, data):
         return data.died.values
@@ -150,50 +216,64 @@ class ActualTreatmentPredictor(_BasePredictor):
         """Returns the most likely treatments for a patient.
 
         Args:
-            data: A dataframe containing patient features as well as a sample_id column. The sample_id column
-            is needed because there can be many most likely treatments for a sample_id and the column is used
-            to reconcile the treatment with the record.
+            data: A dataframe containing patient features.
 
         Returns:
-            A dataframe with the following columns:
-            sample_id: The sample_id the treatment is for.
+            A dataframe with a row for each possible treatment of a sample, sorted by sample_id and treatment_code, with
+            the following columns:
+            sample_id: The position of the row in data the treatment is for.
             treatment: The treatment category
+            probability_of_treatment: The probability that the patient was given the treatment.
+
+        """
+        possible_treatments = self.get_possible_treatment_codes(data)
+        return pd.DataFrame({
+            "sample_id": possible_treatments.sample_ids,
+            "treatment": possible_treatments.treatments[possible_treatments.treatment_codes],
+            "probability_of_treatment": possible_treatments.probabilities
+        })
+
+    def get_possible_treatment_codes(self, data):
+        """Returns the most likely treatments for a patient as arrays of treatment codes, see get_possible_treatments.
+
+        Args:
+            data: A dataframe containing patient features.
+
+        Returns:
+            A PossibleTreatments for the rows of data.
 
         """
         self._checked_is_trained()
 
-        # leave comment on structure
-        probabilities_sectioned_by_treatment = self._pipeline.predict_proba(data)
-        ordered_treatments = self._treatment_label_binarizer.classes_
-        treatment_dfs = []
-
-        for (treatment, probabilities_for_treatment) in zip(ordered_treatments, probabilities_sectioned_by_treatment):
-            probability_of_treatment = [prob[1] if len(prob) > 1 else 0 for prob in probabilities_for_treatment]
-            df = pd.DataFrame({
-                "treatment": treatment,
-                "probability_of_treatment": probability_of_treatment,
-                "sample_id": range(len(probability_of_treatment))
-            })
-            treatment_dfs.append(df)
-
-        combined_df = pd.concat(treatment_dfs)
-
-        # Get all treatments that have a probability greater than the threshold
-        sample_with_high_probability = \
-            combined_df[combined_df.probability_of_treatment > self._recommendation_probability_threshold]
-
-        # Get the top probability for a sample_id. This treatment will be used if there is no treatment for the
-        # sample_id greater than the threshold
-        top_treatment_per_sample_id = combined_df.groupby("sample_id")["probability_of_treatment"].nlargest(
-            1).reset_index().drop('level_1', axis=1)
-
-        # Find top treatments for samples that have not treatment above the threshold. This is a rare case but can
-        # happen.
-        samples_ids_with_high_prob = set(sample_with_high_probability.sample_id.unique())
-        all_sample_ids = set(combined_df.sample_id.unique())
-        ids_not_in_high_prob = all_sample_ids - samples_ids_with_high_prob
-
-        top_treatments_for_samples_missing_high_prob =\
-            top_treatment_per_sample_id[top_treatment_per_sample_id.sample_id.isin(ids_not_in_high_prob)]
-
-        return pd.concat([sample_with_high_probability, top_treatments_for_samples_missing_high_prob])
+        # predict_proba returns an array for each treatment with the probability of each sample not having and having
+        # the treatment. Treatments that were never given in the training data only have the first column.
+        probabilities_sectioned_by_treatment = self._predict_proba(self._preprocessor.transform(data))
+        probability_of_treatment = np.column_stack(
+            [probabilities[:, 1] if probabilities.shape[1] > 1 else np.zeros(len(probabilities))
+             for probabilities in probabilities_sectioned_by_treatment])
+
+        (sample_ids, treatment_codes) = \
+            select_possible_treatments(probability_of_treatment, self._recommendation_probability_threshold)
+        return PossibleTreatments(sample_ids=sample_ids,
+                                  treatment_codes=treatment_codes,
+                                  probabilities=probability_of_treatment[sample_ids, treatment_codes],
+                                  treatments=self._treatment_label_binarizer.classes_)
+
+
+def select_possible_treatments(probability_of_treatment, recommendation_probability_threshold):
+    """Selects the treatments that have a higher probability than the threshold for each sample. The treatment with
+    the highest probability is selected for samples that have no treatment above the threshold, this is a rare case
+    but can happen.
+
+    Args:
+        probability_of_treatment: A samples x treatments array with the probability of each treatment.
+        recommendation_probability_threshold: The probability threshold that a possible treatment needs to have a
+        higher probability than.
+
+    Returns:
+        A tuple of arrays with the sample and the treatment of each possible treatment, sorted by sample and treatment.
+    """
+    is_possible = probability_of_treatment > recommendation_probability_threshold
+    has_no_possible_treatment = ~is_possible.any(axis=1)
+    is_possible[has_no_possible_treatment, probability_of_treatment[has_no_possible_treatment].argmax(axis=1)] = True
+    return np.nonzero(is_possible)
@@ -0,0 +1,108 @@
+import numpy as np
+
+from models.compiled_forest import get_leaf_probabilities
+
+# The child of a leaf node in a fitted sklearn tree
+_TREE_LEAF = -1
+
+# The treatments are scored in groups whose members are the bits of an unsigned 64 bit integer
+_MAX_TREATMENTS_PER_GROUP = 64
+
+
+def get_forest_probabilities_by_treatment(forest, X, encoded_treatments):
+    """Returns the class probabilities a random forest predicts for every sample combined with every treatment, walking
+    each tree once per distinct path the treatments of a sample take instead of once per treatment.
+
+    Only the encoded treatment differs between the combinations of a sample, so the treatments only take different
+    paths through a tree at nodes that split on a treatment column. Every node has the set of treatments that those
+    nodes send down its path. A walk of the tree with one treatment therefore also scores all the treatments in the set
+    of the leaf it ends in, and the sample is only walked again for the treatments that are not in that set. The walks
+    are done by the compiled DecisionTreeClassifier.apply.
+
+    The probabilities are computed with the same operations, in the same order, as forest.predict_proba, so they are
+    equal to it when the trees are accumulated in order.
+
+    Args:
+        forest: A fitted sklearn RandomForestClassifier with a single output.
+        X: The preprocessed features of each sample. The treatment is encoded in the first columns, which are ignored.
+        encoded_treatments: An array with the encoding of each treatment, replacing the first columns of X.
+
+    Returns:
+        An array of shape (samples, treatments, classes) where the entry for a sample and treatment is the result of
+        forest.predict_proba for the features of the sample with the encoding of the treatment.
+    """
+    # sklearn trees compare float32 features with float64 thresholds
+    X = np.array(X, dtype=np.float32, order="C")
+    encoded_treatments = np.asarray(encoded_treatments, dtype=np.float32)
+
+    probabilities = np.zeros((len(X), len(encoded_treatments), forest.n_classes_))
+    leaves = np.empty((len(X), len(encoded_treatments)), dtype=np.intp)
+    for estimator in forest.estimators_:
+        for first_treatment in range(0, len(encoded_treatments), _MAX_TREATMENTS_PER_GROUP):
+            treatments = slice(first_treatment, first_treatment + _MAX_TREATMENTS_PER_GROUP)
+            _set_leaves_by_treatment(estimator, X, encoded_treatments[treatments], leaves[:, treatments])
+        # Each tree adds the leaf probabilities of every sample and treatment once, in the order of the trees
+        probabilities += np.take(get_leaf_probabilities(estimator.tree_, 0, forest.n_classes_), leaves, axis=0)
+    probabilities /= len(forest.estimators_)
+    return probabilities
+
+
+def _set_leaves_by_treatment(estimator, X, encoded_treatments, leaves):
+    """Sets the leaves array to the leaf of the tree that each sample ends in with each of at most
+    _MAX_TREATMENTS_PER_GROUP treatments. The treatment columns of X are overwritten."""
+    (treatment_count, treatment_width) = encoded_treatments.shape
+    treatment_bits = np.left_shift(np.uint64(1), np.arange(treatment_count, dtype=np.uint64))
+    leaf_treatment_bits = _get_node_treatment_bits(estimator.tree_, encoded_treatments)
+
+    # Every sample is walked with the first treatment, which scores the treatments that end in the same leaf
+    X[:, :treatment_width] = encoded_treatments[0]
+    walked_leaves = estimator.apply(X, check_input=False)
+    leaves[:] = walked_leaves[:, np.newaxis]
+    unscored_bits = ~leaf_treatment_bits[walked_leaves] & np.bitwise_or.reduce(treatment_bits)
+
+    # The samples are walked again with their first unscored treatment until every treatment is scored
+    samples = np.flatnonzero(unscored_bits)
+    unscored_bits = unscored_bits[samples]
+    paths = []
+    while len(samples):
+        # The lowest set bit of a mask is a power of two, which a float64 represents exactly
+        lowest_bits = unscored_bits & (~unscored_bits + np.uint64(1))
+        X_walked = np.take(X, samples, axis=0)
+        X_walked[:, :treatment_width] = encoded_treatments[np.log2(lowest_bits.astype(np.float64)).astype(np.intp)]
+        walked_leaves = estimator.apply(X_walked, check_input=False)
+
+        scored_bits = unscored_bits & leaf_treatment_bits[walked_leaves]
+        paths.append((samples, walked_leaves, scored_bits))
+        unscored_bits &= ~scored_bits
+        is_unscored = unscored_bits != 0
+        (samples, unscored_bits) = (samples[is_unscored], unscored_bits[is_unscored])
+
+    if paths:
+        (samples, walked_leaves, scored_bits) = [np.concatenate(arrays) for arrays in zip(*paths)]
+        for treatment in range(treatment_count):
+            is_scored = (scored_bits & treatment_bits[treatment]) != 0
+            leaves[samples[is_scored], treatment] = walked_leaves[is_scored]
+
+
+def _get_node_treatment_bits(tree, encoded_treatments):
+    """Returns a bit mask for each node of the tree with the treatments that the nodes splitting on a treatment column
+    send down the path to the node."""
+    (treatment_count, treatment_width) = encoded_treatments.shape
+    internal_nodes = np.flatnonzero(tree.children_left != _TREE_LEAF)
+    features = tree.feature[internal_nodes]
+    splits_on_treatment = features < treatment_width
+    goes_left = \
+        encoded_treatments[:, np.minimum(features, treatment_width - 1)] <= tree.threshold[internal_nodes]
+
+    (left_bits, right_bits) = (np.zeros(len(internal_nodes), dtype=np.uint64),
+                               np.zeros(len(internal_nodes), dtype=np.uint64))
+    for treatment in range(treatment_count):
+        left_bits |= (goes_left[treatment] | ~splits_on_treatment).astype(np.uint64) << np.uint64(treatment)
+        right_bits |= (~goes_left[treatment] | ~splits_on_treatment).astype(np.uint64) << np.uint64(treatment)
+
+    # The masks are passed down one level of the tree at a time
+    node_bits = np.full(tree.node_count, (1 << treatment_count) - 1, dtype=np.uint64)
+    for _ in range(tree.max_depth):
+        node_bits[tree.children_left[internal_nodes]] = node_bits[internal_nodes] & left_bits
+        node_bits[tree.children_right[internal_nodes]] = node_bits[internal_nodes] & right_bits
+    return node_bits
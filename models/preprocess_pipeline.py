@@ -15,6 +15,11 @@ _CATEGORY_FIELDS = ['sex']
 
 _SCALAR_FIELDS = ALL_CHART_ITEM_FIELDS + ALL_LAB_ITEM_FIELDS + ["age"]
 
+# The patient feature columns used by the preprocessor, the categorical ones and the scalar ones
+CATEGORY_FEATURE_FIELDS = [_TREATMENT_FIELD] + _CATEGORY_FIELDS
+
+SCALAR_FEATURE_FIELDS = _SCALAR_FIELDS
+
 class CongestiveHeartFailurePreprocessor(object):
     """Prepares the congestive heart failure data to be used with a machine learning model, as well as
     provides functionality to relate feature importance back to the preprocessed field name.
@@ -52,6 +57,57 @@ class CongestiveHeartFailurePreprocessor(object):
     def transform(self, X):
         return self._pipeline.transform(X)
 
+    def transform_treatment_candidates(self, X, sample_ids, treatments):
+        """Transforms rows of X combined with candidate treatments. The result is the same as transforming a copy of
+        the row of each candidate with the treatment replaced, but each row of X is only transformed once.
+
+        Args:
+            X: A dataframe containing patient features. The treatment column is ignored.
+            sample_ids: The position in X of the row of each candidate.
+            treatments: The treatment of each candidate.
+
+        Returns:
+            An array with the transformed features of each candidate.
+
+        Raises:
+            ValueError: If the treatment is not used as a predictor.
+        """
+        all_treatments = pd.Index(pd.unique(treatments))
+        (features, encoded_treatments) = self.transform_by_treatment(X, all_treatments.values)
+        treatment_width = encoded_treatments.shape[1]
+        return np.hstack([encoded_treatments[all_treatments.get_indexer(treatments)],
+                          features[sample_ids, treatment_width:]])
+
+    def transform_by_treatment(self, X, treatments):
+        """Transforms the rows of X and the treatments separately, so that the rows can be combined with any of the
+        treatments without transforming them again.
+
+        Only the one hot encoded treatment, which comes first in the transformed features, differs between the
+        treatments. Replacing the first columns of a transformed row with the encoding of a treatment gives the same
+        features as transforming the row with that treatment.
+
+        Args:
+            X: A dataframe containing patient features. The treatment column is ignored.
+            treatments: The distinct treatments.
+
+        Returns:
+            A tuple of the transformed features of each row of X, with an arbitrary treatment encoded in the first
+            columns, and an array with the encoding of each treatment.
+
+        Raises:
+            ValueError: If the treatment is not used as a predictor.
+        """
+        if _TREATMENT_FIELD not in self._all_category_fields:
+            raise ValueError("The preprocessor does not use the treatment as a predictor")
+        treatment_binarizer = self._label_binarizer_by_field_name[_TREATMENT_FIELD]
+        treatment_width = treatment_binarizer.transform(treatment_binarizer.classes_[:1]).shape[1]
+
+        # Missing treatments are imputed by the pipeline, so the encodings are transformed by it as well
+        encoded_treatments = self.transform(
+            X.iloc[np.zeros(len(treatments), dtype=int)].assign(**{_TREATMENT_FIELD: treatments}))
+        features = self.transform(X.assign(**{_TREATMENT_FIELD: treatment_binarizer.classes_[0]}))
+        return features, encoded_treatments[:, :treatment_width]
+
     def transform_feature_importance(self, raw_feature_importance):
         len_of_categories = [len(self._label_binarizer_by_field_name[name].classes_)
                              for name in self._all_category_fields]
@@ -0,0 +1,291 @@
+import json
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from numbers import Number
+
+import numpy as np
+import pandas as pd
+
+from models.preprocess_pipeline import CATEGORY_FEATURE_FIELDS, SCALAR_FEATURE_FIELDS
+
+# The number of most recent requests and batches that the latency percentiles and batch sizes are computed from
+_STATS_SAMPLE_SIZE = 10000
+
+
+class MicroBatcher(object):
+    """Combines concurrent treatment suggestion requests into batches for DecisionEngine.get_treatment_suggestion, so
+    that the fixed cost of a call is shared by the requests that arrive close together.
+
+    Each worker thread takes the oldest waiting request and adds the requests that arrive until batch_window seconds
+    after it was submitted, or until the batch has max_batch_size requests, before it gets the suggestions of the batch.
+    Other workers start their batches while a batch is being processed. If a batch fails, it is split in half and the
+    halves are processed again, so that only the requests that fail on their own get the error.
+
+    Example:
+        batcher = MicroBatcher(get_decision_engine(get_ml_data()), batch_window=0.005, workers=2)
+        batcher.get_treatment_suggestion({"age": 71, "sex": "M", "treatment": None, ...})
+    """
+
+    def __init__(self, decision_engine, batch_window=0.005, max_batch_size=256, workers=1):
+        """
+        Args:
+            decision_engine: The trained DecisionEngine.
+            batch_window: The number of seconds a request may wait for other requests to join its batch.
+            max_batch_size: The maximum number of requests in a batch.
+            workers: The number of threads that process batches.
+        """
+        self._decision_engine = decision_engine
+        self._batch_window = batch_window
+        self._max_batch_size = max_batch_size
+
+        self._requests = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._latencies = deque(maxlen=_STATS_SAMPLE_SIZE)
+        self._batch_sizes = deque(maxlen=_STATS_SAMPLE_SIZE)
+        self._completed_count = 0
+        self._failed_count = 0
+        self._first_submitted = None
+        self._last_completed = None
+
+        self._workers = [threading.Thread(target=self._process_requests, daemon=True) for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, features):
+        """Queues a treatment suggestion request for the features of a patient day.
+
+        Args:
+            features: A dict from feature name to value, see validate_features.
+
+        Returns:
+            A Future that resolves to a dict with the suggested treatment and its probability_of_living.
+        """
+        future = Future()
+        submitted = time.perf_counter()
+        with self._stats_lock:
+            self._first_submitted = self._first_submitted or submitted
+        self._requests.put((submitted, features, future))
+        return future
+
+    def get_treatment_suggestion(self, features, timeout=None):
+        """Returns the suggested treatment for the features of a patient day once its batch is processed, see
+        submit."""
+        return self.submit(features).result(timeout)
+
+    def get_stats(self):
+        """Returns a dict with the following statistics of the requests processed so far, including the failed requests:
+        requests: The number of requests processed.
+        failed_requests: The number of requests that failed.
+        requests_per_second: The throughput from the first request submitted to the last request processed.
+        latency_p50_ms, latency_p95_ms, latency_p99_ms: Percentiles of the time from submitting a request to its result,
+        in milliseconds, over the most recent requests.
+        mean_batch_size: The mean number of requests in the most recent batches.
+        """
+        with self._stats_lock:
+            latencies = np.array(self._latencies)
+            batch_sizes = np.array(self._batch_sizes)
+            completed_count = self._completed_count
+            failed_count = self._failed_count
+            elapsed = (self._last_completed - self._first_submitted) if completed_count else None
+
+        stats = {
+            "requests": completed_count,
+            "failed_requests": failed_count,
+            "requests_per_second": completed_count / elapsed if elapsed else None,
+            "mean_batch_size": float(batch_sizes.mean()) if len(batch_sizes) else None
+        }
+        for percentile in [50, 95, 99]:
+            stats["latency_p%d_ms" % percentile] = \
+                1000 * float(np.percentile(latencies, percentile)) if len(latencies) else None
+        return stats
+
+    def close(self):
+        """Stops the workers once the queued requests are processed."""
+        for _ in self._workers:
+            self._requests.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _process_requests(self):
+        is_closed = False
+        while not is_closed:
+            request = self._requests.get()
+            if request is None:
+                return
+            batch = [request]
+            deadline = request[0] + self._batch_window
+            while len(batch) < self._max_batch_size:
+                try:
+                    request = self._requests.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    is_closed = True
+                    break
+                batch.append(request)
+            self._process_batch(batch)
+
+    def _process_batch(self, batch):
+        with self._stats_lock:
+            self._batch_sizes.append(len(batch))
+        self._process_requests_together(batch)
+
+    def _process_requests_together(self, requests):
+        try:
+            suggestions = self._decision_engine.get_treatment_suggestion(
+                get_feature_frame([features for (_, features, _) in requests]))
+        except Exception as e:
+            # The requests are retried in halves until the requests that fail on their own are found
+            if len(requests) > 1:
+                middle = len(requests) // 2
+                self._process_requests_together(requests[:middle])
+                self._process_requests_together(requests[middle:])
+                return
+            logging.exception("Treatment suggestion failed for a request")
+            requests[0][2].set_exception(e)
+            self._record_completed(requests, failed=True)
+            return
+
+        for ((_, _, future), treatment, probability_of_living) in \
+                zip(requests, suggestions.treatment.values, suggestions.probability_of_living.values):
+            future.set_result({
+                "treatment": None if pd.isnull(treatment) else treatment,
+                "probability_of_living": None if pd.isnull(probability_of_living) else float(probability_of_living)
+            })
+        self._record_completed(requests, failed=False)
+
+    def _record_completed(self, requests, failed):
+        completed = time.perf_counter()
+        with self._stats_lock:
+            self._latencies.extend(completed - submitted for (submitted, _, _) in requests)
+            self._completed_count += len(requests)
+            self._failed_count += len(requests) if failed else 0
+            self._last_completed = completed
+
+
+def validate_features(features):
+    """Checks the features of a patient day in a request. Features that are not given are missing values, which the
+    preprocessors impute.
+
+    Args:
+        features: A dict from feature name to value. The scalar features are numbers, the categorical features, sex
+        and treatment, are strings. Any feature can be None.
+
+    Raises:
+        ValueError: If the features are not a dict, a feature is unknown or a value has the wrong type.
+    """
+    if not isinstance(features, dict):
+        raise ValueError("The features must be an object from feature name to value")
+    unknown_fields = set(features) - set(CATEGORY_FEATURE_FIELDS) - set(SCALAR_FEATURE_FIELDS)
+    if unknown_fields:
+        raise ValueError("Unknown features: %s" % ", ".join(sorted(unknown_fields)))
+    for (field, value) in features.items():
+        expected_type = str if field in CATEGORY_FEATURE_FIELDS else Number
+        if value is not None and (not isinstance(value, expected_type) or isinstance(value, bool)):
+            raise ValueError("The value of %s must be a %s or null" %
+                             (field, "string" if expected_type is str else "number"))
+
+
+def get_feature_frame(features):
+    """Returns a dataframe with a row for the features of each patient day, as dicts validated by validate_features,
+    and a column for every feature the preprocessors use."""
+    feature_frame = pd.DataFrame.from_records(features).reindex(columns=CATEGORY_FEATURE_FIELDS + SCALAR_FEATURE_FIELDS)
+    feature_frame[SCALAR_FEATURE_FIELDS] = feature_frame[SCALAR_FEATURE_FIELDS].astype(float)
+    return feature_frame
+
+
+def get_content_length(headers):
+    """Returns the length of the body of a request from its Content-Length header.
+
+    Raises:
+        ValueError: If the header is missing, negative or not an integer.
+    """
+    content_length = headers.get("Content-Length")
+    if content_length is None:
+        raise ValueError("The Content-Length header is required")
+    if not content_length.strip().isdecimal():
+        raise ValueError("The Content-Length header must be a non-negative integer")
+    return int(content_length)
+
+
+class RecommendationServer(ThreadingHTTPServer):
+    """An HTTP server for treatment suggestions. Each connection is handled by a thread that waits for its requests to
+    be processed by the batcher.
+
+    POST /recommendation with the features of a patient day as a JSON object, see validate_features, returns a JSON
+    object with the suggested treatment and its probability_of_living. GET /stats returns MicroBatcher.get_stats as a
+    JSON object.
+    """
+    daemon_threads = True
+    # Clients that connect at the same time wait to be accepted instead of having their connections refused
+    request_queue_size = 128
+
+    def __init__(self, batcher, host="127.0.0.1", port=8000):
+        super().__init__((host, port), _RecommendationRequestHandler)
+        self.batcher = batcher
+
+
+class _RecommendationRequestHandler(BaseHTTPRequestHandler):
+    # Keeps connections open between requests, so that clients do not connect for every request
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        try:
+            content_length = get_content_length(self.headers)
+        except ValueError as e:
+            # The body is not read, so the connection cannot be used for another request
+            self.close_connection = True
+            self._send_json(400, {"error": str(e)})
+            return
+        body = self.rfile.read(content_length)
+        if self.path != "/recommendation":
+            self._send_json(404, {"error": "Not found"})
+            return
+        try:
+            features = json.loads(body.decode("utf-8"))
+            validate_features(features)
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        try:
+            self._send_json(200, self.server.batcher.get_treatment_suggestion(features))
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+
+    def do_GET(self):
+        if self.path != "/stats":
+            self._send_json(404, {"error": "Not found"})
+            return
+        self._send_json(200, self.server.batcher.get_stats())
+
+    def log_message(self, format, *args):
+        logging.debug("%s %s" % (self.address_string(), format % args))
+
+    def _send_json(self, status, content):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve_recommendations(decision_engine, host="127.0.0.1", port=8000, batch_window=0.005, max_batch_size=256,
+                          workers=1):
+    """Serves treatment suggestions over HTTP until interrupted, see RecommendationServer and MicroBatcher."""
+    batcher = MicroBatcher(decision_engine, batch_window=batch_window, max_batch_size=max_batch_size, workers=workers)
+    server = RecommendationServer(batcher, host=host, port=port)
+    logging.info("Serving treatment suggestions on http://%s:%d" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        logging.info("Served %d requests" % batcher.get_stats()["requests"])
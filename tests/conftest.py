@@ -0,0 +1,28 @@
+import pytest
+
+from data_loading import data_loaders, query_cache
+from data_loading.data_sources import SQLiteDataSource
+from data_loading.synthetic_mimic2 import generate_synthetic_mimic2
+from data_processing import processed_data_interface
+from data_processing.datetime_modifier import get_modify_dates_fn
+
+# Generates 50 subjects, enough for every stage of the pipeline to have rows
+_SYNTHETIC_SCALE = 0.1
+
+
+@pytest.fixture
+def synthetic_data_source(tmp_path, monkeypatch):
+    """Loads data from a small synthetic MIMIC2 database and caches processed data in a temporary directory. Query
+    results are not cached, so that changes to the database are always read.
+
+    Returns:
+        The path to the SQLite file.
+    """
+    database_path = str(tmp_path / "synthetic_mimic2.db")
+    generate_synthetic_mimic2(database_path, scale=_SYNTHETIC_SCALE)
+    monkeypatch.setattr(data_loaders, "_data_source", SQLiteDataSource(database_path))
+    monkeypatch.setattr(processed_data_interface, "_PROCESSED_DATA_DIR", str(tmp_path / "processed_data"))
+    monkeypatch.setitem(query_cache._settings, "enabled", False)
+    get_modify_dates_fn.cache_clear()
+    yield database_path
+    get_modify_dates_fn.cache_clear()
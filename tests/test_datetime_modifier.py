@@ -0,0 +1,46 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+from data_processing import datetime_modifier
+from data_processing.datetime_modifier import get_modify_dates_fn
+
+
+@pytest.fixture
+def modify_dates_fn(monkeypatch):
+    """Returns the date modifier for two subjects born in obfuscated years, offset by 600 and 1200 years."""
+    patients = pd.DataFrame({
+        "subject_id": [1, 2],
+        "dob": [datetime.datetime(2600, 1, 1), datetime.datetime(3200, 1, 1)]
+    })
+    monkeypatch.setattr(datetime_modifier, "get_patients", lambda: patients)
+    get_modify_dates_fn.cache_clear()
+    yield get_modify_dates_fn()
+    get_modify_dates_fn.cache_clear()
+
+
+def test_modify_dates_shifts_by_subject_offset(modify_dates_fn):
+    df = pd.DataFrame({
+        "subject_id": [1, 2, 2],
+        "charttime": [datetime.datetime(2650, 2, 28, 5, 30), datetime.datetime(3210, 7, 1), None]
+    })
+
+    modified = modify_dates_fn(df, ["charttime"])
+
+    assert list(modified.charttime[:2]) == [pd.Timestamp(2050, 2, 28, 5, 30), pd.Timestamp(2010, 7, 1)]
+    assert pd.isnull(modified.charttime[2])
+
+
+def test_modify_dates_rejects_subjects_without_offset(modify_dates_fn):
+    df = pd.DataFrame({"subject_id": [1, 3], "charttime": [datetime.datetime(2650, 1, 1)] * 2})
+
+    with pytest.raises(ValueError, match="subject_ids 3"):
+        modify_dates_fn(df, ["charttime"])
+
+
+def test_modify_dates_rejects_dates_outside_pandas_range(modify_dates_fn):
+    df = pd.DataFrame({"subject_id": [1], "charttime": [datetime.datetime(3205, 1, 1)]})
+
+    with pytest.raises(pd.errors.OutOfBoundsDatetime):
+        modify_dates_fn(df, ["charttime"])
@@ -0,0 +1,40 @@
+import numpy as np
+
+from models.decision_engine import get_best_treatment_per_sample
+
+_TREATMENTS = np.array(["a", "b", "c"], dtype=object)
+
+
+def test_get_best_treatment_per_sample():
+    probability_of_living_by_treatment = np.array([
+        [0.5, 0.7, 0.7],
+        [0.9, 0.9, 0.9],
+        [0.9, 0.95, 0.1]
+    ])
+
+    best = get_best_treatment_per_sample(probability_of_living_by_treatment,
+                                         sample_ids=np.array([0, 0, 0, 2, 2]),
+                                         treatment_codes=np.array([0, 1, 2, 0, 2]),
+                                         treatments=_TREATMENTS)
+
+    # Ties go to the first treatment, and treatments that are not possible for a sample are never selected
+    assert list(best.treatment.iloc[[0, 2]]) == ["b", "a"]
+    assert list(best.probability_of_living.iloc[[0, 2]]) == [0.7, 0.9]
+    # Sample 1 has no possible treatments
+    assert best.isnull().iloc[1].all()
+
+
+def test_get_best_treatment_per_sample_ignores_nan_probabilities():
+    probability_of_living_by_treatment = np.array([
+        [np.nan, 0.6, 0.9],
+        [np.nan, np.nan, 0.9]
+    ])
+
+    best = get_best_treatment_per_sample(probability_of_living_by_treatment,
+                                         sample_ids=np.array([0, 0, 1, 1]),
+                                         treatment_codes=np.array([0, 1, 0, 1]),
+                                         treatments=_TREATMENTS)
+
+    assert best.treatment.iloc[0] == "b"
+    assert best.probability_of_living.iloc[0] == 0.6
+    assert best.isnull().iloc[1].all()
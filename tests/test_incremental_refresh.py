@@ -0,0 +1,59 @@
+import os
+import sqlite3
+
+import pytest
+
+from data_processing import processed_data_interface
+from data_processing.incremental_refresh import build_ml_data_with_watermarks, refresh_ml_data
+from data_processing.ml_data_prepairer import get_ml_data, ML_DATA_FILE
+from data_processing.processed_data_interface import load_cached_data, get_cache_state, get_cache_status, CACHE_VALID
+
+
+def add_lab_event(database_path, icustay_id):
+    """Appends a copy of the latest lab event of the icustay, an hour after the latest lab event in the database, as
+    if it was just recorded."""
+    connection = sqlite3.connect(database_path)
+    try:
+        columns = [column for (_, column, _, _, _, _) in connection.execute("PRAGMA table_info(labevents)")]
+        values = ["datetime((SELECT MAX(charttime) FROM labevents), '+1 hour')" if column == "charttime" else column
+                  for column in columns]
+        connection.execute("INSERT INTO labevents (%s) SELECT %s FROM labevents WHERE icustay_id = ? "
+                           "ORDER BY charttime DESC LIMIT 1" % (", ".join(columns), ", ".join(values)),
+                           (int(icustay_id),))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def test_refresh_ml_data_uses_death_time_frame_of_dataset(synthetic_data_source):
+    build_ml_data_with_watermarks()
+    ml_data = get_ml_data(death_time_frame=7)
+    assert (ml_data.died_within_3d != ml_data.died_within_7d).any()
+
+    add_lab_event(synthetic_data_source, ml_data.icustay_id.iloc[0])
+    assert refresh_ml_data() == [ml_data.icustay_id.iloc[0]]
+
+    refreshed_ml_data = load_cached_data(ML_DATA_FILE)
+    assert (refreshed_ml_data.died == refreshed_ml_data.died_within_7d).all()
+
+
+def test_refresh_ml_data_requires_fingerprint(synthetic_data_source):
+    ml_data = build_ml_data_with_watermarks()
+    os.remove(os.path.join(processed_data_interface._PROCESSED_DATA_DIR, ML_DATA_FILE + ".fingerprint.json"))
+
+    add_lab_event(synthetic_data_source, ml_data.icustay_id.iloc[0])
+    with pytest.raises(ValueError):
+        refresh_ml_data()
+
+
+def test_refresh_ml_data_keeps_caches_valid(synthetic_data_source):
+    ml_data = build_ml_data_with_watermarks()
+
+    add_lab_event(synthetic_data_source, ml_data.icustay_id.iloc[0])
+    assert refresh_ml_data() == [ml_data.icustay_id.iloc[0]]
+
+    assert get_cache_state(ML_DATA_FILE)[0] == CACHE_VALID
+    assert (get_cache_status().state == CACHE_VALID).all()
+    # Nothing changed since the refresh
+    assert refresh_ml_data() == []
+    assert get_cache_state(ML_DATA_FILE)[0] == CACHE_VALID
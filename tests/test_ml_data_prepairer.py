@@ -0,0 +1,32 @@
+import sqlite3
+
+import pandas as pd
+
+from data_processing.ml_data_prepairer import get_ml_data
+
+
+def remove_cohort(database_path):
+    """Removes the congestive heart failure diagnoses, which select the icustays of the cohort."""
+    connection = sqlite3.connect(database_path)
+    try:
+        connection.execute("DELETE FROM icd9 WHERE code = '428.0'")
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def test_get_ml_data_runs_on_synthetic_database(synthetic_data_source):
+    ml_data = get_ml_data()
+
+    assert len(ml_data) > 0
+    assert ml_data.age.notnull().all()
+    assert ml_data.age.between(0, 120).all()
+
+
+def test_get_ml_data_out_of_core_without_icustays(synthetic_data_source):
+    remove_cohort(synthetic_data_source)
+
+    ml_data = get_ml_data(memory_budget=10 ** 8)
+
+    assert len(ml_data) == 0
+    pd.testing.assert_frame_equal(ml_data, get_ml_data(use_cache=False))
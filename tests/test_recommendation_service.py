@@ -0,0 +1,85 @@
+import threading
+from http.client import HTTPConnection
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("sklearn_pandas")
+
+from models.recommendation_service import MicroBatcher, RecommendationServer, validate_features, \
+    get_content_length
+
+# The age of the patient days that the decision engine fails to score
+_FAILING_AGE = 13
+
+
+class _DecisionEngine(object):
+    """Suggests a treatment for the patient days older than 60, and fails for a batch with a patient day of
+    _FAILING_AGE."""
+
+    def get_treatment_suggestion(self, prediction_df):
+        if (prediction_df.age == _FAILING_AGE).any():
+            raise ValueError("Failed to score")
+        return pd.DataFrame({
+            "treatment": np.where(prediction_df.age > 60, "40mg IV", None),
+            "probability_of_living": prediction_df.age / 100
+        })
+
+
+@pytest.fixture
+def batcher():
+    batcher = MicroBatcher(_DecisionEngine(), batch_window=0.05)
+    yield batcher
+    batcher.close()
+
+
+@pytest.fixture
+def server_port(batcher):
+    server = RecommendationServer(batcher, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def test_validate_features():
+    validate_features({"age": 71, "sex": "M", "treatment": None})
+    for features in [[], {"unknown": 1}, {"age": "71"}, {"age": True}, {"sex": 1}]:
+        with pytest.raises(ValueError):
+            validate_features(features)
+
+
+def test_get_content_length():
+    assert get_content_length({"Content-Length": "12"}) == 12
+    for headers in [{}, {"Content-Length": "twelve"}, {"Content-Length": "-1"}, {"Content-Length": "1.5"}]:
+        with pytest.raises(ValueError):
+            get_content_length(headers)
+
+
+@pytest.mark.parametrize("content_length", ["twelve", "-1"])
+def test_invalid_content_length_is_rejected(server_port, content_length):
+    connection = HTTPConnection("127.0.0.1", server_port, timeout=5)
+    connection.putrequest("POST", "/recommendation")
+    connection.putheader("Content-Length", content_length)
+    connection.endheaders()
+
+    response = connection.getresponse()
+
+    assert response.status == 400
+    assert b"Content-Length" in response.read()
+
+
+def test_failing_request_does_not_fail_its_batch(batcher):
+    ages = [71, 45, _FAILING_AGE, 80, 62]
+    futures = [batcher.submit({"age": age}) for age in ages]
+
+    with pytest.raises(ValueError):
+        futures[2].result(5)
+    results = [future.result(5) for (age, future) in zip(ages, futures) if age != _FAILING_AGE]
+    assert [result["treatment"] for result in results] == ["40mg IV", None, "40mg IV", "40mg IV"]
+
+    stats = batcher.get_stats()
+    assert stats["requests"] == 5
+    assert stats["failed_requests"] == 1
+    assert stats["mean_batch_size"] == 5